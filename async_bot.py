@@ -0,0 +1,460 @@
+"""
+   Async bot module. Contains the AsyncBot class, a Bot that runs on an
+   asyncio event loop instead of a blocking select loop.
+"""
+
+import sys
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import inspect
+import time
+
+import irc_message
+import extension
+import bot
+import send_queue
+
+# stop creating .pyc files
+sys.dont_write_bytecode = True
+
+class AsyncBot(bot.Bot):
+
+   def __init__(self, settings = {}):
+      super(AsyncBot, self).__init__(settings)
+      self.__init_async_settings(settings)
+      self.loop = None
+      self.loop_thread = None
+      self.stream_reader = None
+      self.stream_writer = None
+      self.flush_handle = None
+      self.flush_soon = False
+      # the event loop's timer for the scheduler's next timer
+      self.timer_handle = None
+      self.sendq = send_queue.SendQueue(self.__stream_write, self.send_rate, self.send_burst)
+      # Maps a conversation key (a channel, or a nick for private messages)
+      # to the deque of messages waiting to be dispatched for it. Messages in
+      # one conversation are handled in order, while separate conversations
+      # are handled concurrently.
+      self.conversations = {}
+      self.tasks = set()
+      self.executor = concurrent.futures.ThreadPoolExecutor(
+         max_workers=self.async_workers,
+         thread_name_prefix='extension')
+
+
+   # Initialize the settings specific to AsyncBot, to defaults if not given.
+   def __init_async_settings(self, settings):
+      # number of threads available to run synchronous extension hooks
+      self.async_workers = settings.get('async_workers', 8)
+
+
+   # Queue an encoded line through the send queue, like Bot._send_data.
+   # Synchronous extensions call this from executor threads, in which case the
+   # line is handed over to the event loop.
+   def _send_data(self, data, target=None, priority=None):
+      if threading.get_ident() == self.loop_thread:
+         self.__queue_line(data, target, priority)
+      else:
+         self.loop.call_soon_threadsafe(self.__queue_line, data, target, priority)
+
+
+   # Queue a line, to be written along with everything else queued in this
+   # pass of the event loop.
+   def __queue_line(self, data, target, priority):
+      self.sendq.put(data, target, priority)
+      if not self.flush_soon:
+         if self.flush_handle is not None:
+            self.flush_handle.cancel()
+         self.flush_handle = self.loop.call_soon(self.__flush)
+         self.flush_soon = True
+
+
+   # Flush the send queue, and if anything is left over arrange to be called
+   # again once the queue can make progress.
+   def __flush(self):
+      self.flush_handle = None
+      self.flush_soon = False
+      self.sendq.flush()
+      if not self.sendq.pending():
+         return
+      if self.sendq.blocked():
+         delay = AsyncBot.BLOCKED_RETRY
+      else:
+         delay = self.sendq.delay()
+      if self.flush_handle is None and delay is not None:
+         self.flush_handle = self.loop.call_later(delay, self.__flush)
+
+
+   # Write to the stream for the send queue. Once the stream has buffered
+   # more than the transport's high-water mark, refuse more data, so a slow
+   # server fills our send queue rather than memory.
+   def __stream_write(self, data):
+      if self.stream_writer.transport.get_write_buffer_size() >= AsyncBot.WRITE_BUFFER_LIMIT:
+         raise BlockingIOError()
+      self.stream_writer.write(data)
+      return len(data)
+
+
+   # Get a line from the IRC server, as bytes. Raises an EOFError if the
+   # connection is closed for some reason, and also takes care of the \r\n on
+   # the end.
+   async def __get_line(self):
+      data = await self.stream_reader.readline()
+      if not data:
+         raise EOFError('Connection closed unexpectedly')
+      self.metrics.bytes_in += len(data)
+      return data.rstrip(b'\r\n')
+
+
+   # Open connection to an IRC server. Like Bot.connect, this returns once the
+   # server has welcomed the bot.
+   async def connect(self, server, nick, port=6667, ident="x", realname="x"):
+      self.server = server
+      self.port = port
+      self.start_nick = nick
+      self.ident = ident
+      self.realname = realname
+      if self.network is None:
+         self.network = server
+      self.loop = asyncio.get_running_loop()
+      self.loop_thread = threading.get_ident()
+      try:
+         self.stream_reader, self.stream_writer = await asyncio.open_connection(server, port)
+      except OSError as serr:
+         self.log('Connection error:', serr)
+         raise serr
+
+      # anything left over from a previous connection is dropped
+      self.sendq.clear()
+      # registration goes out ahead of everything else
+      self._socksend('USER %s %s %s :%s' % (ident, server, server, realname), priority=send_queue.SendQueue.HIGH)
+      self._socksend('NICK %s' % nick, priority=send_queue.SendQueue.HIGH)
+
+      command = ""
+      # wait for 001 (successful connection to the server)
+      while command != "001":
+         try:
+            line = await self.__get_line()
+            msg = irc_message.IrcMessage(line, self.fallback_encoding)
+         except EOFError as e:
+            self.log('Connection closed while waiting for 001')
+            raise e
+         except ValueError as e:
+            self.log('Problem parsing received line: %s' % e)
+            continue
+
+         command = msg.command
+         self._pre_welcome(msg)
+
+
+   # Interacts with the IRC server until the bot is terminated manually or the
+   # server closes the connection. Reading from the server never waits on an
+   # extension; each message is queued on its conversation and dispatched by a
+   # separate task.
+   async def interact(self):
+      if self.metrics_port is not None and self.metrics.server is None:
+         self.metrics.serve(self.metrics_port)
+      quit_event = asyncio.Event()
+
+      def read_console():
+         user_input = sys.stdin.readline().rstrip('\n').split()
+         if not self._console_command(user_input):
+            quit_event.set()
+
+      try:
+         self.loop.add_reader(sys.stdin, read_console)
+      except OSError:
+         # stdin is something that can't be polled, like /dev/null
+         self.log('Warning: console input is unavailable')
+      # timers run on the event loop, woken up for the next one due
+      self.scheduler.on_change = self.__timers_changed
+      self.__arm_timers()
+      read_task = self.loop.create_task(self.__read_server())
+      quit_task = self.loop.create_task(quit_event.wait())
+      try:
+         await asyncio.wait([read_task, quit_task], return_when=asyncio.FIRST_COMPLETED)
+      finally:
+         self.scheduler.on_change = None
+         if self.timer_handle is not None:
+            self.timer_handle.cancel()
+            self.timer_handle = None
+         self.loop.remove_reader(sys.stdin)
+         read_task.cancel()
+         quit_task.cancel()
+         try:
+            await self.stream_writer.drain()
+         except ConnectionError:
+            pass
+
+
+   # Set the event loop's timer for the scheduler's next timer.
+   def __arm_timers(self):
+      if self.timer_handle is not None:
+         self.timer_handle.cancel()
+      delay = self.scheduler.delay()
+      if delay is None:
+         self.timer_handle = None
+      else:
+         self.timer_handle = self.loop.call_later(delay, self.__run_timers)
+
+
+   def __run_timers(self):
+      self.timer_handle = None
+      self._run_timers()
+      self.__arm_timers()
+
+
+   # Timers may be set from executor threads too.
+   def __timers_changed(self):
+      if threading.get_ident() == self.loop_thread:
+         self.__arm_timers()
+      else:
+         self.loop.call_soon_threadsafe(self.__arm_timers)
+
+
+   # Read lines from the server until it closes the connection.
+   async def __read_server(self):
+      while True:
+         # any OSError (a reset or a timeout) means the connection has
+         # failed, and so does a ValueError, for a line longer than the
+         # stream will buffer
+         try:
+            line = await self.__get_line()
+         except EOFError:
+            self.log('Connection closed unexpectedly')
+            if not (self.reconnect_enabled and await self.reconnect()):
+               return
+            continue
+         except (OSError, ValueError) as e:
+            self.log('Connection lost: %s' % e)
+            if not (self.reconnect_enabled and await self.reconnect()):
+               return
+            continue
+
+         self.metrics.record_line()
+         try:
+            msg = irc_message.IrcMessage(line, self.fallback_encoding)
+         except ValueError as e:
+            self.log('Problem parsing received line: %s' % e)
+            continue
+         self._track_session(msg)
+         self._queue_message(msg)
+
+
+   # Reconnect to the server after the connection has dropped, like
+   # Bot.reconnect, without blocking the event loop while waiting.
+   async def reconnect(self):
+      self.stream_writer.close()
+      self._notify_extensions('on_disconnect')
+
+      attempt = 0
+      delay = self._first_reconnect_delay()
+      while self._may_reconnect(attempt):
+         attempt += 1
+         if delay > 0:
+            await asyncio.sleep(self._reconnect_wait(delay))
+         self.log('Reconnecting to %s (attempt %d)' % (self.server, attempt))
+         try:
+            await self.connect(self.server, self.start_nick, self.port, self.ident, self.realname)
+         except (OSError, EOFError) as e:
+            self.log('Reconnect failed:', e)
+            delay = self._next_reconnect_delay(delay)
+            continue
+
+         self.reconnect_delay = delay
+         self._rejoin()
+         self._notify_extensions('on_reconnect')
+         return True
+
+      self.log('Giving up on reconnecting to', self.server)
+      return False
+
+
+   # Queue a message on its conversation, starting a task to work through the
+   # conversation if one isn't already running.
+   def _queue_message(self, msg):
+      key = self._conversation_key(msg)
+      pending = self.conversations.get(key)
+      if pending is None:
+         pending = collections.deque()
+         self.conversations[key] = pending
+         self.__start_task(self.__run_conversation(key, pending))
+      pending.append(msg)
+
+
+   # Start a task, keeping a reference to it until it finishes.
+   def __start_task(self, coro):
+      task = self.loop.create_task(coro)
+      self.tasks.add(task)
+      task.add_done_callback(self.tasks.discard)
+
+
+   # Wrap an extension's hook for the dispatch index like Bot._guard, but as a
+   # coroutine function. The hook is awaited with the time budget as a
+   # timeout, which cancels a coroutine hook, or abandons a synchronous one
+   # to finish on its executor thread. A blocking extension's synchronous
+   # hooks run on its own detached threads, as they would for a Bot, so one
+   # whose calls hang can't take up the executor the others share.
+   def _guard_hook(self, ext, hook):
+      breaker = self._breaker(ext)
+      budget = self._time_budget(ext)
+      detach = ext.blocking and budget is not None and not inspect.iscoroutinefunction(hook)
+      if detach:
+         executor, slots = self._detached(ext)
+
+      async def guarded(msg):
+         if not breaker.allow():
+            return None
+         future = None
+         if detach:
+            if not slots.acquire(blocking=False):
+               self._breaker_failed(breaker, 'has %d calls still running' % self.detached_threads)
+               return None
+            future = executor.submit(self._run_detached, slots, hook, msg)
+            call = asyncio.wrap_future(future)
+         else:
+            call = ext.run_hook_async(hook, msg, self.executor)
+         try:
+            retn = await asyncio.wait_for(call, budget)
+         except asyncio.TimeoutError:
+            if future is not None and future.cancel():
+               # it never started, so its slot is still taken
+               slots.release()
+            self._breaker_failed(breaker, 'abandoned after %.1fs' % budget)
+            return None
+         except Exception as e:
+            self._breaker_failed(breaker, 'raised %s' % type(e).__name__)
+            raise
+         if breaker.succeeded():
+            self.log('%s is working again' % ext.name)
+         return retn
+
+      return guarded
+
+
+   # Make the PRIVMSG hook running an extension's commands and triggers like
+   # Bot._trigger_hook, but as a coroutine function awaiting each handler as
+   # wrapped by _guard_hook. So coroutine handlers run on the event loop and
+   # synchronous ones on a single executor thread.
+   def _trigger_hook(self, registry, ext):
+      return registry.hook_async(ext, self._rate_limit(ext))
+
+
+   # Call an observer extension's hook in its own task.
+   async def __run_observer(self, ext, hook, stats, msg):
+      token = extension.dispatching.set(self)
+      start = time.perf_counter()
+      try:
+         retn = await ext.run_hook_async(hook, msg, self.executor)
+         self.metrics.record(stats, retn, time.perf_counter() - start)
+      except Exception:
+         self.metrics.record(stats, None, time.perf_counter() - start, True)
+         self.logger.exception('Exception triggered from message:', msg, '\nin extension', ext.name)
+      finally:
+         extension.dispatching.reset(token)
+
+
+   # Dispatch the messages of one conversation in order, finishing once
+   # there are none left.
+   async def __run_conversation(self, key, pending):
+      while pending:
+         await self._dispatch(pending.popleft())
+      del self.conversations[key]
+
+
+   # Run a message through the list of extensions and then the hooks, with
+   # the same halt and handled semantics as Bot._process_line. Extensions'
+   # hooks see this bot as the dispatching one, in the task and in the
+   # executor threads they are run on.
+   async def _dispatch(self, msg):
+      token = extension.dispatching.set(self)
+      try:
+         await self.__dispatch(msg)
+      finally:
+         extension.dispatching.reset(token)
+
+
+   async def __dispatch(self, msg):
+      halt = False
+      handled = False
+      for ext, hook, stats in self.dispatch.get(msg.command, ()):
+         if ext.role == extension.Extension.OBSERVER:
+            # Observers never halt, so nothing after them has to wait for
+            # them to finish.
+            self.__start_task(self.__run_observer(ext, hook, stats, msg))
+            handled = True
+            continue
+         # this includes any time spent waiting for an executor thread
+         start = time.perf_counter()
+         try:
+            retn = await ext.run_hook_async(hook, msg, self.executor)
+            self.metrics.record(stats, retn, time.perf_counter() - start)
+            if retn == True:
+               halt = True
+               handled = True
+               break
+            if retn == False:
+               handled = True
+            # if retn is anything else, set neither halt nor handled
+
+         except Exception:
+            self.metrics.record(stats, None, time.perf_counter() - start, True)
+            self.logger.exception('Exception triggered from message:', msg, '\nin extension', ext.name)
+
+      # The bot's own hooks are kept minimal and cheap (PING and the like),
+      # so they are called directly on the loop unless they are coroutines.
+      if not halt:
+         if msg.command in self.hooks:
+            halt = True
+            handled = True
+            stats = self.metrics.hook_stats(bot.Bot.HOOK_STATS_NAME, msg.command)
+            start = time.perf_counter()
+            try:
+               retn = self.hooks[msg.command](msg)
+               if asyncio.iscoroutine(retn):
+                  await retn
+               self.metrics.record(stats, True, time.perf_counter() - start)
+            except Exception:
+               self.metrics.record(stats, None, time.perf_counter() - start, True)
+               self.logger.exception('Exception triggered from message:', msg, '\nin hook', msg.command)
+
+      self._report_message(msg, halt, handled)
+
+
+   # The destructor for the bot. Waits for messages still being dispatched,
+   # then closes the connection and calls all extensions' cleanup methods.
+   async def cleanup(self):
+      while self.tasks:
+         await asyncio.wait(list(self.tasks))
+      if self.flush_handle is not None:
+         self.flush_handle.cancel()
+      self.sendq.flush()
+      self.stream_writer.close()
+      try:
+         await self.stream_writer.wait_closed()
+      except OSError:
+         pass
+      self.metrics.shutdown()
+      self.log('Connection closed successfully.')
+      # every task has finished, so only abandoned hooks could still be
+      # running, and they aren't waited for
+      self.executor.shutdown(wait=False, cancel_futures=True)
+      self._shutdown_detached()
+      for ext in self.extensions:
+         ext.detach(self)
+         if not ext.bots:
+            ext.cleanup()
+      if self.owns_logger:
+         self.logger.close()
+
+
+   ###
+   ### Constants
+   ###
+
+   # bytes the stream may buffer before the send queue holds on to lines
+   WRITE_BUFFER_LIMIT = 65536
+   # seconds to wait before retrying a flush the stream refused
+   BLOCKED_RETRY = 0.05
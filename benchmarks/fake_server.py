@@ -0,0 +1,656 @@
+"""
+   A local stand-in for an IRC server, for load and integration testing the
+   bot without a real network. It speaks enough of the protocol for
+   registration (including 432 and 433 nick errors), JOIN/PART/NAMES,
+   PRIVMSG, NICK, PING and QUIT, simulates channels full of users talking
+   at a configurable rate, and applies flood limits like a real ircd.
+
+   Usage: python benchmarks/fake_server.py [--port N] [--channel #chan --rate N ...]
+   or start a FakeIrcServer from another script; see loadtest.py.
+"""
+
+import sys
+import socket
+import selectors
+import threading
+import collections
+import random
+import re
+import time
+import argparse
+
+# stop creating .pyc files
+sys.dont_write_bytecode = True
+
+WORDS = ('the quick brown fox jumps over the lazy dog is are what why '
+         'lol ok yes no maybe tomorrow python irc bot karma quote').split()
+
+# Message generators for simulators, each taking a random generator and the
+# list of simulated nicks and returning the text of one message.
+
+def chatter_text(rng, nicks):
+   return ' '.join(rng.choice(WORDS) for i in range(rng.randint(3, 12)))
+
+def karma_text(rng, nicks):
+   return ' '.join(t + rng.choice(['++', '++', '--']) for t in rng.sample(nicks, min(len(nicks), rng.randint(1, 3))))
+
+def command_text(rng, nicks):
+   return rng.choice(['!quote', '!karma ' + rng.choice(nicks), 'hype', chatter_text(rng, nicks)])
+
+TRAFFIC = {
+   'chatter': chatter_text,
+   'karma': karma_text,
+   'commands': command_text,
+}
+
+
+class Simulator:
+
+   # A crowd of users that don't really connect, talking in a channel at
+   # rate messages per second. text is a function taking a random generator
+   # and the list of nicks and returning a message.
+   def __init__(self, channel, rate, users=100, text=chatter_text, seed=None, prefix='sim'):
+      self.channel = channel
+      self.rate = rate
+      self.nicks = ['%s%d' % (prefix, i) for i in range(users)]
+      self.text = text
+      self.rng = random.Random(seed)
+      self.start = None
+      self.generated = 0
+
+
+   # Return the lines due since the last call, at most limit of them, so a
+   # stall doesn't turn into one enormous burst.
+   def due(self, now, limit=10000):
+      if self.start is None:
+         self.start = now
+      count = min(limit, int((now - self.start) * self.rate) - self.generated)
+      lines = []
+      for i in range(count):
+         nick = self.rng.choice(self.nicks)
+         lines.append(':%s!~%s@sim.example.net PRIVMSG %s :%s' % (
+            nick, nick, self.channel, self.text(self.rng, self.nicks)))
+      self.generated += max(0, count)
+      return lines
+
+
+class Client:
+
+   def __init__(self, sock, address):
+      self.sock = sock
+      self.address = address
+      self.inbuf = bytearray()
+      self.outbuf = bytearray()
+      self.nick = None
+      self.user = None
+      self.registered = False
+      self.channels = set()
+      # flood control clock, as in ircu: each line moves it penalty seconds
+      # into the future, and lines are only processed while it is no more
+      # than the burst allowance ahead of now
+      self.flood_clock = 0.0
+      self.closing = False
+
+   def prefix(self):
+      return '%s!~%s@%s' % (self.nick, self.user or self.nick, self.address[0])
+
+
+class FakeIrcServer:
+
+   def __init__(self, host='127.0.0.1', port=0, settings={}):
+      self.__init_settings(settings)
+      self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      self.listener.bind((host, port))
+      self.listener.listen(64)
+      self.listener.setblocking(False)
+      self.host, self.port = self.listener.getsockname()
+
+      self.selector = selectors.DefaultSelector()
+      self.selector.register(self.listener, selectors.EVENT_READ, None)
+      # woken up by the control methods, which run on other threads
+      self.wake_r, self.wake_w = socket.socketpair()
+      self.wake_r.setblocking(False)
+      self.selector.register(self.wake_r, selectors.EVENT_READ, None)
+      self.commands = collections.deque()
+
+      self.clients = []
+      # maps lowercased channel names to sets of Clients
+      self.channels = {}
+      self.simulators = []
+      self.thread = None
+      self.running = False
+
+      # counters
+      self.stats = collections.Counter()
+      # times each channel was last joined by a real client, for measuring
+      # how long a reconnect takes
+      self.join_times = {}
+
+
+   # Initialize the server's settings, to defaults if not given.
+   def __init_settings(self, settings):
+      self.name = settings.get('server_name', 'irc.example.net')
+      # nicks that are always in use, to exercise 433 handling
+      self.taken_nicks = set(n.lower() for n in settings.get('taken_nicks', []))
+      self.nick_length = settings.get('nick_length', 16)
+      # Flood control. Each line costs flood_penalty seconds and a client may
+      # get flood_burst seconds ahead of real time; past that its lines wait
+      # in its receive queue, and if that grows past recvq bytes it is
+      # disconnected for Excess Flood. The defaults allow 2 lines a second
+      # with bursts of 5, matching Bot's send_rate and send_burst.
+      self.flood_penalty = settings.get('flood_penalty', 0.5)
+      self.flood_burst = settings.get('flood_burst', 2.5)
+      self.recvq = settings.get('recvq', 4096)
+      # clients that don't read what is sent to them are dropped once this
+      # many bytes are waiting
+      self.sendq = settings.get('sendq', 8 * 1024 * 1024)
+      self.max_line = settings.get('max_line', 512)
+
+
+   ###
+   ### Control, safe to call from any thread
+   ###
+
+   # Run the server on a background thread.
+   def start(self):
+      self.running = True
+      self.thread = threading.Thread(None, self.serve, 'fake-ircd')
+      self.thread.daemon = True
+      self.thread.start()
+      return self
+
+
+   def stop(self):
+      self.__control(self.__stop)
+      if self.thread is not None:
+         self.thread.join()
+         self.thread = None
+
+
+   # Start a simulator talking.
+   def add_simulator(self, simulator):
+      self.__control(lambda: self.simulators.append(simulator))
+
+
+   # Drop every client, like a netsplit or server restart.
+   def disconnect_all(self, reason='Server restarting'):
+      def drop():
+         for client in list(self.clients):
+            self.__send(client, 'ERROR :Closing Link: %s (%s)' % (client.address[0], reason))
+            self.__close(client, flush=True)
+      self.__control(drop)
+
+
+   def __control(self, fn):
+      self.commands.append(fn)
+      try:
+         self.wake_w.send(b'x')
+      except OSError:
+         pass
+
+
+   ###
+   ### Event loop
+   ###
+
+   def serve(self):
+      self.running = True
+      while self.running:
+         now = time.monotonic()
+         self.__run_simulators(now)
+         self.__process_deferred(now)
+
+         for client in self.clients:
+            events = selectors.EVENT_READ
+            if client.outbuf:
+               events |= selectors.EVENT_WRITE
+            if self.selector.get_key(client.sock).events != events:
+               self.selector.modify(client.sock, events, client)
+
+         timeout = 0.005 if self.simulators or self.__any_deferred() else None
+         for key, mask in self.selector.select(timeout):
+            client = key.data
+            if key.fileobj is self.listener:
+               self.__accept()
+            elif key.fileobj is self.wake_r:
+               self.__drain_wake()
+            else:
+               if mask & selectors.EVENT_WRITE:
+                  self.__flush(client)
+               if mask & selectors.EVENT_READ and not client.closing:
+                  self.__read(client)
+
+      for client in list(self.clients):
+         self.__close(client)
+      self.selector.close()
+      self.listener.close()
+      self.wake_r.close()
+      self.wake_w.close()
+
+
+   def __stop(self):
+      self.running = False
+
+
+   def __drain_wake(self):
+      try:
+         while self.wake_r.recv(4096):
+            pass
+      except BlockingIOError:
+         pass
+      while self.commands:
+         self.commands.popleft()()
+
+
+   def __accept(self):
+      try:
+         sock, address = self.listener.accept()
+      except BlockingIOError:
+         return
+      sock.setblocking(False)
+      client = Client(sock, address)
+      self.clients.append(client)
+      self.selector.register(sock, selectors.EVENT_READ, client)
+      self.stats['connections'] += 1
+
+
+   def __read(self, client):
+      try:
+         data = client.sock.recv(65536)
+      except (BlockingIOError, InterruptedError):
+         return
+      except OSError:
+         data = b''
+      if not data:
+         self.__close(client)
+         return
+      self.stats['bytes_received'] += len(data)
+      client.inbuf += data
+      self.__process_lines(client, time.monotonic())
+
+
+   # Process as many complete lines from a client as flood control allows.
+   def __process_lines(self, client, now):
+      while not client.closing:
+         end = client.inbuf.find(b'\n')
+         if end < 0:
+            break
+         if client.flood_clock - now > self.flood_burst:
+            # over the limit: the line waits, as on a real ircd
+            self.stats['lines_throttled'] += 1
+            break
+         raw = bytes(client.inbuf[:end]).rstrip(b'\r')
+         del client.inbuf[:end + 1]
+         client.flood_clock = max(client.flood_clock, now) + self.flood_penalty
+         if len(raw) + 2 > self.max_line:
+            self.stats['long_lines'] += 1
+            raw = raw[:self.max_line - 2]
+         self.stats['lines_received'] += 1
+         self.__handle(client, str(raw, 'utf-8', 'replace'))
+
+      if not client.closing and len(client.inbuf) > self.recvq:
+         self.stats['excess_flood_kills'] += 1
+         self.__send(client, 'ERROR :Closing Link: %s (Excess Flood)' % client.address[0])
+         self.__close(client, flush=True)
+
+
+   # Work through lines held back by flood control whose time has come.
+   def __process_deferred(self, now):
+      for client in list(self.clients):
+         if b'\n' in client.inbuf and client.flood_clock - now <= self.flood_burst:
+            self.__process_lines(client, now)
+
+
+   def __any_deferred(self):
+      return any(b'\n' in client.inbuf for client in self.clients)
+
+
+   def __run_simulators(self, now):
+      for sim in self.simulators:
+         lines = sim.due(now)
+         if not lines:
+            continue
+         members = self.channels.get(sim.channel.lower(), ())
+         for line in lines:
+            data = (line + '\r\n').encode('utf-8')
+            for client in members:
+               self.__queue(client, data)
+         self.stats['simulated_messages'] += len(lines)
+
+
+   ###
+   ### Protocol
+   ###
+
+   # Split a line into its command and parameters, the last of which may
+   # contain spaces if it follows a colon.
+   @staticmethod
+   def parse(line):
+      if line.startswith(':'):
+         line = line.partition(' ')[2]
+      line, colon, trail = line.partition(' :')
+      params = line.split()
+      if colon:
+         params.append(trail)
+      if not params:
+         return ('', [])
+      return (params[0].upper(), params[1:])
+
+
+   def __handle(self, client, line):
+      command, params = FakeIrcServer.parse(line)
+      if not command:
+         return
+      handler = FakeIrcServer.HANDLERS.get(command)
+      if not client.registered and command not in FakeIrcServer.PRE_REGISTRATION:
+         self.__numeric(client, '451', ':You have not registered')
+         return
+      if handler is None:
+         self.__numeric(client, '421', '%s :Unknown command' % command)
+         return
+      handler(self, client, params)
+
+
+   def _nick(self, client, params):
+      if not params:
+         self.__numeric(client, '431', ':No nickname given')
+         return
+      nick = params[0]
+      if not FakeIrcServer.NICK_RE.match(nick) or len(nick) > self.nick_length:
+         self.__numeric(client, '432', '%s :Erroneous Nickname' % nick)
+         return
+      if self.__nick_taken(nick, client):
+         self.__numeric(client, '433', '%s :Nickname is already in use' % nick)
+         return
+
+      if client.registered:
+         line = ':%s NICK :%s' % (client.prefix(), nick)
+         self.__send(client, line)
+         for peer in self.__peers(client):
+            self.__send(peer, line)
+         client.nick = nick
+      else:
+         client.nick = nick
+         self.__try_register(client)
+
+
+   def _user(self, client, params):
+      if client.registered:
+         self.__numeric(client, '462', ':You may not reregister')
+         return
+      if len(params) < 4:
+         self.__numeric(client, '461', 'USER :Not enough parameters')
+         return
+      client.user = params[0]
+      self.__try_register(client)
+
+
+   def _join(self, client, params):
+      if not params:
+         self.__numeric(client, '461', 'JOIN :Not enough parameters')
+         return
+      for chan in params[0].split(','):
+         if not chan.startswith('#'):
+            self.__numeric(client, '403', '%s :No such channel' % chan)
+            continue
+         key = chan.lower()
+         members = self.channels.setdefault(key, set())
+         if client in members:
+            continue
+         members.add(client)
+         client.channels.add(key)
+         self.join_times[key] = time.monotonic()
+         line = ':%s JOIN %s' % (client.prefix(), chan)
+         for member in members:
+            self.__send(member, line)
+         self.__names(client, chan)
+
+
+   def _part(self, client, params):
+      if not params:
+         self.__numeric(client, '461', 'PART :Not enough parameters')
+         return
+      reason = params[1] if len(params) > 1 else ''
+      for chan in params[0].split(','):
+         key = chan.lower()
+         members = self.channels.get(key)
+         if members is None or client not in members:
+            self.__numeric(client, '442', "%s :You're not on that channel" % chan)
+            continue
+         line = ':%s PART %s :%s' % (client.prefix(), chan, reason)
+         for member in members:
+            self.__send(member, line)
+         self.__leave(client, key)
+
+
+   def _privmsg(self, client, params, command='PRIVMSG'):
+      if not params:
+         self.__numeric(client, '411', ':No recipient given (%s)' % command)
+         return
+      if len(params) < 2 or not params[1]:
+         self.__numeric(client, '412', ':No text to send')
+         return
+      self.stats[command.lower() + 's_received'] += 1
+      target = params[0]
+      line = ':%s %s %s :%s' % (client.prefix(), command, target, params[1])
+      if target.startswith('#'):
+         members = self.channels.get(target.lower())
+         if members is None:
+            self.__numeric(client, '401', '%s :No such nick/channel' % target)
+            return
+         for member in members:
+            if member is not client:
+               self.__send(member, line)
+      else:
+         peer = self.__find_nick(target)
+         if peer is None:
+            if not self.__simulated(target):
+               self.__numeric(client, '401', '%s :No such nick/channel' % target)
+            return
+         self.__send(peer, line)
+
+
+   def _notice(self, client, params):
+      self._privmsg(client, params, 'NOTICE')
+
+
+   def _ping(self, client, params):
+      token = params[0] if params else self.name
+      self.__send(client, ':%s PONG %s :%s' % (self.name, self.name, token))
+
+
+   def _pong(self, client, params):
+      self.stats['pongs_received'] += 1
+
+
+   def _quit(self, client, params):
+      reason = params[0] if params else 'Client Quit'
+      self.__send(client, 'ERROR :Closing Link: %s (Quit: %s)' % (client.address[0], reason))
+      self.__close(client, flush=True, reason='Quit: ' + reason)
+
+
+   HANDLERS = {
+      'NICK': _nick,
+      'USER': _user,
+      'JOIN': _join,
+      'PART': _part,
+      'PRIVMSG': _privmsg,
+      'NOTICE': _notice,
+      'PING': _ping,
+      'PONG': _pong,
+      'QUIT': _quit,
+   }
+   PRE_REGISTRATION = frozenset(['NICK', 'USER', 'PING', 'PONG', 'QUIT'])
+   NICK_RE = re.compile(r'^[A-Za-z\[\]\\`_^{|}][A-Za-z0-9\[\]\\`_^{|}-]*$')
+
+
+   def __try_register(self, client):
+      if client.registered or client.nick is None or client.user is None:
+         return
+      client.registered = True
+      self.stats['registrations'] += 1
+      self.__numeric(client, '001', ':Welcome to the fake IRC network %s' % client.prefix())
+      self.__numeric(client, '002', ':Your host is %s, running fake-ircd' % self.name)
+      self.__numeric(client, '003', ':This server was created just now')
+      self.__numeric(client, '004', '%s fake-ircd i nt' % self.name)
+      self.__numeric(client, '375', ':- %s Message of the Day -' % self.name)
+      self.__numeric(client, '372', ':- This server is for testing only.')
+      self.__numeric(client, '376', ':End of /MOTD command.')
+
+
+   def __names(self, client, chan):
+      key = chan.lower()
+      nicks = [member.nick for member in self.channels.get(key, ())]
+      for sim in self.simulators:
+         if sim.channel.lower() == key:
+            nicks.extend(sim.nicks)
+      # split the list over as many lines as it takes, like a real server
+      line = []
+      length = 0
+      for nick in nicks:
+         if line and length + len(nick) + 1 > 400:
+            self.__numeric(client, '353', '= %s :%s' % (chan, ' '.join(line)))
+            line = []
+            length = 0
+         line.append(nick)
+         length += len(nick) + 1
+      if line:
+         self.__numeric(client, '353', '= %s :%s' % (chan, ' '.join(line)))
+      self.__numeric(client, '366', '%s :End of /NAMES list.' % chan)
+
+
+   def __nick_taken(self, nick, client):
+      lower = nick.lower()
+      if lower in self.taken_nicks or self.__simulated(nick):
+         return True
+      other = self.__find_nick(nick)
+      return other is not None and other is not client
+
+
+   def __find_nick(self, nick):
+      lower = nick.lower()
+      for client in self.clients:
+         if client.nick is not None and client.nick.lower() == lower:
+            return client
+      return None
+
+
+   def __simulated(self, nick):
+      return any(nick in sim.nicks for sim in self.simulators)
+
+
+   # The other clients sharing a channel with a client.
+   def __peers(self, client):
+      peers = set()
+      for key in client.channels:
+         peers.update(self.channels.get(key, ()))
+      peers.discard(client)
+      return peers
+
+
+   def __leave(self, client, key):
+      members = self.channels.get(key)
+      if members is not None:
+         members.discard(client)
+         if not members:
+            del self.channels[key]
+      client.channels.discard(key)
+
+
+   ###
+   ### Output
+   ###
+
+   def __numeric(self, client, numeric, text):
+      self.__send(client, ':%s %s %s %s' % (self.name, numeric, client.nick or '*', text))
+
+
+   def __send(self, client, line):
+      self.__queue(client, (line + '\r\n').encode('utf-8'))
+
+
+   def __queue(self, client, data):
+      if client.closing:
+         return
+      client.outbuf += data
+      self.stats['lines_sent'] += 1
+      if len(client.outbuf) > self.sendq:
+         self.stats['sendq_exceeded'] += 1
+         client.outbuf = bytearray()
+         self.__close(client)
+
+
+   def __flush(self, client):
+      try:
+         nbytes = client.sock.send(client.outbuf)
+      except (BlockingIOError, InterruptedError):
+         return
+      except OSError:
+         self.__close(client)
+         return
+      self.stats['bytes_sent'] += nbytes
+      del client.outbuf[:nbytes]
+
+
+   # Remove a client, telling the channels it was on. With flush, whatever is
+   # still queued for it is written first, as far as the socket will take it.
+   def __close(self, client, flush=False, reason='Connection closed'):
+      if client not in self.clients:
+         return
+      client.closing = True
+      if flush and client.outbuf:
+         try:
+            client.sock.setblocking(True)
+            client.sock.settimeout(1.0)
+            client.sock.sendall(client.outbuf)
+         except OSError:
+            pass
+      if client.registered:
+         line = ':%s QUIT :%s' % (client.prefix(), reason)
+         for peer in self.__peers(client):
+            self.__send(peer, line)
+      for key in list(client.channels):
+         self.__leave(client, key)
+      self.clients.remove(client)
+      self.selector.unregister(client.sock)
+      try:
+         client.sock.shutdown(socket.SHUT_RDWR)
+      except OSError:
+         pass
+      client.sock.close()
+      self.stats['disconnections'] += 1
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Run a fake IRC server for testing.')
+   parser.add_argument('--host', default='127.0.0.1')
+   parser.add_argument('--port', type=int, default=6667)
+   parser.add_argument('--channel', action='append', default=[], help='channel to simulate traffic in (repeatable)')
+   parser.add_argument('--rate', type=float, default=100, help='simulated messages per second per channel')
+   parser.add_argument('--users', type=int, default=100, help='simulated users per channel')
+   parser.add_argument('--traffic', choices=sorted(TRAFFIC), default='chatter')
+   parser.add_argument('--taken', action='append', default=[], help='nick to report as already in use (repeatable)')
+   parser.add_argument('--flood-penalty', type=float, default=0.5)
+   parser.add_argument('--flood-burst', type=float, default=2.5)
+   args = parser.parse_args()
+
+   server = FakeIrcServer(args.host, args.port, {
+      'taken_nicks': args.taken,
+      'flood_penalty': args.flood_penalty,
+      'flood_burst': args.flood_burst,
+   })
+   for i, chan in enumerate(args.channel):
+      server.add_simulator(Simulator(chan, args.rate, args.users, TRAFFIC[args.traffic], seed=i, prefix='sim%d_' % i))
+   server.start()
+   print('Listening on %s:%d' % (server.host, server.port))
+   try:
+      while True:
+         time.sleep(5)
+         print(', '.join('%s %d' % item for item in sorted(server.stats.items())))
+   except KeyboardInterrupt:
+      server.stop()
+
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,254 @@
+"""
+   In-process stand-ins for the network and MongoDB, so the bot and its
+   extensions can be benchmarked without either.
+"""
+
+import sys
+import itertools
+import copy
+
+# stop creating .pyc files
+sys.dont_write_bytecode = True
+
+class FakeSocket:
+
+   # Accepts everything the bot sends and counts it.
+   def __init__(self):
+      self.bytes_sent = 0
+      self.sends = 0
+
+   def send(self, data, flags=0):
+      self.sends += 1
+      self.bytes_sent += len(data)
+      return len(data)
+
+   def sendmsg(self, buffers, ancdata=(), flags=0):
+      self.sends += 1
+      total = sum(len(b) for b in buffers)
+      self.bytes_sent += total
+      return total
+
+   def close(self):
+      pass
+
+
+class FakeCollection:
+
+   # A small in-memory imitation of a pymongo collection, covering what the
+   # extensions use. Filters only support equality, $in, $gt/$gte/$lt/$lte
+   # and $ne.
+   def __init__(self, name):
+      self.name = name
+      self.docs = []
+      self.ids = itertools.count(1)
+      # counters, to see how many round trips a workload would cost
+      self.round_trips = 0
+
+
+   def find_one(self, spec=None, projection=None):
+      self.round_trips += 1
+      for doc in self.docs:
+         if FakeCollection.matches(doc, spec):
+            return FakeCollection.project(doc, projection)
+      return None
+
+
+   def find(self, spec=None, projection=None, sort=None, limit=0):
+      self.round_trips += 1
+      found = [FakeCollection.project(doc, projection) for doc in self.docs if FakeCollection.matches(doc, spec)]
+      if sort:
+         for key, direction in reversed(sort):
+            found.sort(key=lambda d: d.get(key, 0), reverse=(direction < 0))
+      if limit:
+         found = found[:limit]
+      return found
+
+
+   def count(self, spec=None):
+      self.round_trips += 1
+      if not spec:
+         return len(self.docs)
+      return sum(1 for doc in self.docs if FakeCollection.matches(doc, spec))
+
+   def count_documents(self, spec):
+      return self.count(spec)
+
+   def estimated_document_count(self):
+      return self.count()
+
+
+   def insert(self, doc):
+      self.round_trips += 1
+      return self.__insert(doc)
+
+   def insert_one(self, doc):
+      self.round_trips += 1
+      return FakeResult(inserted_id=self.__insert(doc))
+
+   def insert_many(self, docs, ordered=True):
+      self.round_trips += 1
+      return FakeResult(inserted_ids=[self.__insert(doc) for doc in docs])
+
+
+   def update(self, spec, change, upsert=False, multi=False):
+      self.round_trips += 1
+      return self.__update(spec, change, upsert, multi)
+
+   def update_one(self, spec, change, upsert=False):
+      self.round_trips += 1
+      return self.__update(spec, change, upsert, False)
+
+   def update_many(self, spec, change, upsert=False):
+      self.round_trips += 1
+      return self.__update(spec, change, upsert, True)
+
+
+   def find_one_and_update(self, spec, change, upsert=False, return_document=False):
+      self.round_trips += 1
+      for doc in self.docs:
+         if FakeCollection.matches(doc, spec):
+            before = dict(doc)
+            FakeCollection.apply(doc, change)
+            return dict(doc) if return_document else before
+      if upsert:
+         self.__update(spec, change, True, False)
+         return dict(self.docs[-1]) if return_document else None
+      return None
+
+
+   def delete_many(self, spec):
+      self.round_trips += 1
+      before = len(self.docs)
+      self.docs = [doc for doc in self.docs if not FakeCollection.matches(doc, spec)]
+      return FakeResult(deleted_count=before - len(self.docs))
+
+
+   # Apply a list of operations in one round trip. Operations are objects with
+   # the attributes of pymongo's UpdateOne/InsertOne/DeleteMany: an insert
+   # has a document, the others a filter and (for updates) an update and
+   # upsert flag.
+   def bulk_write(self, requests, ordered=True):
+      self.round_trips += 1
+      for request in requests:
+         kind = type(request).__name__
+         if kind == 'InsertOne':
+            self.__insert(request._doc)
+         elif kind in ('UpdateOne', 'UpdateMany'):
+            self.__update(request._filter, request._doc, request._upsert, kind == 'UpdateMany')
+         elif kind == 'DeleteMany':
+            self.docs = [doc for doc in self.docs if not FakeCollection.matches(doc, request._filter)]
+      return FakeResult()
+
+
+   def create_index(self, keys, **kwargs):
+      return str(keys)
+
+
+   def __insert(self, doc):
+      doc = copy.deepcopy(doc)
+      if '_id' not in doc:
+         doc['_id'] = '%024x' % next(self.ids)
+      self.docs.append(doc)
+      return doc['_id']
+
+
+   def __update(self, spec, change, upsert, multi):
+      matched = 0
+      for doc in self.docs:
+         if FakeCollection.matches(doc, spec):
+            FakeCollection.apply(doc, change)
+            matched += 1
+            if not multi:
+               break
+      if matched == 0 and upsert:
+         doc = dict((k, v) for k, v in (spec or {}).items() if not isinstance(v, dict))
+         FakeCollection.apply(doc, change, inserting=True)
+         self.__insert(doc)
+      return FakeResult(matched_count=matched)
+
+
+   @staticmethod
+   def matches(doc, spec):
+      if not spec:
+         return True
+      for key, want in spec.items():
+         have = doc.get(key)
+         if key == '_id':
+            have = str(have)
+            want = str(want) if not isinstance(want, dict) else want
+         if isinstance(want, dict):
+            for op, arg in want.items():
+               if op == '$in' and have not in arg:
+                  return False
+               if op == '$ne' and have == arg:
+                  return False
+               if op == '$gt' and not (have is not None and have > arg):
+                  return False
+               if op == '$gte' and not (have is not None and have >= arg):
+                  return False
+               if op == '$lt' and not (have is not None and have < arg):
+                  return False
+               if op == '$lte' and not (have is not None and have <= arg):
+                  return False
+         elif have != want:
+            return False
+      return True
+
+
+   @staticmethod
+   def project(doc, projection):
+      if not projection:
+         return dict(doc)
+      keep = [k for k, v in projection.items() if v]
+      result = dict((k, doc[k]) for k in keep if k in doc)
+      if projection.get('_id', 1) and '_id' in doc:
+         result['_id'] = doc['_id']
+      return result
+
+
+   @staticmethod
+   def apply(doc, change, inserting=False):
+      for op, fields in change.items():
+         if op == '$set':
+            doc.update(fields)
+         elif op == '$setOnInsert':
+            if inserting:
+               doc.update(fields)
+         elif op == '$inc':
+            for key, delta in fields.items():
+               doc[key] = doc.get(key, 0) + delta
+         elif op == '$max':
+            for key, value in fields.items():
+               if key not in doc or value > doc[key]:
+                  doc[key] = value
+         elif op == '$push':
+            for key, value in fields.items():
+               doc.setdefault(key, []).append(value)
+
+
+class FakeResult:
+
+   def __init__(self, **kwargs):
+      self.__dict__.update(kwargs)
+
+
+class FakeDatabase:
+
+   # Collections are created on first use, by attribute or item access, like
+   # a pymongo Database.
+   def __init__(self):
+      self.collections = {}
+
+   def __getattr__(self, name):
+      if name.startswith('_'):
+         raise AttributeError(name)
+      return self[name]
+
+   def __getitem__(self, name):
+      if name not in self.collections:
+         self.collections[name] = FakeCollection(name)
+      return self.collections[name]
+
+   # Total round trips made to every collection.
+   def round_trips(self):
+      return sum(c.round_trips for c in self.collections.values())
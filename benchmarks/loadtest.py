@@ -0,0 +1,120 @@
+"""
+   End to end load test. Starts a FakeIrcServer with simulated users talking
+   in some channels, connects a real Bot to it over TCP with an echo
+   extension, and reports how many lines the bot got through, whether it
+   kept to the server's flood limits and, if the server is made to drop it,
+   how long it took to reconnect and rejoin.
+
+   Usage: python benchmarks/loadtest.py [--seconds N] [--rate N] [--channels N] [--drop-every N]
+"""
+
+import sys
+import os
+import time
+import select
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.dont_write_bytecode = True
+
+import bot
+import logger
+import fake_server
+
+import extensions.echo as echo
+
+
+# Run the bot's event loop for a while. This is Bot.interact without the
+# console, so it can run unattended.
+def drive(jbot, server, seconds, drop_every):
+   jbot._start_interacting()
+   start = time.monotonic()
+   end = start + seconds
+   next_drop = start + drop_every if drop_every else None
+   reconnects = []
+
+   while time.monotonic() < end:
+      now = time.monotonic()
+      if next_drop is not None and now >= next_drop:
+         server.disconnect_all()
+         next_drop = now + drop_every
+
+      wants_write, timeout = jbot._wait_spec()
+      if timeout is None or timeout > 0.05:
+         timeout = 0.05
+      write_wait = [jbot.sock] if wants_write else []
+      readable, writable, errors = select.select([jbot.sock], write_wait, [], timeout)
+      jbot._run_timers()
+      jbot._flush_sends()
+      if readable and not jbot._on_readable():
+         dropped = time.monotonic()
+         if not jbot.reconnect():
+            break
+         # the rejoin only counts once the server has seen every JOIN
+         while not all(server.join_times.get(chan.lower(), 0) > dropped for chan in jbot.channels):
+            jbot._flush_sends()
+            time.sleep(0.001)
+         reconnects.append(time.monotonic() - dropped)
+
+   return time.monotonic() - start, reconnects
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Load test a bot against a local fake IRC server.')
+   parser.add_argument('--seconds', type=float, default=10)
+   parser.add_argument('--rate', type=float, default=1000, help='simulated messages per second per channel')
+   parser.add_argument('--channels', type=int, default=4)
+   parser.add_argument('--users', type=int, default=200, help='simulated users per channel')
+   parser.add_argument('--traffic', choices=sorted(fake_server.TRAFFIC), default='chatter')
+   parser.add_argument('--drop-every', type=float, default=0, help='seconds between server-side disconnects')
+   parser.add_argument('--send-rate', type=float, default=2.0)
+   parser.add_argument('--send-burst', type=int, default=5)
+   parser.add_argument('--workers', type=int, default=0, help='Bot worker_threads')
+   args = parser.parse_args()
+
+   server = fake_server.FakeIrcServer(settings={'taken_nicks': ['knob']}).start()
+   channels = ['#load%d' % i for i in range(args.channels)]
+
+   jbot = bot.Bot({
+      'message_print_level': bot.Bot.NO_MESSAGES,
+      'logger': logger.Logger(logger.Logger.INFO, []),
+      'send_rate': args.send_rate,
+      'send_burst': args.send_burst,
+      'worker_threads': args.workers,
+      'reconnect_min_delay': 0.05,
+      'reconnect_max_delay': 1,
+      # the server drops the bot on purpose, so don't back off for it
+      'reconnect_stable_time': 0,
+   })
+   jbot.set_extensions([echo.Echo(jbot)])
+   # knob is taken, so this also goes through the 433 handling
+   jbot.connect(server.host, 'knob', server.port)
+   for chan in channels:
+      jbot.join(chan)
+   while len(server.join_times) < len(channels):
+      jbot._flush_sends()
+      time.sleep(0.01)
+
+   for i, chan in enumerate(channels):
+      server.add_simulator(fake_server.Simulator(chan, args.rate, args.users,
+         fake_server.TRAFFIC[args.traffic], seed=i, prefix='sim%d_' % i))
+
+   elapsed, reconnects = drive(jbot, server, args.seconds, args.drop_every)
+   lines_in = jbot.metrics.lines_in
+   stats = server.stats
+   print('%.1fs as %s: bot received %d lines (%.0f/s) of %d simulated, sent %d lines' % (
+      elapsed, jbot.nick, lines_in, lines_in / elapsed, stats['simulated_messages'], jbot.sendq.lines_sent))
+   print('flood control: %d lines throttled by the server, %d excess flood kills, send queue depth %d' % (
+      stats['lines_throttled'], stats['excess_flood_kills'], jbot.sendq.depth))
+   if reconnects:
+      print('reconnects: %d, mean %.3fs, max %.3fs to rejoin %d channels' % (
+         len(reconnects), sum(reconnects) / len(reconnects), max(reconnects), len(channels)))
+
+   jbot._console_command(['quit'])
+   jbot.cleanup()
+   jbot.logger.close()
+   server.stop()
+
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,249 @@
+"""
+   Traffic replay benchmark. Feeds recorded or synthetic IRC traffic through
+   IrcMessage parsing and Bot dispatch into the real extensions, with the
+   network and MongoDB replaced by the in-process fakes in fakes.py, and
+   reports throughput, per-extension latency and allocations per message.
+
+   Usage: python benchmarks/replay.py [scenario ...] [--lines N] [--file PATH] [--allocs]
+   With no scenarios, all of them are run. --file replays raw IRC lines
+   from a log instead.
+"""
+
+import sys
+import os
+import time
+import random
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.dont_write_bytecode = True
+
+import bot
+import logger
+import fakes
+
+import extensions.karma_tracker as karma_tracker
+import extensions.hype as hype
+import extensions.quote_retriever as quote_retriever
+import extensions.quote_recorder as quote_recorder
+import extensions.sundry_commands as sundry_commands
+
+BOT_NICK = 'knob'
+CHANNELS = ['#chan%d' % i for i in range(8)]
+WORDS = ('the quick brown fox jumps over the lazy dog is are what why '
+         'lol ok yes no maybe tomorrow python irc bot karma quote').split()
+
+def nicks(count):
+   return ['user%d' % i for i in range(count)]
+
+def prefix(nick):
+   return ':%s!~%s@host-%d.example.net' % (nick, nick, hash(nick) % 1000)
+
+def chat_line(rng, users):
+   return '%s PRIVMSG %s :%s' % (prefix(rng.choice(users)), rng.choice(CHANNELS),
+      ' '.join(rng.choice(WORDS) for i in range(rng.randint(3, 12))))
+
+
+###
+### Scenarios. Each is a function taking a random generator and a number of
+### lines and returning that many raw lines.
+###
+
+# Joining big channels: JOINs, NAMES replies with long nick lists, and a
+# MOTD, all of which SundryCommands swallows.
+def names_burst(rng, count):
+   users = nicks(5000)
+   lines = []
+   while len(lines) < count:
+      chan = rng.choice(CHANNELS)
+      lines.append('%s JOIN %s' % (prefix(BOT_NICK), chan))
+      for i in range(0, len(users), 50):
+         lines.append(':irc.example.net 353 %s = %s :%s' % (BOT_NICK, chan, ' '.join(users[i:i + 50])))
+      lines.append(':irc.example.net 366 %s %s :End of /NAMES list.' % (BOT_NICK, chan))
+      lines.append(':irc.example.net 375 %s :- irc.example.net Message of the Day -' % BOT_NICK)
+      for i in range(20):
+         lines.append(':irc.example.net 372 %s :- %s' % (BOT_NICK, ' '.join(rng.choice(WORDS) for j in range(10))))
+      lines.append(':irc.example.net 376 %s :End of /MOTD command.' % BOT_NICK)
+   return lines[:count]
+
+# Lots of users handing out several karma changes per line.
+def karma_storm(rng, count):
+   users = nicks(300)
+   lines = []
+   for i in range(count):
+      targets = rng.sample(users, rng.randint(1, 4))
+      mods = ' '.join(t + rng.choice(['++', '++', '--']) for t in targets)
+      if rng.random() < 0.1:
+         text = '!karma %s' % rng.choice(users)
+      else:
+         text = mods
+      lines.append('%s PRIVMSG %s :%s' % (prefix(rng.choice(users)), rng.choice(CHANNELS), text))
+   return lines
+
+# Everyone asking for quotes at once, on top of ordinary chatter.
+def quote_flood(rng, count):
+   users = nicks(200)
+   lines = []
+   for i in range(count):
+      if rng.random() < 0.7:
+         lines.append('%s PRIVMSG %s :!quote' % (prefix(rng.choice(users)), rng.choice(CHANNELS)))
+      else:
+         lines.append(chat_line(rng, users))
+   return lines
+
+# Ordinary conversation, which QuoteRecorder records and a little of which
+# triggers Hype.
+def chatter(rng, count):
+   users = nicks(500)
+   lines = []
+   for i in range(count):
+      roll = rng.random()
+      if roll < 0.05:
+         lines.append('%s PRIVMSG %s :hype' % (prefix(rng.choice(users)), rng.choice(CHANNELS)))
+      elif roll < 0.08:
+         lines.append('PING :irc.example.net')
+      else:
+         lines.append(chat_line(rng, users))
+   return lines
+
+SCENARIOS = {
+   'names_burst': names_burst,
+   'karma_storm': karma_storm,
+   'quote_flood': quote_flood,
+   'chatter': chatter,
+}
+
+
+###
+### Running
+###
+
+# Build a bot with the real extensions on fakes. Nothing is printed, sends
+# are never rate limited, and neither are the extensions' commands and
+# triggers, so only the bot's own work and the extensions' is measured.
+def make_bot():
+   settings = {
+      'message_print_level': bot.Bot.NO_MESSAGES,
+      'logger': logger.Logger(logger.Logger.INFO, []),
+      'send_rate': 1e9,
+      'send_burst': 1e9,
+      'reconnect': False,
+   }
+   jbot = bot.Bot(settings)
+   jbot.sock = fakes.FakeSocket()
+   jbot.nick = BOT_NICK
+
+   db = fakes.FakeDatabase()
+   for i in range(500):
+      db.quotes.insert({'author': 'user%d' % i, 'quote': 'quote number %d' % i, 'index': i})
+   db.quotes.round_trips = 0
+
+   karma_ext = karma_tracker.KarmaTracker(jbot, db, {
+      'prevent_spam': True,
+      'karma_timeout': 5,
+   })
+   extensions = [
+      karma_ext,
+      hype.Hype(jbot),
+      quote_retriever.QuoteRetriever(jbot, db),
+      quote_recorder.QuoteRecorder(jbot, db, True),
+      sundry_commands.SundryCommands(jbot, {}),
+   ]
+   for ext in extensions:
+      ext.rate_limit = None
+      ext.channel_rate_limit = None
+   jbot.set_extensions(extensions)
+   return jbot, db
+
+
+# Wrap every hook in the bot's dispatch index so each call's latency is
+# recorded exactly, rather than in the metrics histogram buckets.
+def time_hooks(jbot):
+   samples = {}
+
+   def timed(name, hook):
+      record = samples.setdefault(name, [])
+      def call(msg):
+         start = time.perf_counter()
+         try:
+            return hook(msg)
+         finally:
+            record.append(time.perf_counter() - start)
+      return call
+
+   for command, entries in jbot.dispatch.items():
+      jbot.dispatch[command] = [(ext, timed(ext.name, hook), stats) for ext, hook, stats in entries]
+   return samples
+
+
+def percentile(values, q):
+   if not values:
+      return 0.0
+   values = sorted(values)
+   return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run(name, lines, measure_allocs):
+   jbot, db = make_bot()
+   samples = time_hooks(jbot)
+   process = jbot._process_line
+
+   start = time.perf_counter()
+   for line in lines:
+      process(line)
+   elapsed = time.perf_counter() - start
+
+   print('%s: %d lines in %.3fs, %.0f lines/s, %d bytes sent, %d db round trips' % (
+      name, len(lines), elapsed, len(lines) / elapsed, jbot.sock.bytes_sent, db.round_trips()))
+   for ext_name, values in sorted(samples.items()):
+      if not values:
+         continue
+      print('   %-18s %8d calls  p50 %8.1fus  p99 %8.1fus' % (
+         ext_name, len(values), 1e6 * percentile(values, 0.5), 1e6 * percentile(values, 0.99)))
+   for ext in jbot.extensions:
+      ext.cleanup()
+
+   if measure_allocs:
+      # a fresh bot without the timing wrappers, traced separately so
+      # tracemalloc's overhead doesn't skew the timings above
+      jbot, db = make_bot()
+      blocks_before = sys.getallocatedblocks()
+      tracemalloc.start()
+      for line in lines:
+         jbot._process_line(line)
+      current, peak = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+      blocks_after = sys.getallocatedblocks()
+      print('   allocations: %.1f blocks retained/msg, %.0f bytes retained/msg, peak %.0f KiB' % (
+         (blocks_after - blocks_before) / len(lines), current / len(lines), peak / 1024))
+      for ext in jbot.extensions:
+         ext.cleanup()
+
+   jbot.logger.close()
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Replay IRC traffic through the bot and its extensions.')
+   parser.add_argument('scenarios', nargs='*', help='scenarios to run: %s' % ', '.join(sorted(SCENARIOS)))
+   parser.add_argument('--lines', type=int, default=20000, help='lines per scenario')
+   parser.add_argument('--file', help='replay raw IRC lines from this file instead')
+   parser.add_argument('--allocs', action='store_true', help='also measure allocations per message')
+   parser.add_argument('--seed', type=int, default=1)
+   args = parser.parse_args()
+
+   if args.file:
+      with open(args.file, encoding='utf-8', errors='replace') as f:
+         lines = [line.rstrip('\r\n') for line in f if line.strip()]
+      run(os.path.basename(args.file), lines, args.allocs)
+      return
+
+   for name in args.scenarios or sorted(SCENARIOS):
+      if name not in SCENARIOS:
+         parser.error('unknown scenario %s' % name)
+      lines = SCENARIOS[name](random.Random(args.seed), args.lines)
+      run(name, lines, args.allocs)
+
+
+if __name__ == '__main__':
+   main()
@@ -4,14 +4,28 @@
 """
 
 import sys
+import os
 import socket
 import select
 import errno
-import traceback
+import threading
+import time
 import random
+import math
+import concurrent.futures
 
 import irc_message
 import extension
+import line_buffer
+import send_queue
+import message_builder
+import triggers
+import scheduler
+import rate_limit
+import circuit_breaker
+import worker_pool
+import metrics
+import logger
 
 # stop creating .pyc files
 sys.dont_write_bytecode = True
@@ -25,10 +39,60 @@ class Bot:
 
    def __init__(self, settings = {}):
       self.sock = None
+      self.reader = None
+      # why the connection failed, if a read or write on it has; see
+      # _on_readable and _flush_sends
+      self.connection_error = None
       self.__init_settings(settings)
+      self.__init_logger(settings)
+      self.sendq = send_queue.SendQueue(self.__sock_write, self.send_rate, self.send_burst,
+         self.__sock_writev if hasattr(socket.socket, 'sendmsg') else None)
+      self.builder = message_builder.MessageBuilder()
+      # While the loop is working through a read, lines are only queued, and
+      # go out together when it is done.
+      self.batching_sends = False
+      # Where and as whom the bot last connected, so it can reconnect, and
+      # the channels it is on, so it can rejoin them. channels is a dict
+      # used as an ordered set.
+      self.server = None
+      self.port = None
+      self.start_nick = None
+      self.ident = None
+      self.realname = None
+      self.channels = {}
+      # when the server last welcomed the bot, and the most the reconnection
+      # attempt that got it back then could have waited; see
+      # _first_reconnect_delay
+      self.welcomed_at = None
+      self.reconnect_delay = 0
+      self.metrics = metrics.Metrics()
+      self.metrics.add_gauge('send_queue_depth', lambda: self.sendq.depth)
+      self.metrics.add_gauge('send_queue_max_wait_seconds', lambda: self.sendq.max_wait)
+      self.metrics.add_gauge('bytes_sent_total', lambda: self.sendq.bytes_sent, 'counter')
+      self.metrics.add_gauge('lines_sent_total', lambda: self.sendq.lines_sent, 'counter')
+      self.metrics.add_gauge('log_records_dropped_total', lambda: self.logger.dropped, 'counter')
       self.extensions = []
-      # TODO: make a setting for "notify level" controlling what gets printed
-      # at different priority levels.
+      # dispatch maps each IRC command to the ordered list of
+      # (extension, hook function, HookStats) tuples interested in it; see
+      # update_dispatch.
+      self.dispatch = {}
+      # Only used when worker_threads is set: the pool dispatching messages,
+      # and the executor running observer extensions.
+      self.workers = None
+      self.observers = None
+      # the CircuitBreaker for each extension, and for each blocking
+      # extension the executor its hooks are called on, so they can be
+      # abandoned if they take too long, with a semaphore counting its calls
+      # in progress; see _guard
+      self.breakers = {}
+      self.detached = {}
+      # maps each extension with rate limits to a tuple of its limits and its
+      # (user, channel) RateLimiters, either of which may be None; see
+      # _rate_limit
+      self.rate_limiters = {}
+      self.send_lock = threading.Lock()
+      # timers set with call_later and call_every, run by the event loop
+      self.scheduler = scheduler.Scheduler(self.__timer_error)
 
       # hooks is a dictionary mapping IRC command strings, 
       # like 'PRIVMSG', 'NICK' or '224', to functions that will be called with
@@ -45,88 +109,246 @@ class Bot:
          '433': self._try_underscore_nick,
          'NOTICE': self._show_notice,
       }
-      # TODO: add hooks for successful channel join, nick (changes self.nick)
 
 
    # Initialize the settings, to defaults if not given.
    def __init_settings(self, settings):
       self.show_say = settings.get('show_say', False)
       self.message_print_level = settings.get('message_print_level', 1)
+      # flood control: lines per second sent once the burst is used up
+      self.send_rate = settings.get('send_rate', 2.0)
+      self.send_burst = settings.get('send_burst', 5)
+      # Number of threads to dispatch messages on. 0 dispatches everything
+      # inline on the main loop. Otherwise messages are partitioned by
+      # conversation, so each channel or query is still handled in order.
+      self.worker_threads = settings.get('worker_threads', 0)
+      # Reconnect when the server drops the connection, instead of returning
+      # from interact. The first attempt is immediate; after that the delay
+      # doubles from reconnect_min_delay up to reconnect_max_delay seconds,
+      # with random jitter. reconnect_attempts of None means never give up.
+      # A connection that drops within reconnect_stable_time seconds of
+      # being welcomed counts as another failed attempt, so the delay only
+      # starts over once one has stayed up that long.
+      self.reconnect_enabled = settings.get('reconnect', True)
+      self.reconnect_min_delay = settings.get('reconnect_min_delay', 1)
+      self.reconnect_max_delay = settings.get('reconnect_max_delay', 300)
+      self.reconnect_attempts = settings.get('reconnect_attempts', None)
+      self.reconnect_stable_time = settings.get('reconnect_stable_time', 60)
+      # Encoding for received text that isn't valid UTF-8; see
+      # irc_message.decode.
+      self.fallback_encoding = settings.get('fallback_encoding', irc_message.FALLBACK_ENCODING)
+      # port for a local HTTP endpoint serving metrics in the Prometheus text
+      # format, or None for no endpoint
+      self.metrics_port = settings.get('metrics_port', None)
+      # Seconds an extension's hook may take, unless the extension sets its
+      # own time_budget; None for no limit. An extension whose hooks fail or
+      # go over budget breaker_threshold times in a row is skipped for
+      # breaker_cooldown seconds, then given one call to show it has
+      # recovered. detached_threads is how many calls to each blocking
+      # extension can be in progress at once, including abandoned ones still
+      # running; while that many are, its calls are skipped and counted as
+      # failures, so one extension whose calls hang can't hold up the others.
+      self.extension_time_budget = settings.get('extension_time_budget', 5.0)
+      self.breaker_threshold = settings.get('breaker_threshold', 5)
+      self.breaker_cooldown = settings.get('breaker_cooldown', 60)
+      self.detached_threads = settings.get('detached_threads', 4)
+      # most users and channels each extension's rate limits keep track of
+      self.rate_limit_keys = settings.get('rate_limit_keys', 10000)
+      # Name of the network the bot is on, which extensions shared by bots on
+      # several networks use to keep them apart. Defaults to the server the
+      # bot connects to.
+      self.network = settings.get('network', None)
+
+
+   # Set up where the bot's output goes. A Logger passed in the logger
+   # setting (for instance one shared by several bots) is used as it is;
+   # otherwise the bot makes its own, writing to stdout and, if log_file is
+   # set, to a file rotated once it grows past log_max_bytes.
+   def __init_logger(self, settings):
+      self.owns_logger = 'logger' not in settings
+      if not self.owns_logger:
+         self.logger = settings['logger']
+         return
+      sinks = [logger.StreamSink()]
+      log_file = settings.get('log_file', None)
+      if log_file is not None:
+         sinks.append(logger.RotatingFileSink(log_file,
+            settings.get('log_max_bytes', 10 * 1024 * 1024),
+            settings.get('log_backups', 5)))
+      self.logger = logger.Logger(self.message_print_level, sinks,
+         settings.get('log_queue_size', 10000))
 
 
    # Send a string to the IRC server over the socket. This just removes the
    # boilerplate \r\n on everything.
-   def __socksend(self, line):
-      self.sock.sendall((line + '\r\n').encode('utf-8'))
+   # The line goes through the send queue, so it may go out later if the bot
+   # has been talking too much; target is the channel or nick it is addressed
+   # to, used to share the send rate fairly. Never blocks.
+   def _socksend(self, line, target=None, priority=None):
+      self._send_data((line + '\r\n').encode('utf-8'), target, priority)
+
+
+   # Queue an encoded line, including its \r\n, and send it unless the loop
+   # is in the middle of a read and will send everything at the end of it.
+   # Subclasses with a different transport (see AsyncBot) override this.
+   def _send_data(self, data, target=None, priority=None):
+      with self.send_lock:
+         self.sendq.put(data, target, priority)
+         if not self.batching_sends:
+            self.__flush()
+
 
+   # Non-blocking writes to the socket, used by the send queue.
+   def __sock_write(self, data):
+      return self.sock.send(data, Bot.SEND_FLAGS)
 
-   # Get a line from the IRC server. Raises an EOFError if the connection is closed for some reason,
+   def __sock_writev(self, buffers):
+      return self.sock.sendmsg(buffers, (), Bot.SEND_FLAGS)
+
+
+   # Get a line from the IRC server, as bytes. Raises an EOFError if the connection is closed for some reason,
    # and also takes care of the \r\n on the end of every line.
+   # Lines already buffered by an earlier read are returned without touching the socket.
    def __get_line(self):
-      data = bytearray()
-      c = ''
-      while c != b'\n':
-         c = self.sock.recv(1)
-         data += c
-      if not data:
-         raise EOFError('Connection closed unexpectedly')
-
-      data = str(data, 'utf-8')
-      return data.rstrip('\r\n')
+      return self.reader.get_line()
 
 
    # Open connection to an IRC server.
    # This has a while loop parsing commands, but it will exit 
    # once it is alerted to the connection message.
-   # This isn't expected to be able to be on multiple servers at once.
+   # A bot is a single connection; use a NetworkLoop to run bots on
+   # several servers at once.
    # May be called before or after setting hooks.
    def connect(self, server, nick, port=6667, ident="x", realname="x"):
+      self.server = server
+      self.port = port
+      self.start_nick = nick
+      self.ident = ident
+      self.realname = realname
+      if self.network is None:
+         self.network = server
+
       self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
       try:
          self.sock.connect((server, port))
       except socket.error as serr:
          if serr.errno == errno.ECONNREFUSED:
-            print('Connection error: Connection refused by server')
+            self.log('Connection error: Connection refused by server')
          elif serr.errno == errno.ENOEXEC:
-            print(variables.server, "connection error: Exec format error (maybe the server you specified doesn't exist, or you have a problem connecting to the Internet)")
+            self.log(server, "connection error: Exec format error (maybe the server you specified doesn't exist, or you have a problem connecting to the Internet)")
          else:
-            print(variables.server,'connection error:',errno.errcode[serr.errno])
+            self.log(server, 'connection error:', errno.errorcode.get(serr.errno, serr))
+         self.sock.close()
          raise serr
 
-      self.__socksend('USER %s %s %s :%s' % (ident, server, server, realname))
-      self.__socksend('NICK %s' % nick)
+      self._register()
 
       command = ""
       # wait for 001 (successful connection to the server)
       while command != "001":
+         # a line too long for the reader raises a ValueError, which is
+         # passed on like a closed connection rather than read past
          try:
             line = self.__get_line()
-            msg = irc_message.IrcMessage(line)
          except EOFError as e:
-            print('Connection closed while waiting for 001')
+            self.log('Connection closed while waiting for 001')
             raise e
+         try:
+            msg = irc_message.IrcMessage(line, self.fallback_encoding)
          except ValueError as e:
-            print('Problem parsing received line: %s' % e)
+            self.log('Problem parsing received line: %s' % e)
+            continue
 
          command = msg.command
-         if command == '001':
-            print('Connection succeeded')
-            self.nick = msg.params[0]
-         elif command in self.pre_welcome_hooks:
-            self.pre_welcome_hooks[command](msg)
-         else:
-            print('Unknown IRC command:', msg)
+         self._pre_welcome(msg)
+
+
+   # Start reading from a newly connected socket, and register with the
+   # server as the nick connect was last given.
+   def _register(self):
+      self.reader = line_buffer.LineBuffer(self.sock)
+      self.connection_error = None
+      # anything left over from a previous connection is dropped
+      with self.send_lock:
+         self.sendq.clear()
+      # registration goes out ahead of everything else
+      self._socksend('USER %s %s %s :%s' % (self.ident, self.server, self.server, self.realname), priority=send_queue.SendQueue.HIGH)
+      self._socksend('NICK %s' % self.start_nick, priority=send_queue.SendQueue.HIGH)
+
+
+   # Start connecting to the server again without waiting for the
+   # connection, for event loops driving several bots (see NetworkLoop).
+   # Returns the new socket, which becomes writable once the connection is
+   # made or has failed; _finish_connect should be called then. Looking up
+   # the server's address may still block.
+   def _start_connect(self):
+      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      try:
+         sock.setblocking(False)
+         err = sock.connect_ex((self.server, self.port))
+         if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise OSError(err, os.strerror(err))
+      except OSError:
+         sock.close()
+         raise
+      self.sock = sock
+      return sock
+
+
+   # Finish a connection started by _start_connect, raising an OSError if it
+   # failed, and register with the server. What the server sends after that
+   # should be read with _read_welcome until it welcomes the bot.
+   def _finish_connect(self):
+      err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+      if err != 0:
+         raise OSError(err, os.strerror(err))
+      self.sock.setblocking(True)
+      self._register()
+
+
+   # Called when the socket is readable while waiting for the server to
+   # welcome the bot. Does a single read and handles what it got the way
+   # connect does. Returns True once the welcome has arrived, leaving any
+   # lines after it buffered. Raises an EOFError if the server closed the
+   # connection, and like LineBuffer.fill an OSError if it failed or a
+   # ValueError if the server sent a line too long to buffer.
+   def _read_welcome(self):
+      if self.reader.fill() == 0:
+         raise EOFError('Connection closed while waiting for 001')
+      while self.reader.has_line():
+         try:
+            msg = irc_message.IrcMessage(self.reader.get_line(), self.fallback_encoding)
+         except ValueError as e:
+            self.log('Problem parsing received line: %s' % e)
+            continue
+         self._pre_welcome(msg)
+         if msg.command == '001':
+            return True
+      return False
+
+
+   # Handle a message received before the connection is established.
+   def _pre_welcome(self, msg):
+      command = msg.command
+      if command == '001':
+         self.log('Connection succeeded')
+         self.nick = msg.params[0]
+         self.welcomed_at = time.monotonic()
+      elif command in self.pre_welcome_hooks:
+         self.pre_welcome_hooks[command](msg)
+      else:
+         self.log('Unknown IRC command:', msg)
 
 
    # Attempts to join a channel.
    # TODO: allow this to take a list of channels
    def join(self, channelName):
       if len(channelName) < 1:
-         print('Warning: tried to call join with an empty channel name, ignoring')
+         self.log('Warning: tried to call join with an empty channel name, ignoring')
          return
       if channelName[0] != '#':
          channelName = '#' + channelName
-      self.__socksend('JOIN '+channelName)
+      self._socksend('JOIN '+channelName)
 
 
    # Add a new hook. This assigns a function to a certain type of command.
@@ -141,115 +363,688 @@ class Bot:
       # This can cause a feedback loop where it keeps resending
       # messages which will eventually get it kicked for flooding.
       if self.show_say:
-         print('Saying', msg_str, 'to', recipient)
+         self.log('Saying', msg_str, 'to', recipient)
       if recipient == self.nick:
-         print('Warning: bot tried to send a message to itself')
+         self.log('Warning: bot tried to send a message to itself')
          return
-      self.__socksend('PRIVMSG %s :%s' % (recipient, msg_str))
+      for data in self.builder.privmsg(recipient, msg_str):
+         self._send_data(data, recipient)
 
 
    # Interacts with the IRC server. This will start a loop that will not exit until the bot is
    # terminated manually or the server closes the connection. Inside the loop, the bot will
    # read and interpret commands according to its hooks.
    def interact(self):
+      self._start_interacting()
       while True:
-         read_socks, write_socks, err_socks = select.select([sys.stdin, self.sock], [], [])
+         wants_write, timeout = self._wait_spec()
+         write_wait = [self.sock] if wants_write else []
+         read_socks, write_socks, err_socks = select.select([sys.stdin, self.sock], write_wait, [], timeout)
+         self._run_timers()
+         connected = self._flush_sends()
 
          for sock in read_socks:
+            if not connected:
+               break
             if sock == sys.stdin:
                user_input = sys.stdin.readline().rstrip('\n').split()
-               cmd = user_input[0].lower()
-               if cmd == 'quit':
-                  self.__socksend('QUIT :' + ' '.join(user_input[1:]))
+               if not self._console_command(user_input):
                   return
 
-               elif cmd == 'tell':
-                  if len(user_input) < 3:
-                     print('Too few arguments to tell')
-                  else:
-                     self.say(' '.join(user_input[2:]), user_input[1])
+            elif sock == self.sock:
+               connected = self._on_readable()
 
-               elif cmd == 'join':
-                  if len(user_input) < 2:
-                     print('Too few arguments to join')
-                  else:
-                     self.join(user_input[1])
+         if not connected:
+            self._log_connection_lost()
+            if not (self.reconnect_enabled and self.reconnect()):
+               return
 
 
-            elif sock == self.sock:
-               # first get and parse the message
-               try:
-                  msg = irc_message.IrcMessage(self.__get_line())
-               except EOFError:
-                  print('Connection closed unexpectedly')
-                  return
-               except ValueError as e:
-                  print('Problem parsing received line: %s' % e)
-
-               # then run it through the list of extensions
-               halt = False
-               handled = False
-               for ext in self.extensions:
-                  try:
-                     retn = ext.act(msg)
-                     if retn == True:
-                        halt = True
-                        handled = True
-                        break
-                     if retn == False:
-                        handled = True
-                     # if retn is anything else, set neither halt nor handled
-
-                  except Exception as e:
-                     print('Exception triggered from message:', msg)
-                     print('in extension', ext.name)
-                     print(e)
-                     traceback.print_exc()
-
-               # if no extension told it to terminate parsing, try
-               # calling the hook for it if there is one.
-               # This counts as handling and halting the message.
-               # For this reason, the default hooks list should be kept minimal.
-               if not halt:
-                  if msg.command in self.hooks:
-                     halt = True
-                     handled = True
-                     try:
-                        self.hooks[msg.command](msg)
-                     except Exception as e:
-                        print('Exception triggered from message:', msg)
-                        print('in hook', msg.command)
-                        print(e)
-                        traceback.print_exc()
-
-               # based on halt and handle and message_print_level,
-               # determine whether to print it
-               if halt:
-                  if self.message_print_level >= Bot.ALL_MESSAGES:
-                     print('IRC message received (was handled and halted):')
-                     msg.print()
-               elif handled:
-                  if self.message_print_level >= Bot.FALL_THROUGH_MESSAGES:
-                     print('IRC message recieved (was handled but fell through):')
-                     msg.print()
-               else:
-                  if self.message_print_level >= Bot.UNHANDLED_MESSAGES:
-                     print('IRC message received (not caught by any extension or hook):')
-                     msg.print()
+   # Reconnect to the server after the connection has dropped, rejoining the
+   # channels the bot was on. Extensions stay as they are, so their state
+   # survives; their on_disconnect and on_reconnect methods are called around
+   # the reconnection. Returns True once reconnected, or False if the bot ran
+   # out of attempts.
+   # This waits for the server, so it is only for a loop driving this bot
+   # alone; NetworkLoop reconnects its bots in the background.
+   def reconnect(self):
+      self._disconnected()
+
+      attempt = 0
+      delay = self._first_reconnect_delay()
+      while self._may_reconnect(attempt):
+         attempt += 1
+         if delay > 0:
+            time.sleep(self._reconnect_wait(delay))
+         self.log('Reconnecting to %s (attempt %d)' % (self.server, attempt))
+         try:
+            self.connect(self.server, self.start_nick, self.port, self.ident, self.realname)
+         except (OSError, EOFError, ValueError) as e:
+            self.log('Reconnect failed:', e)
+            self.sock.close()
+            delay = self._next_reconnect_delay(delay)
+            continue
+
+         self.reconnect_delay = delay
+         self._reconnected()
+         return True
+
+      self.log('Giving up on reconnecting to', self.server)
+      return False
+
+
+   # Log that the connection dropped, and why if it failed rather than being
+   # closed by the server. name is what to call the network, if anything.
+   def _log_connection_lost(self, name=None):
+      where = '' if name is None else ' to %s' % name
+      if self.connection_error is None:
+         self.log('Connection%s closed unexpectedly' % where)
+      else:
+         self.log('Connection%s lost: %s' % (where, self.connection_error))
+
+
+   # Close the connection that dropped, and tell the extensions.
+   def _disconnected(self):
+      self.sock.close()
+      self._notify_extensions('on_disconnect')
+
+
+   # Pick up where the bot left off once the server has welcomed it again.
+   def _reconnected(self):
+      self._rejoin()
+      self._notify_extensions('on_reconnect')
+      # connect may have read past the welcome message
+      self.__process_buffered()
+
+
+   # The most the first reconnection attempt may wait once the connection
+   # has dropped: nothing if it had stayed up for reconnect_stable_time,
+   # and otherwise the next step of backoff from the attempt that got it,
+   # so a server that welcomes the bot and then drops it straight away
+   # isn't reconnected to over and over without a pause. Loops reconnecting
+   # the bot store the delay of the attempt that succeeds in
+   # reconnect_delay.
+   def _first_reconnect_delay(self):
+      if self.welcomed_at is not None and time.monotonic() - self.welcomed_at >= self.reconnect_stable_time:
+         return 0
+      return self._next_reconnect_delay(self.reconnect_delay)
+
+
+   # Whether to make another reconnection attempt after attempt of them.
+   def _may_reconnect(self, attempt):
+      return self.reconnect_attempts is None or attempt < self.reconnect_attempts
+
+
+   # The most the next reconnection attempt may wait, after one that could
+   # wait up to delay seconds has failed (0 for the first attempt).
+   def _next_reconnect_delay(self, delay):
+      return min(self.reconnect_max_delay, max(self.reconnect_min_delay, delay * 2))
+
+
+   # How long to wait before a reconnection attempt that may wait up to delay
+   # seconds. Full jitter, so many bots dropped by one netsplit don't all
+   # come back at the same moment.
+   def _reconnect_wait(self, delay):
+      wait = random.uniform(0, delay)
+      self.log('Reconnecting in %.1f seconds' % wait)
+      return wait
+
+
+   # Rejoin every channel the bot was on, using as few JOIN lines as the
+   # line length limit allows.
+   def _rejoin(self):
+      channels = list(self.channels)
+      self.channels = {}
+      line = ''
+      for chan in channels:
+         if line and len(line) + len(chan) + 1 > Bot.MAX_JOIN_LENGTH:
+            self._socksend('JOIN ' + line)
+            line = ''
+         line = chan if not line else line + ',' + chan
+      if line:
+         self._socksend('JOIN ' + line)
+
+
+   # Call a connection event method on every extension, as the current bot.
+   def _notify_extensions(self, method):
+      token = extension.dispatching.set(self)
+      try:
+         for ext in self.extensions:
+            try:
+               getattr(ext, method)()
+            except Exception:
+               self.logger.exception('Exception in', method, 'of extension', ext.name)
+      finally:
+         extension.dispatching.reset(token)
+
+
+   # Keep track of the bot's own nick and the channels it is on, from
+   # messages about the bot itself.
+   def _track_session(self, msg):
+      command = msg.command
+      if command not in Bot.SESSION_COMMANDS:
+         return
+      if command == 'KICK':
+         if len(msg.params) > 1 and msg.params[1] == self.nick:
+            self.channels.pop(msg.params[0], None)
+         return
+      if msg.getSender() != self.nick:
+         return
+      if command == 'JOIN':
+         chan = msg.params[0] if msg.params else msg.trail
+         self.channels[chan] = True
+      elif command == 'PART':
+         if msg.params:
+            self.channels.pop(msg.params[0], None)
+      elif command == 'NICK':
+         self.nick = msg.params[0] if msg.params else msg.trail
+
+
+   # Get ready to process messages once connected. Event loops driving the bot
+   # call this before anything else.
+   def _start_interacting(self):
+      if self.metrics_port is not None and self.metrics.server is None:
+         self.metrics.serve(self.metrics_port)
+      if self.worker_threads > 0 and self.workers is None:
+         self.workers = worker_pool.WorkerPool(self.worker_threads, self._dispatch_message, 'dispatch', self.__worker_error)
+         self.observers = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.worker_threads,
+            thread_name_prefix='observer')
+      # connect may have read past the welcome message
+      self.__process_buffered()
+
+
+   # What the bot needs to wait for before its next step, as a tuple of
+   # whether to wait for the socket to become writable, and the longest time
+   # to wait (None for no limit).
+   def _wait_spec(self):
+      # wake up for the next timer in any case, and besides that when the
+      # socket can take more data if the last flush filled it, or when the
+      # send queue earns its next token
+      timers = self.scheduler.delay()
+      if self.sendq.blocked():
+         return (True, timers)
+      timeout = self.sendq.delay()
+      if timers is not None and (timeout is None or timers < timeout):
+         timeout = timers
+      if self.workers is not None:
+         # workers may queue lines at any time, so check back regularly
+         if timeout is None or timeout > Bot.WORKER_POLL_INTERVAL:
+            timeout = Bot.WORKER_POLL_INTERVAL
+      return (False, timeout)
+
+
+   # Called when the socket is readable. Does a single read, then works
+   # through every complete line it produced. Returns False if the server
+   # closed the connection, or if it failed: reading or writing it raised
+   # an OSError (a reset, say), or the server sent a line too long to
+   # buffer. Either way the bot should reconnect.
+   def _on_readable(self):
+      try:
+         nbytes = self.reader.fill()
+      except (OSError, ValueError) as e:
+         self.connection_error = e
+         return False
+      self.metrics.bytes_in += nbytes
+      eof = (nbytes == 0)
+      self.__process_buffered()
+      return not eof and self.connection_error is None
+
+
+   # Run the timers that are due. Event loops driving the bot call this every
+   # time they wake up.
+   def _run_timers(self):
+      token = extension.dispatching.set(self)
+      try:
+         self.scheduler.run_due()
+      finally:
+         extension.dispatching.reset(token)
+
+
+   def __timer_error(self, handle, e):
+      self.logger.exception('Exception in timer', getattr(handle.fn, '__qualname__', handle.fn))
+
+
+   def __worker_error(self, msg, e):
+      self.logger.exception('Exception in worker thread dispatching message:', msg)
+
+
+   # Call fn(*args) once, delay seconds from now, from the bot's event loop.
+   # Returns a handle with a cancel method. Timers are cheap, so there is no
+   # need to batch them or to start a thread to wait.
+   def call_later(self, delay, fn, *args):
+      return self.scheduler.call_later(delay, fn, *args)
+
+
+   # Call fn(*args) every interval seconds from the bot's event loop, until
+   # the handle returned is cancelled.
+   def call_every(self, interval, fn, *args):
+      return self.scheduler.call_every(interval, fn, *args)
+
+
+   # Send whatever the send queue allows right now. Returns False if the
+   # connection has failed.
+   def _flush_sends(self):
+      with self.send_lock:
+         self.__flush()
+      return self.connection_error is None
+
+
+   # Flush the send queue, with send_lock held. A write failing means the
+   # connection is gone, which is kept for the loop to find and reconnect,
+   # rather than raised to whatever was sending (often an extension).
+   def __flush(self):
+      try:
+         self.sendq.flush()
+      except OSError as e:
+         if self.connection_error is None:
+            self.connection_error = e
+
+
+   # Process every complete line the reader has already received, parsing
+   # them as one batch. Replies are sent together once all of them have been
+   # handled.
+   def __process_buffered(self):
+      if not self.reader.has_line():
+         return
+      lines = self.reader.get_lines()
+      self.metrics.record_line(len(lines))
+      with self.send_lock:
+         self.batching_sends = True
+      try:
+         for msg in irc_message.parse_lines(lines, on_error=self.__parse_error,
+                                            fallback_encoding=self.fallback_encoding):
+            self._process_message(msg)
+      finally:
+         with self.send_lock:
+            self.batching_sends = False
+            self.__flush()
+
+
+   def __parse_error(self, line, e):
+      self.log('Problem parsing received line: %s' % e)
+
+
+   # Run a command typed by the user on the console, already split into words.
+   # Returns False if the bot should stop interacting.
+   def _console_command(self, user_input):
+      if len(user_input) < 1:
+         return True
+      cmd = user_input[0].lower()
+      if cmd == 'quit':
+         self._socksend('QUIT :' + ' '.join(user_input[1:]), priority=send_queue.SendQueue.HIGH)
+         return False
+
+      elif cmd == 'tell':
+         if len(user_input) < 3:
+            self.log('Too few arguments to tell')
+         else:
+            self.say(' '.join(user_input[2:]), user_input[1])
+
+      elif cmd == 'join':
+         if len(user_input) < 2:
+            self.log('Too few arguments to join')
+         else:
+            self.join(user_input[1])
+
+      elif cmd == 'stats':
+         self.log(self.metrics.report())
+
+      elif cmd == 'breakers':
+         for ext in self.extensions:
+            self.log(self._breaker(ext).status())
+
+      return True
+
+
+   # Parse a single line from the server and run it through the extensions
+   # and hooks.
+   def _process_line(self, line):
+      self.metrics.record_line()
+      # first get and parse the message
+      try:
+         msg = irc_message.IrcMessage(line, self.fallback_encoding)
+      except ValueError as e:
+         self.log('Problem parsing received line: %s' % e)
+         return
+      self._process_message(msg)
+
+
+   # Run a parsed message through the extensions and hooks, or hand it to the
+   # workers.
+   def _process_message(self, msg):
+      self._track_session(msg)
+      if self.workers is not None:
+         self.workers.submit(self._conversation_key(msg), msg)
+      else:
+         self._dispatch_message(msg)
+
+
+   # The key messages are partitioned on when they are processed concurrently:
+   # the channel, or the other nick for private messages. Messages with the
+   # same key are always processed in order.
+   def _conversation_key(self, msg):
+      key = msg.params[0] if msg.params else ''
+      if key == self.nick:
+         key = msg.getSender()
+      return key
+
+
+   # Run a message through the extensions that hook its command, then the
+   # bot's own hooks.
+   def _dispatch_message(self, msg):
+      token = extension.dispatching.set(self)
+      try:
+         self.__dispatch_message(msg)
+      finally:
+         extension.dispatching.reset(token)
+
+
+   def __dispatch_message(self, msg):
+      halt = False
+      handled = False
+      for ext, hook, stats in self.dispatch.get(msg.command, ()):
+         if ext.role == extension.Extension.OBSERVER and self.observers is not None:
+            # Observers never halt, so nothing after them has to wait for
+            # them to finish.
+            self.observers.submit(self.__run_observer, ext, hook, stats, msg)
+            handled = True
+            continue
+         start = time.perf_counter()
+         try:
+            retn = hook(msg)
+            self.metrics.record(stats, retn, time.perf_counter() - start)
+            if retn == True:
+               halt = True
+               handled = True
+               break
+            if retn == False:
+               handled = True
+            # if retn is anything else, set neither halt nor handled
+
+         except Exception:
+            self.metrics.record(stats, None, time.perf_counter() - start, True)
+            self.logger.exception('Exception triggered from message:', msg, '\nin extension', ext.name)
+
+      # if no extension told it to terminate parsing, try
+      # calling the hook for it if there is one.
+      # This counts as handling and halting the message.
+      # For this reason, the default hooks list should be kept minimal.
+      if not halt:
+         if msg.command in self.hooks:
+            halt = True
+            handled = True
+            stats = self.metrics.hook_stats(Bot.HOOK_STATS_NAME, msg.command)
+            start = time.perf_counter()
+            try:
+               self.hooks[msg.command](msg)
+               self.metrics.record(stats, True, time.perf_counter() - start)
+            except Exception:
+               self.metrics.record(stats, None, time.perf_counter() - start, True)
+               self.logger.exception('Exception triggered from message:', msg, '\nin hook', msg.command)
+
+      self._report_message(msg, halt, handled)
+
+
+   # Call an observer extension's hook on the observer executor.
+   def __run_observer(self, ext, hook, stats, msg):
+      token = extension.dispatching.set(self)
+      start = time.perf_counter()
+      try:
+         retn = hook(msg)
+         self.metrics.record(stats, retn, time.perf_counter() - start)
+      except Exception:
+         self.metrics.record(stats, None, time.perf_counter() - start, True)
+         self.logger.exception('Exception triggered from message:', msg, '\nin extension', ext.name)
+      finally:
+         extension.dispatching.reset(token)
+
+
+   # Based on halt and handle and message_print_level,
+   # determine whether to print a message that has been dispatched.
+   def _report_message(self, msg, halt, handled):
+      if halt:
+         self.logger.message(Bot.ALL_MESSAGES,
+            'IRC message received (was handled and halted):', msg)
+      elif handled:
+         self.logger.message(Bot.FALL_THROUGH_MESSAGES,
+            'IRC message recieved (was handled but fell through):', msg)
+      else:
+         self.logger.message(Bot.UNHANDLED_MESSAGES,
+            'IRC message received (not caught by any extension or hook):', msg)
+
+
+   # Write bot output, like print, through the bot's logger.
+   def log(self, *args):
+      self.logger.log(logger.Logger.INFO, *args)
 
 
    # The destructor for the bot. Closes connections and calls all
-   # extensions' cleanup methods.
+   # extensions' cleanup methods. Extensions shared with other bots are only
+   # cleaned up by the last bot using them.
    def cleanup(self):
+      if self.workers is not None:
+         self.workers.shutdown()
+         self.observers.shutdown(wait=True)
+         self.workers = None
+         self.observers = None
+      # give anything still queued (usually the QUIT) one last chance, unless
+      # the connection is already gone
+      self._flush_sends()
       self.sock.close()
-      print('Connection closed successfully.')
+      self.metrics.shutdown()
+      # don't wait for any calls that were abandoned
+      self._shutdown_detached()
+      self.log('Connection closed successfully.')
       for ext in self.extensions:
-         ext.cleanup()
+         ext.detach(self)
+         if not ext.bots:
+            ext.cleanup()
+      if self.owns_logger:
+         self.logger.close()
 
 
    # Sets the bot's internal list of extensions.
+   # The same extension instance may be given to several bots (see
+   # NetworkLoop), in which case it replies through whichever bot received
+   # the message it is handling.
    def set_extensions(self, extensions):
+      for ext in self.extensions:
+         if ext not in extensions:
+            ext.detach(self)
       self.extensions = extensions
+      for ext in extensions:
+         ext.attach(self)
+      self.update_dispatch()
+
+
+   # Rebuild the dispatch index from the extensions' hooks, so each message
+   # only visits the extensions that hook its command, still in the order of
+   # the extensions list. Extension.add_hook and remove_hook call this; it must
+   # be called by hand if an extension's hooks dictionary is changed directly.
+   # Extensions' declared commands and triggers are compiled together here
+   # too, into a PRIVMSG hook for each extension that has any.
+   def update_dispatch(self):
+      dispatch = {}
+      registry = triggers.TriggerRegistry(self.extensions, self._guard_hook)
+      for ext in self.extensions:
+         if ext.commands or ext.triggers:
+            stats = self.metrics.hook_stats(ext.name, 'PRIVMSG')
+            hook = self._trigger_hook(registry, ext)
+            dispatch.setdefault('PRIVMSG', []).append((ext, hook, stats))
+         for command, hook in ext.hooks.items():
+            if command not in dispatch:
+               dispatch[command] = []
+            stats = self.metrics.hook_stats(ext.name, command)
+            dispatch[command].append((ext, self._guard_hook(ext, hook), stats))
+      # swapped in whole, so a message being dispatched is never affected
+      self.dispatch = dispatch
+
+
+   # Make the PRIVMSG hook running an extension's commands and triggers,
+   # each wrapped by _guard_hook.
+   def _trigger_hook(self, registry, ext):
+      return registry.hook(ext, self._rate_limit(ext))
+
+
+   # Get the CircuitBreaker for an extension, creating it if needed.
+   def _breaker(self, ext):
+      breaker = self.breakers.get(ext)
+      if breaker is None:
+         breaker = circuit_breaker.CircuitBreaker(ext.name, self.breaker_threshold, self.breaker_cooldown)
+         self.breakers[ext] = breaker
+      return breaker
+
+
+   # Return a function saying whether a message may set off an extension's
+   # commands and triggers, according to its rate limits, or None if it has
+   # none.
+   def _rate_limit(self, ext):
+      if ext.rate_limit is None and ext.channel_rate_limit is None:
+         self.rate_limiters.pop(ext, None)
+         return None
+      limits = (ext.rate_limit, ext.channel_rate_limit)
+      # keep what the limiters know across updates, unless the limits changed
+      known = self.rate_limiters.get(ext)
+      if known is None or known[0] != limits:
+         known = (limits, tuple(None if limit is None else
+            rate_limit.RateLimiter(*limit, max_keys=self.rate_limit_keys) for limit in limits))
+         self.rate_limiters[ext] = known
+      user_limiter, channel_limiter = known[1]
+
+      def allow(msg):
+         nick = msg.getSender()
+         channel = msg.params[0] if msg.params else ''
+         if channel == self.nick:
+            channel = nick
+         if user_limiter is not None:
+            wait, first = user_limiter.check((nick, channel))
+            if wait:
+               if first:
+                  self.__refuse(ext, nick, channel, wait)
+               return False
+         if channel_limiter is not None:
+            wait, first = channel_limiter.check(channel)
+            if wait:
+               if first:
+                  self.__refuse(ext, nick, channel, wait)
+               return False
+         return True
+
+      return allow
+
+
+   # Tell a user they've hit a rate limit, if the extension says to.
+   def __refuse(self, ext, nick, channel, wait):
+      wait = math.ceil(wait)
+      seconds = '%d second%s' % (wait, '' if wait == 1 else 's')
+      if ext.rate_limit_response == extension.Extension.REPLY_ONCE:
+         self.say('%s: slow down, try again in %s' % (nick, seconds), channel)
+      elif ext.rate_limit_response == extension.Extension.NOTIFY:
+         self.say('Slow down, %s will listen again in %s' % (ext.name, seconds), nick)
+
+
+   # The time budget for an extension's calls, or None for no limit.
+   def _time_budget(self, ext):
+      if ext.time_budget is not None:
+         return ext.time_budget
+      return self.extension_time_budget
+
+
+   # Wrap a hook or trigger handler of an extension so it is skipped while
+   # the extension's breaker is open, and so failures and calls over the time
+   # budget are counted against the breaker. A blocking extension's function
+   # is called on one of its own detached threads, and if it hasn't returned
+   # once the budget is spent it is left to finish on its own while the bot
+   # goes on; if all of the extension's threads are still busy, the call is
+   # skipped straight away. A skipped or abandoned call returns None, so it
+   # neither handles nor halts the message. Exceptions are still raised to
+   # the caller.
+   def _guard(self, ext, fn):
+      breaker = self._breaker(ext)
+      budget = self._time_budget(ext)
+      detach = ext.blocking and budget is not None
+      if detach:
+         executor, slots = self._detached(ext)
+
+      def guarded(msg):
+         if not breaker.allow():
+            return None
+         start = time.perf_counter()
+         try:
+            if detach:
+               if not slots.acquire(blocking=False):
+                  self._breaker_failed(breaker, 'has %d calls still running' % self.detached_threads)
+                  return None
+               future = executor.submit(self._run_detached, slots, fn, msg)
+               try:
+                  retn = future.result(budget)
+               except concurrent.futures.TimeoutError:
+                  if future.cancel():
+                     # it never started, so its slot is still taken
+                     slots.release()
+                  self._breaker_failed(breaker, 'abandoned after %.1fs' % budget)
+                  return None
+            else:
+               retn = fn(msg)
+         except Exception as e:
+            self._breaker_failed(breaker, 'raised %s' % type(e).__name__)
+            raise
+         elapsed = time.perf_counter() - start
+         if budget is not None and elapsed > budget:
+            self._breaker_failed(breaker, 'took %.1fs, over its %.1fs budget' % (elapsed, budget))
+         elif breaker.succeeded():
+            self.log('%s is working again' % ext.name)
+         return retn
+
+      return guarded
+
+
+   # Wrap an extension's hook, command or trigger handler for the dispatch
+   # index; see _guard.
+   def _guard_hook(self, ext, hook):
+      return self._guard(ext, hook)
+
+
+   # Get the executor a blocking extension's calls are made on, and the
+   # semaphore with a slot for each of its calls in progress, creating them
+   # if needed. The executor has a thread for every slot, so a call that
+   # gets a slot never waits for a thread.
+   def _detached(self, ext):
+      detached = self.detached.get(ext)
+      if detached is None:
+         detached = (
+            concurrent.futures.ThreadPoolExecutor(
+               max_workers=self.detached_threads,
+               thread_name_prefix='detached'),
+            threading.BoundedSemaphore(self.detached_threads))
+         self.detached[ext] = detached
+      return detached
+
+
+   # Call an extension's function on one of its detached threads, giving up
+   # its slot once it returns, however long that takes.
+   def _run_detached(self, slots, fn, msg):
+      token = extension.dispatching.set(self)
+      try:
+         return fn(msg)
+      finally:
+         extension.dispatching.reset(token)
+         slots.release()
+
+
+   # Stop every blocking extension's executor, without waiting for calls
+   # that were abandoned.
+   def _shutdown_detached(self):
+      for executor, slots in self.detached.values():
+         executor.shutdown(wait=False, cancel_futures=True)
+      self.detached = {}
+
+
+   # Count a failure against a breaker, and say so if that tripped it.
+   def _breaker_failed(self, breaker, reason):
+      if breaker.failed(reason):
+         self.log('%s %s; skipping it for %ss' % (breaker.name, reason, breaker.cooldown))
 
 
    ### 
@@ -263,11 +1058,11 @@ class Bot:
 
    # Send a PONG to the server.
    def _pong(self, msg):
-      self.__socksend('PONG :Pong')
+      self._socksend('PONG :Pong', priority=send_queue.SendQueue.HIGH)
 
    # Show a NOTICE sent by the server.
    def _show_notice(self, msg):
-      print('NOTICE', msg.trail)
+      self.log('NOTICE', msg.trail)
 
    # Take an erroneous nick returned by the server and attempt to
    # send a NICK that is the same, with all nonalphabetic characters removed.
@@ -286,18 +1081,18 @@ class Bot:
       else:
          attempt = ''.join([i for i in bad_nick if i.isalpha()])
 
-      print('Bad nick', bad_nick)
-      print('Trying', attempt)
-      self.__socksend('NICK %s' % (attempt))
+      self.log('Bad nick', bad_nick)
+      self.log('Trying', attempt)
+      self._socksend('NICK %s' % (attempt), priority=send_queue.SendQueue.HIGH)
 
    # When the server returns a nickname because it is already in use,
    # append an underscore and send that nick.
    def _try_underscore_nick(self, msg):
       taken_nick = msg.params[1]
       attempt = taken_nick + '_'
-      print('Nickname', taken_nick, 'already in use')
-      print('Trying', attempt)
-      self.__socksend('NICK %s' % (attempt))
+      self.log('Nickname', taken_nick, 'already in use')
+      self.log('Trying', attempt)
+      self._socksend('NICK %s' % (attempt), priority=send_queue.SendQueue.HIGH)
 
 
    ###
@@ -310,5 +1105,20 @@ class Bot:
    FALL_THROUGH_MESSAGES = 2
    ALL_MESSAGES = 3
 
+   # flags for socket sends, which must never block the receive loop
+   SEND_FLAGS = getattr(socket, 'MSG_DONTWAIT', 0)
+
+   # seconds between send queue checks while worker threads are running
+   WORKER_POLL_INTERVAL = 0.1
+
+   # name the bot's own hooks are recorded under in metrics
+   HOOK_STATS_NAME = '(bot)'
+
+   # commands that can change the bot's nick or channels
+   SESSION_COMMANDS = frozenset(['JOIN', 'PART', 'KICK', 'NICK'])
+   # longest channel list put in one JOIN when rejoining, leaving room in the
+   # 512 byte line for the command and prefix
+   MAX_JOIN_LENGTH = 400
+
 
 
@@ -0,0 +1,104 @@
+"""
+   Circuit breaker module. Contains the CircuitBreaker class, which the bot
+   keeps for each extension so that one whose hooks keep failing or running
+   over their time budget is skipped for a while instead of slowing down
+   every message.
+"""
+
+import sys
+import time
+import threading
+
+# stop creating .pyc files
+sys.dont_write_bytecode = True
+
+class CircuitBreaker:
+
+   # The breaker starts CLOSED, letting every call through. After threshold
+   # failures in a row it trips OPEN, and calls are skipped for cooldown
+   # seconds. After that it is HALF_OPEN: a single call is let through as a
+   # probe, and closes the breaker again if it succeeds or reopens it for
+   # another cooldown if it fails.
+   def __init__(self, name, threshold=5, cooldown=60):
+      self.name = name
+      self.threshold = threshold
+      self.cooldown = cooldown
+      self.state = CircuitBreaker.CLOSED
+      self.failures = 0
+      self.last_failure = None
+      self.opened_at = 0.0
+      self.trips = 0
+      self.skipped = 0
+      self.lock = threading.Lock()
+
+
+   # Return whether a call should go ahead. A call that does must be
+   # followed by succeeded or failed.
+   def allow(self):
+      if self.state == CircuitBreaker.CLOSED:
+         return True
+      with self.lock:
+         if self.state == CircuitBreaker.CLOSED:
+            return True
+         if self.state == CircuitBreaker.OPEN and time.monotonic() >= self.opened_at + self.cooldown:
+            self.state = CircuitBreaker.HALF_OPEN
+            return True
+         self.skipped += 1
+         return False
+
+
+   # Record a successful call. Returns True if this closed the breaker.
+   def succeeded(self):
+      if self.state == CircuitBreaker.CLOSED and self.failures == 0:
+         return False
+      with self.lock:
+         self.failures = 0
+         if self.state == CircuitBreaker.CLOSED:
+            return False
+         self.state = CircuitBreaker.CLOSED
+         return True
+
+
+   # Record a failed call, with a short description of what went wrong.
+   # Returns True if this tripped the breaker.
+   def failed(self, reason):
+      with self.lock:
+         self.failures += 1
+         self.last_failure = reason
+         if self.state == CircuitBreaker.OPEN:
+            return False
+         if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.threshold:
+            self.state = CircuitBreaker.OPEN
+            self.opened_at = time.monotonic()
+            self.trips += 1
+            return True
+         return False
+
+
+   # One line describing the breaker, for the console.
+   def status(self):
+      with self.lock:
+         if self.state == CircuitBreaker.OPEN:
+            left = max(0.0, self.opened_at + self.cooldown - time.monotonic())
+            state = 'open, probing in %.0fs' % left
+         elif self.state == CircuitBreaker.HALF_OPEN:
+            state = 'half open, probing'
+         else:
+            state = 'closed'
+         line = '%s: %s; %d failure%s in a row, tripped %d time%s, %d call%s skipped' % (
+            self.name, state,
+            self.failures, '' if self.failures == 1 else 's',
+            self.trips, '' if self.trips == 1 else 's',
+            self.skipped, '' if self.skipped == 1 else 's')
+         if self.last_failure is not None:
+            line += ' (last failure: %s)' % self.last_failure
+         return line
+
+
+   ###
+   ### States
+   ###
+
+   CLOSED = 'closed'
+   OPEN = 'open'
+   HALF_OPEN = 'half open'
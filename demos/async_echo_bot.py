@@ -0,0 +1,43 @@
+"""
+   Async echo bot demo, the echo bot running on AsyncBot with an extension
+   whose hook is a coroutine.
+"""
+
+import asyncio
+
+import async_bot
+import extension
+
+class AsyncEcho(extension.Extension):
+   name = "Async Echo"
+
+   def __init__(self, bot):
+      super(AsyncEcho, self).__init__(bot)
+      self.hooks = {
+         'PRIVMSG': self.privmsg_handler
+      }
+
+   # Coroutine hooks run on the event loop, so they must not block; anything
+   # slow should be awaited.
+   async def privmsg_handler(self, msg):
+      sender = msg.getSender()
+      recipient = msg.params[0]
+      await asyncio.sleep(0)
+      if recipient == self.bot.nick:
+         self.bot.say(msg.trail, sender)
+      else:
+         self.bot.say(msg.trail, recipient)
+      return True
+
+   def cleanup(self):
+      pass
+
+async def main():
+   jbot = async_bot.AsyncBot({})
+   jbot.set_extensions([AsyncEcho(jbot)])
+   await jbot.connect('irc.freenode.net', 'sjdhfkj')
+   jbot.join('#zszszs')
+   await jbot.interact()
+   await jbot.cleanup()
+
+asyncio.run(main())
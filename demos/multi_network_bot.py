@@ -0,0 +1,28 @@
+"""
+   Multi-network demo, one process running bots on two networks that share
+   a single echo extension.
+"""
+
+import bot
+import network_loop
+import extensions.echo as echo
+
+freenode = bot.Bot({})
+oftc = bot.Bot({})
+
+# One instance, given to both bots. It replies through whichever bot
+# received the message.
+echo_ext = echo.Echo(freenode)
+freenode.set_extensions([echo_ext])
+oftc.set_extensions([echo_ext])
+
+freenode.connect('irc.freenode.net', 'sjdhfkj')
+freenode.join('#zszszs')
+oftc.connect('irc.oftc.net', 'sjdhfkj')
+oftc.join('#zszszs')
+
+loop = network_loop.NetworkLoop()
+loop.add_bot('freenode', freenode)
+loop.add_bot('oftc', oftc)
+loop.interact()
+loop.cleanup()
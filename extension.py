@@ -5,22 +5,106 @@
 
 # import abc
 import sys
+import asyncio
+import inspect
+import contextvars
 
 import irc_message
 
 # stop creating .pyc files
 sys.dont_write_bytecode = True
 
+# The bot an extension's code is being run for: the one dispatching the
+# message it is handling, or whose timer or event it is in. Bots set it
+# around each call, on whichever thread or task makes it. This is how an
+# extension shared by several bots replies on the connection the message
+# came in on.
+dispatching = contextvars.ContextVar('dispatching', default=None)
+
 class Extension(object):
 
+   # values for role
+   TERMINAL = 'terminal'
+   OBSERVER = 'observer'
+   # values for rate_limit_response
+   DROP = 'drop'
+   REPLY_ONCE = 'reply once'
+   NOTIFY = 'notify'
+
    # variables
    name = "" # expected to be supplied by the implementor
    hooks = {}
-   bot = None
+   # Things to look for in PRIVMSG trails, as an alternative to hooking
+   # PRIVMSG and checking each line by hand. commands maps prefixes like
+   # '!quote' to handlers called for lines starting with them; triggers is a
+   # list of (regular expression, handler) called for lines it is found in.
+   # The bot compiles every extension's into one matcher (see triggers.py), so
+   # each line is scanned once. Handlers take the message and return like
+   # hooks; an extension's commands run before its triggers, and both before
+   # any PRIVMSG hook it also has. Like hooks, these should be set in the
+   # constructor, or the bot's update_dispatch called after changing them.
+   # Patterns are embedded in a larger one, so they must not use numbered
+   # backreferences or global inline flags.
+   commands = {}
+   triggers = []
+   # How the extension takes part in dispatch when the bot runs handlers
+   # concurrently. TERMINAL extensions may halt a message, so later ones wait
+   # for them. OBSERVER extensions only watch messages and never halt (their
+   # hooks must not return True), so they can run alongside everything else.
+   role = TERMINAL
+   # Seconds the bot lets one call to a hook or handler take, or None for the
+   # bot's extension_time_budget setting. The calls of a blocking extension
+   # (one that waits on the network or a database) are made on threads of its
+   # own, so the bot can stop waiting for them and move on once the budget
+   # is spent; the calls of any other extension are only timed. Either way
+   # calls over budget count as failures, and an extension failing too often
+   # is skipped for a while (see circuit_breaker.py).
+   time_budget = None
+   blocking = False
+   # How often one user may set off the extension's commands and triggers in
+   # one channel (or in private), as a tuple of (calls, seconds), and how
+   # often everyone together may in one channel; None for no limit. Lines
+   # over the limit are halted without being handled. What happens besides
+   # is up to rate_limit_response: DROP ignores them silently, REPLY_ONCE
+   # tells the user where they spoke when to try again, and NOTIFY tells
+   # them in private; either way only once until they are let through again.
+   rate_limit = None
+   channel_rate_limit = None
+   rate_limit_response = DROP
 
 
    def __init__(self, bot):
       self.bot = bot
+      # every bot this extension has been given to with set_extensions
+      self.bots = []
+
+
+   # The bot the extension acts for. For an extension shared between several
+   # bots, while handling a message this is the bot that received it (and in
+   # a timer, the bot whose timer it is), and otherwise the bot it was
+   # created with.
+   @property
+   def bot(self):
+      if len(self.bots) > 1:
+         current = dispatching.get()
+         if current is not None:
+            return current
+      return self.__bot
+
+   @bot.setter
+   def bot(self, bot):
+      self.__bot = bot
+
+
+   # Record that a bot has started or stopped using this extension. These are
+   # called by the bot.
+   def attach(self, bot):
+      if bot not in self.bots:
+         self.bots.append(bot)
+
+   def detach(self, bot):
+      if bot in self.bots:
+         self.bots.remove(bot)
 
 
    # Act on an irc message. This should not be called by the programmer.
@@ -34,11 +118,82 @@ class Extension(object):
       return self.hooks[msg.command](msg)
 
 
+   # Call one of this extension's hook functions for AsyncBot. Hooks that are
+   # coroutine functions are awaited on the event loop; ordinary hooks are
+   # run in the given executor so that any blocking I/O they do can't stall
+   # the loop, in a copy of the caller's context, so they see the same
+   # dispatching bot. The return value means the same as for act.
+   async def run_hook_async(self, hook, msg, executor=None):
+      if inspect.iscoroutinefunction(hook):
+         return await hook(msg)
+      loop = asyncio.get_running_loop()
+      return await loop.run_in_executor(executor, contextvars.copy_context().run, hook, msg)
+
+
+   # Add or replace the hook for a command after the extension has been
+   # created, keeping the dispatch index of every bot using it up to date.
+   def add_hook(self, command, fn):
+      # copy rather than mutate, since a bot may be dispatching from the
+      # current dictionary (and the class-level default is shared)
+      hooks = dict(self.hooks)
+      hooks[command] = fn
+      self.hooks = hooks
+      self.__hooks_changed()
+
+
+   # Remove the hook for a command, if there is one.
+   def remove_hook(self, command):
+      if command not in self.hooks:
+         return
+      hooks = dict(self.hooks)
+      del hooks[command]
+      self.hooks = hooks
+      self.__hooks_changed()
+
+
+   # Every bot using the extension has its own dispatch index to rebuild.
+   def __hooks_changed(self):
+      bots = self.bots
+      if not bots and self.bot is not None:
+         bots = [self.bot]
+      for bot in list(bots):
+         bot.update_dispatch()
+
+
+   # Call fn(*args) once, delay seconds from now, on the bot's event loop.
+   # Returns a handle whose cancel method stops it. Extensions should use
+   # this and call_every rather than starting threads of their own, and
+   # cancel their timers in cleanup.
+   def call_later(self, delay, fn, *args):
+      return self.bot.call_later(delay, fn, *args)
+
+
+   # Call fn(*args) every interval seconds on the bot's event loop, until the
+   # handle returned is cancelled.
+   def call_every(self, interval, fn, *args):
+      return self.bot.call_every(interval, fn, *args)
+
+
+   # Called when the bot's connection to the server drops, before it tries
+   # to reconnect. Extensions keep their state across the reconnection.
+   def on_disconnect(self):
+      pass
+
+
+   # Called once the bot has reconnected and asked to rejoin its channels.
+   def on_reconnect(self):
+      pass
+
+
    # Print a message to console. The message will be automatically
    # prefaced by the extension name to indicate where it's coming from.
-   # Acts like normal print, with a variable number of args.
+   # Acts like normal print, with a variable number of args, but goes through
+   # the bot's logger so it never blocks.
    def print(*args):
       self = args[0]
       ext_name_str = "(" + type(self).name + ")"
       args = ( ext_name_str, ) + args[1:]
-      print(*args)
+      if self.bot is None:
+         print(*args)
+      else:
+         self.bot.log(*args)
@@ -12,28 +12,32 @@ import extension
 
 class GifLinks(extension.Extension):
    name = "GIF Links"
+   blocking = True
+   # every gif is a request to Giphy
+   rate_limit = (3, 60)
+   rate_limit_response = extension.Extension.REPLY_ONCE
 
    def __init__(self, bot, settings={}):
       super(GifLinks, self).__init__(bot)
       self.__init_settings(settings)
-      self.hooks = {
-         'PRIVMSG': self.privmsg_handler
+      self.commands = {
+         '!gif': self.privmsg_handler,
+         '!randomgif': self.privmsg_handler,
       }
 
    def __init_settings(self, settings):
-      pass
+      # seconds to wait for Giphy, so an abandoned request doesn't hold on
+      # to one of the bot's threads forever
+      self.request_timeout = settings.get('request_timeout', 10)
 
    def privmsg_handler(self, msg):
       recipient = msg.params[0]
       if recipient == self.bot.nick:
          recipient = msg.getSender()
 
-      if msg.trail.startswith('!gif') or msg.trail.startswith('!randomgif'):
-         gif_url = self.get_gif_link(msg.trail)
-         self.bot.say(gif_url, recipient)
-         return True
-      else:
-         return False
+      gif_url = self.get_gif_link(msg.trail)
+      self.bot.say(gif_url, recipient)
+      return True
 
    def get_gif_link(self, trail):
       params = trail.split()[1:]
@@ -43,7 +47,8 @@ class GifLinks(extension.Extension):
       else:
          tag_str = '&tag=%s' % '+'.join(params)
 
-      r = requests.get("http://api.giphy.com/v1/gifs/random?api_key=dc6zaTOxFJmzC&fmt=json" + tag_str)
+      r = requests.get("http://api.giphy.com/v1/gifs/random?api_key=dc6zaTOxFJmzC&fmt=json" + tag_str,
+         timeout=self.request_timeout)
       gif_url = json.loads(str(r.content, 'utf-8').replace('\\',''))['data']['image_original_url']
       return gif_url
 
@@ -23,7 +23,8 @@ class CommandHandler(extension.Extension):
       self.hooks = {
          'PRIVMSG': self.privmsg_handler
       }
-      self.commands = {
+      # not Extension.commands, since these are looked up by word, not prefix
+      self.actions = {
          'quote': self._random_quote,
       }
 
@@ -35,11 +36,11 @@ class CommandHandler(extension.Extension):
          cmd_list = msg.trail.split()
          command = cmd_list[0][1:]
 
-         if not command in self.commands:
+         if not command in self.actions:
             return False
 
          params = cmd_list[1:]
-         self.commands[command](params)
+         self.actions[command](params)
 
          return True
 
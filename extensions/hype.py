@@ -4,7 +4,6 @@
    with "HYPE"
 """
 
-import re
 import random
 
 import irc_message
@@ -12,6 +11,9 @@ import extension
 
 class Hype(extension.Extension):
    name = "Hype"
+   # hyping many times fast is no more hype, just lag
+   rate_limit = (3, 30)
+   channel_rate_limit = (5, 30)
    hype_msgs = {
       'HYPE': 20,
       'HYPE HYPE HYPE': 5,
@@ -27,26 +29,25 @@ class Hype(extension.Extension):
    def __init__(self, bot, settings={}):
       super(Hype, self).__init__(bot)
       self.__init_settings(settings)
-      self.hooks = {
-         'PRIVMSG': self.privmsg_handler
+      self.commands = {
+         '!hype': self.privmsg_handler,
       }
+      self.triggers = [
+         ('^(?:[gG][eE][tT] +)?[hH]+[yY]+[pP]+[eE]+', self.privmsg_handler),
+      ]
 
    def __init_settings(self, settings):
       pass
 
+   # Called for !hype and for lines starting with something like "get hype".
    def privmsg_handler(self, msg):
       recipient = msg.params[0]
       # only works in channels
       if recipient[0] != '#':
          return False
 
-      if msg.trail[:5] == '!hype':
-         self.hype(recipient)
-         return True
-
-      elif re.match('([gG][eE][tT] +)?[hH]+[yY]+[pP]+[eE]+!*', msg.trail):
-         self.hype(recipient)
-         return True
+      self.hype(recipient)
+      return True
 
    def _get_random_hype_msg(self):
       rand = random.uniform(0, Hype.hype_msgs_total)
@@ -1,13 +1,26 @@
 """
    Karma tracking extension.
    Records when users say "something++" or "something--" and uses a
-   Mongo database to record their "karma" numbers.
-   Hooks: PRIVMSG
+   Mongo database to record their "karma" numbers. Changes are kept in
+   memory and written to the database in batches every few seconds.
+   Keeps karma leaderboards, overall and for each channel, in memory, and a
+   history of every change, rolled up by hour and day. Nicks that differ
+   only in case or trailing underscores, and nicks their owners have
+   aliased together, share their karma.
+   Commands: !karma, !points, !top, !bottom, !trending, !alias, !unalias
+   Hooks: NOTICE (replies from NickServ)
+   Triggers: something++, something--
 """
 
 import re
+import bisect
+import heapq
 import threading
 import time
+import collections
+import concurrent.futures
+from pymongo import UpdateOne, InsertOne, ASCENDING
+from pymongo.errors import BulkWriteError, ServerSelectionTimeoutError, OperationFailure
 from bson.objectid import ObjectId
 
 import irc_message
@@ -16,25 +29,647 @@ import extension
 # stop creating .pyc files
 # sys.dont_write_bytecode = True
 
+class KarmaCache:
+
+   # Karma as it is in the users collection, plus the changes not yet
+   # written there. Reading a nick's karma goes to the database only the
+   # first time; changes apply immediately and are written by flush, all in
+   # one bulk_write of upserted $inc operations, so they never overwrite
+   # each other or changes made elsewhere. At most size nicks are kept,
+   # forgetting the least recently used that have nothing waiting to be
+   # written.
+   # Karma given in each channel is also counted in the channel_karma
+   # collection, with a document for each network, channel and nick; that is
+   # only ever written.
+   # Karma is looked up by identity: members is called with one and returns
+   # every nick whose document counts towards it, and the karma is the sum
+   # of theirs. Changes are written to the document of the identity itself.
+   def __init__(self, users, channel_karma, members, size=10000):
+      self.users = users
+      self.channel_karma = channel_karma
+      self.members = members
+      self.size = size
+      # maps nick to its karma as last read or written, or None if it has
+      # never had any
+      self.stored = collections.OrderedDict()
+      # maps nick to the change in its karma not yet written, and
+      # (network, channel, nick) to the change in its karma in that channel
+      self.pending = {}
+      self.channel_pending = {}
+      self.lock = threading.Lock()
+
+
+   # Create the indexes each nick's karma and each channel change are
+   # upserted and read through, so neither writing nor reading scans the
+   # collections. Nothing happens to those that already exist.
+   # Before users was indexed, two upserts of a new nick at once could both
+   # insert a document for it, which the unique index can't be built over.
+   # If a database has any of those, they are merged first, keeping the sum
+   # of their karma.
+   def create_indexes(self):
+      try:
+         self.users.create_index('nick', unique=True)
+      except OperationFailure as e:
+         if e.code != KarmaHistory.DUPLICATE_KEY:
+            raise
+         merge_duplicates(self.users, ['nick'])
+         self.users.create_index('nick', unique=True)
+      self.channel_karma.create_index([('network', ASCENDING), ('channel', ASCENDING), ('nick', ASCENDING)], unique=True)
+
+
+   # Return an identity's karma, or None if it has never received any.
+   def get(self, nick):
+      with self.lock:
+         if nick in self.stored:
+            self.stored.move_to_end(nick)
+            return self.__current(nick)
+      # not holding the lock over the round trip
+      karma = None
+      members = self.members(nick)
+      if len(members) == 1:
+         docs = [self.users.find_one({'nick': nick}, {'karma': 1, '_id': 0})]
+      else:
+         docs = self.users.find({'nick': {'$in': members}}, {'karma': 1, '_id': 0})
+      for doc in docs:
+         if doc is not None:
+            karma = (karma or 0) + doc.get('karma', 0)
+      with self.lock:
+         if nick not in self.stored:
+            self.stored[nick] = karma
+            self.__evict()
+         return self.__current(nick)
+
+
+   # Forget what is known about an identity, so its karma is read again. Its
+   # changes must have been written first.
+   def forget(self, nick):
+      with self.lock:
+         self.stored.pop(nick, None)
+
+
+   # Change a nick's karma by delta, as given in a channel on a network,
+   # returning the new value.
+   def add(self, nick, delta, network, channel):
+      self.get(nick)
+      with self.lock:
+         self.pending[nick] = self.pending.get(nick, 0) + delta
+         key = (network, channel, nick)
+         self.channel_pending[key] = self.channel_pending.get(key, 0) + delta
+         return self.__current(nick)
+
+
+   def __current(self, nick):
+      stored = self.stored.get(nick)
+      if nick not in self.pending:
+         return stored
+      return (stored or 0) + self.pending[nick]
+
+
+   def __evict(self):
+      while len(self.stored) > self.size:
+         for nick in self.stored:
+            if nick not in self.pending:
+               del self.stored[nick]
+               break
+         else:
+            # everything has changes waiting
+            return
+
+
+   # Write every pending change to the database, in one round trip for each
+   # collection. Changes the database certainly didn't apply are kept to
+   # try again. Changes it may or may not have applied are not sent twice,
+   # since that could count them twice; the karma of their nicks is read
+   # again instead. If anything went wrong the first error is raised, once
+   # both collections have been tried.
+   def flush(self):
+      # the changes count as stored while they are being written, so the
+      # karma read meanwhile is still right
+      with self.lock:
+         pending = self.pending
+         channel_pending = self.channel_pending
+         self.pending = {}
+         self.channel_pending = {}
+         self.__apply(pending, 1)
+
+      errors = []
+      changes = [(nick, delta) for nick, delta in pending.items() if delta != 0]
+      failure = write_unordered(self.users, [UpdateOne({'nick': nick}, {'$inc': {'karma': delta}}, upsert=True)
+         for nick, delta in changes])
+      if failure is not None:
+         error, failed = failure
+         errors.append(error)
+         with self.lock:
+            if failed is None:
+               for nick, delta in changes:
+                  self.stored.pop(nick, None)
+            else:
+               retry = dict(changes[index] for index in failed)
+               self.__apply(retry, -1)
+               KarmaCache.merge(self.pending, retry)
+
+      channel_changes = [(key, delta) for key, delta in channel_pending.items() if delta != 0]
+      failure = write_unordered(self.channel_karma, [UpdateOne({'network': network, 'channel': channel, 'nick': nick}, {'$inc': {'karma': delta}}, upsert=True)
+         for (network, channel, nick), delta in channel_changes])
+      if failure is not None:
+         error, failed = failure
+         errors.append(error)
+         if failed is not None:
+            with self.lock:
+               KarmaCache.merge(self.channel_pending, dict(channel_changes[index] for index in failed))
+
+      if errors:
+         raise errors[0]
+      return len(changes) + len(channel_changes)
+
+
+   # Add the changes in one dictionary to another.
+   @staticmethod
+   def merge(into, changes):
+      for key, delta in changes.items():
+         into[key] = into.get(key, 0) + delta
+
+
+   def __apply(self, changes, sign):
+      for nick, delta in changes.items():
+         if nick in self.stored:
+            self.stored[nick] = (self.stored[nick] or 0) + sign * delta
+
+class ExpiringKeys:
+
+   # A set of keys that each drop out ttl seconds after they were last
+   # added. Every key lives for the same time, so keys expire in the order
+   # they were added, and one ordered dictionary serves as the expiry queue
+   # (oldest first) and the index: expired keys are dropped from the front
+   # as they are found, with no sweeping thread, and adding or checking
+   # a key is O(1) amortized. Past max_size keys the oldest are dropped
+   # early, so memory stays bounded however many keys are added.
+   # A key may be added with a value, which pop hands back.
+   def __init__(self, ttl, max_size=50000):
+      self.ttl = ttl
+      self.max_size = max_size
+      # maps each key to the time it expires
+      self.expiries = collections.OrderedDict()
+      self.values = {}
+      self.lock = threading.Lock()
+
+
+   # Add key unless it is already there. Returns whether it was added.
+   def add(self, key, value=None):
+      now = time.monotonic()
+      with self.lock:
+         self.__expire(now)
+         if key in self.expiries:
+            return False
+         self.expiries[key] = now + self.ttl
+         if value is not None:
+            self.values[key] = value
+         if len(self.expiries) > self.max_size:
+            oldest, expiry = self.expiries.popitem(last=False)
+            self.values.pop(oldest, None)
+         return True
+
+
+   # Remove key, returning the value it was added with, or None if it isn't
+   # there (or was added without one).
+   def pop(self, key):
+      with self.lock:
+         self.__expire(time.monotonic())
+         if self.expiries.pop(key, None) is None:
+            return None
+         return self.values.pop(key, None)
+
+
+   def __contains__(self, key):
+      with self.lock:
+         self.__expire(time.monotonic())
+         return key in self.expiries
+
+
+   def __len__(self):
+      return len(self.expiries)
+
+
+   def __expire(self, now):
+      expiries = self.expiries
+      while expiries:
+         key, expiry = next(iter(expiries.items()))
+         if expiry > now:
+            return
+         del expiries[key]
+         self.values.pop(key, None)
+
+
+class Leaderboard:
+
+   # Every nick's karma, kept sorted so the highest and lowest can be read
+   # off the ends at any time. Changing a nick's karma is a binary search
+   # and a list insertion, which moves memory but never sorts. Nicks with no
+   # karma at all aren't listed.
+   def __init__(self):
+      # maps nick to karma
+      self.scores = {}
+      # (karma, nick) for every nick in scores, in ascending order
+      self.ranked = []
+      self.lock = threading.Lock()
+
+
+   # Set a nick's karma.
+   def set(self, nick, karma):
+      with self.lock:
+         self.__set(nick, karma)
+
+
+   # Change a nick's karma by delta.
+   def add(self, nick, delta):
+      with self.lock:
+         self.__set(nick, self.scores.get(nick, 0) + delta)
+
+
+   def __set(self, nick, karma):
+      old = self.scores.get(nick)
+      if old == karma:
+         return
+      if old is not None:
+         del self.ranked[bisect.bisect_left(self.ranked, (old, nick))]
+      if karma == 0:
+         self.scores.pop(nick, None)
+         return
+      self.scores[nick] = karma
+      bisect.insort(self.ranked, (karma, nick))
+
+
+   # Move all of one nick's karma to another.
+   def move(self, source, dest):
+      with self.lock:
+         karma = self.scores.get(source)
+         if karma:
+            self.__set(source, 0)
+            self.__set(dest, self.scores.get(dest, 0) + karma)
+
+
+   # Replace everything with the karma in scores, a dictionary mapping nick
+   # to karma.
+   def load(self, scores):
+      scores = dict((nick, karma) for nick, karma in scores.items() if karma)
+      ranked = sorted((karma, nick) for nick, karma in scores.items())
+      with self.lock:
+         self.scores = scores
+         self.ranked = ranked
+
+
+   # Return the count nicks with the most karma, most first, as (nick,
+   # karma) tuples.
+   def top(self, count):
+      with self.lock:
+         return [(nick, karma) for karma, nick in reversed(self.ranked[-count:])] if count > 0 else []
+
+
+   # Return the count nicks with the least karma, least first.
+   def bottom(self, count):
+      with self.lock:
+         return [(nick, karma) for karma, nick in self.ranked[:count]]
+
+
+   def __len__(self):
+      return len(self.ranked)
+
+
+class KarmaHistory:
+
+   # Every karma change is logged as an event (giver, nick, network,
+   # channel, delta and time) in the events collection, and added to the hourly and daily
+   # rollups in the rollups collection: one document per period, bucket and
+   # nick, holding the net change. Both are written in batches by flush.
+   # The rollups of the last few days are also kept in memory, filled by one
+   # scan at startup, so questions like how much karma a nick gained this
+   # week are answered from a handful of buckets without asking the
+   # database. compact deletes events and rollups older than the retention
+   # given for each, in seconds, so storage stays bounded too.
+   # Each event is given its _id when it is recorded, so sending one again
+   # after a failed write can't insert it twice.
+   def __init__(self, events, rollups, retention):
+      self.events = events
+      self.rollups = rollups
+      self.retention = retention
+      # maps period ('hour' or 'day') to a dictionary mapping the start time
+      # of each bucket kept in memory to a dictionary of nick to net change
+      self.buckets = dict((period, {}) for period in KarmaHistory.BUCKET_SECONDS)
+      # events, and rollup changes keyed by (period, start, nick), not yet
+      # written
+      self.pending_events = []
+      self.pending_rollups = {}
+      self.lock = threading.Lock()
+
+
+   # Create the indexes the rollups are upserted, scanned and deleted
+   # through, and the one events are deleted by, so none of those scan the
+   # collections as they grow. Nothing happens to those that already exist.
+   def create_indexes(self):
+      self.rollups.create_index([('period', ASCENDING), ('start', ASCENDING), ('nick', ASCENDING)], unique=True)
+      self.events.create_index([('time', ASCENDING)])
+
+
+   # Fill the in-memory buckets from the database. resolve is called with
+   # each nick found to get the identity it counts towards.
+   def load(self, resolve):
+      now = time.time()
+      for period, seconds in KarmaHistory.BUCKET_SECONDS.items():
+         since = KarmaHistory.bucket_start(now, period) - seconds * (KarmaHistory.BUCKETS_KEPT[period] - 1)
+         spec = {'period': period, 'start': {'$gte': since}}
+         for doc in self.rollups.find(spec, {'start': 1, 'nick': 1, 'delta': 1, '_id': 0}):
+            bucket = self.buckets[period].setdefault(doc['start'], {})
+            nick = resolve(doc['nick'])
+            bucket[nick] = bucket.get(nick, 0) + doc.get('delta', 0)
+
+
+   # Count everything one nick gained in the buckets in memory towards
+   # another instead.
+   def move(self, source, dest):
+      with self.lock:
+         for buckets in self.buckets.values():
+            for bucket in buckets.values():
+               if source in bucket:
+                  bucket[dest] = bucket.get(dest, 0) + bucket.pop(source)
+
+
+   # Record a karma change.
+   def record(self, giver, nick, network, channel, delta):
+      now = time.time()
+      with self.lock:
+         self.pending_events.append({
+            '_id': ObjectId(),
+            'giver': giver,
+            'nick': nick,
+            'network': network,
+            'channel': channel,
+            'delta': delta,
+            'time': now,
+         })
+         for period in KarmaHistory.BUCKET_SECONDS:
+            start = KarmaHistory.bucket_start(now, period)
+            bucket = self.buckets[period].get(start)
+            if bucket is None:
+               bucket = {}
+               self.buckets[period][start] = bucket
+               self.__drop_old_buckets(period, start)
+            bucket[nick] = bucket.get(nick, 0) + delta
+            key = (period, start, nick)
+            self.pending_rollups[key] = self.pending_rollups.get(key, 0) + delta
+
+
+   def __drop_old_buckets(self, period, newest):
+      oldest = newest - KarmaHistory.BUCKET_SECONDS[period] * (KarmaHistory.BUCKETS_KEPT[period] - 1)
+      buckets = self.buckets[period]
+      for start in [start for start in buckets if start < oldest]:
+         del buckets[start]
+
+
+   # Return a dictionary of nick to net karma change over a window (a key
+   # of WINDOWS) up to now.
+   def changes(self, window):
+      period, count = KarmaHistory.WINDOWS[window]
+      since = KarmaHistory.bucket_start(time.time(), period) - KarmaHistory.BUCKET_SECONDS[period] * (count - 1)
+      totals = {}
+      with self.lock:
+         for start, bucket in self.buckets[period].items():
+            if start >= since:
+               for nick, delta in bucket.items():
+                  totals[nick] = totals.get(nick, 0) + delta
+      return totals
+
+
+   # Net karma change of one nick over a window.
+   def gained(self, nick, window):
+      period, count = KarmaHistory.WINDOWS[window]
+      since = KarmaHistory.bucket_start(time.time(), period) - KarmaHistory.BUCKET_SECONDS[period] * (count - 1)
+      with self.lock:
+         return sum(bucket.get(nick, 0) for start, bucket in self.buckets[period].items() if start >= since)
+
+
+   # Return the count nicks that gained the most karma over a window, as
+   # (nick, change) tuples, most first. Nicks that didn't gain are left out.
+   def trending(self, window, count):
+      totals = self.changes(window)
+      best = heapq.nlargest(count, totals.items(), key=lambda item: item[1])
+      return [(nick, delta) for nick, delta in best if delta > 0]
+
+
+   # Write the pending events and rollup changes, in one round trip for
+   # each collection, neither depending on how the other went. Events that
+   # weren't inserted are kept to try again; those the database already has
+   # come back as duplicates and are dropped. Rollup changes the database
+   # certainly didn't apply are kept too, but not those it may have, as
+   # they would be counted twice. If anything went wrong the first error is
+   # raised, once both collections have been tried.
+   def flush(self):
+      with self.lock:
+         events = self.pending_events
+         rollups = self.pending_rollups
+         self.pending_events = []
+         self.pending_rollups = {}
+
+      errors = []
+      failure = write_unordered(self.events, [InsertOne(event) for event in events])
+      if failure is not None:
+         error, failed = failure
+         errors.append(error)
+         if failed is None:
+            # whichever were inserted will be refused as duplicates next time
+            retry = events
+         else:
+            retry = [events[index] for index, code in failed.items() if code != KarmaHistory.DUPLICATE_KEY]
+         with self.lock:
+            self.pending_events[:0] = retry
+
+      changes = [(key, delta) for key, delta in rollups.items() if delta != 0]
+      failure = write_unordered(self.rollups, [UpdateOne({'period': period, 'start': start, 'nick': nick}, {'$inc': {'delta': delta}}, upsert=True)
+         for (period, start, nick), delta in changes])
+      if failure is not None:
+         error, failed = failure
+         errors.append(error)
+         if failed is not None:
+            with self.lock:
+               KarmaCache.merge(self.pending_rollups, dict(changes[index] for index in failed))
+
+      if errors:
+         raise errors[0]
+      return len(events) + len(changes)
+
+
+   # Delete raw events and rollups that are past their retention, from the
+   # database and from memory.
+   def compact(self):
+      now = time.time()
+      with self.lock:
+         for period in KarmaHistory.BUCKET_SECONDS:
+            self.__drop_old_buckets(period, KarmaHistory.bucket_start(now, period))
+      self.events.delete_many({'time': {'$lt': now - self.retention['events']}})
+      for period in KarmaHistory.BUCKET_SECONDS:
+         self.rollups.delete_many({'period': period, 'start': {'$lt': now - self.retention[period]}})
+
+
+   # The start of the bucket of a period that a time falls in. Buckets are
+   # aligned to UTC hours and days.
+   @staticmethod
+   def bucket_start(when, period):
+      seconds = KarmaHistory.BUCKET_SECONDS[period]
+      return int(when // seconds) * seconds
+
+
+   ###
+   ### Constants
+   ###
+
+   # length of the buckets of each rollup period, in seconds
+   BUCKET_SECONDS = {
+      'hour': 3600,
+      'day': 86400,
+   }
+   # how many of the most recent buckets of each period are kept in memory,
+   # enough for the longest window using that period
+   BUCKETS_KEPT = {
+      'hour': 24,
+      'day': 30,
+   }
+   # windows that can be asked about, with the rollup period used and how
+   # many of its buckets, counting the current one
+   WINDOWS = {
+      'day': ('hour', 24),
+      'week': ('day', 7),
+      'month': ('day', 30),
+   }
+   # MongoDB's error code for a write refused by a unique index
+   DUPLICATE_KEY = 11000
+
+
+class NickAliases:
+
+   # Groups of nicks belonging to one person, as a union-find forest: each
+   # nick points towards the root of its group, which is the identity the
+   # whole group's karma is counted under. Finding a nick's identity follows
+   # the pointers with path halving, and merging puts the smaller group under
+   # the larger, so both take near-constant time, and a nick never aliased
+   # costs only a dictionary miss. The members of each group are listed at
+   # its root, so the list of the group absorbed is all a merge copies.
+   def __init__(self):
+      self.parent = {}
+      # maps each root to the list of nicks in its group
+      self.groups = {}
+      self.lock = threading.Lock()
+
+
+   # Return the identity of a nick.
+   def find(self, nick):
+      parent = self.parent
+      if nick not in parent:
+         return nick
+      with self.lock:
+         while parent[nick] != nick:
+            # point at the grandparent, halving the path for next time
+            parent[nick] = parent[parent[nick]]
+            nick = parent[nick]
+         return nick
+
+
+   # Return every nick with the same identity as nick.
+   def members(self, nick):
+      root = self.find(nick)
+      return list(self.groups.get(root, (root,)))
+
+
+   # Merge the groups of two nicks. Returns a tuple of the identity of the
+   # merged group and the identity that was absorbed into it, or None if
+   # they were already the same.
+   def union(self, a, b):
+      a = self.find(a)
+      b = self.find(b)
+      if a == b:
+         return None
+      with self.lock:
+         for root in (a, b):
+            if root not in self.parent:
+               self.parent[root] = root
+               self.groups[root] = [root]
+         if len(self.groups[a]) < len(self.groups[b]):
+            a, b = b, a
+         self.parent[b] = a
+         self.groups[a].extend(self.groups.pop(b))
+      return (a, b)
+
+
+   # Take on the groups of another NickAliases in place of these, all at
+   # once, so no nick is ever found in a group half rebuilt.
+   def replace(self, other):
+      with self.lock:
+         self.parent = other.parent
+         self.groups = other.groups
+
+
 class KarmaTracker(extension.Extension):
    name = "Karma Tracker"
+   blocking = True
+   rate_limit = (10, 60)
+   rate_limit_response = extension.Extension.NOTIFY
    db = None
 
    def __init__(self, bot, db, settings={}):
       super(KarmaTracker, self).__init__(bot)
       self.db = db
       self.__init_settings(settings)
+      self.aliases = NickAliases()
+      # alias requests waiting for the other nick to confirm, as (asking
+      # nick, nick asked for) pairs
+      self.alias_requests = ExpiringKeys(KarmaTracker.ALIAS_REQUEST_TIMEOUT, KarmaTracker.ALIAS_REQUESTS_MAX)
+      # what to do for each (network, nick) once NickServ says whether the
+      # nick is identified; see __when_identified
+      self.identify_checks = ExpiringKeys(KarmaTracker.IDENTIFY_TIMEOUT, KarmaTracker.ALIAS_REQUESTS_MAX)
+      self.karma = KarmaCache(db.users, db.channel_karma, self.aliases.members, self.cache_size)
+      self.karma.create_indexes()
+      # the overall leaderboard, and one for each channel, keyed by
+      # (network, channel) since the extension may be shared by bots on
+      # several networks
+      self.leaderboard = Leaderboard()
+      self.channel_leaderboards = {}
+      self.leaderboards_lock = threading.Lock()
+      self.__load_identities()
+      self.history = KarmaHistory(db.karma_events, db.karma_rollups, {
+         'events': self.event_retention,
+         'hour': self.hourly_retention,
+         'day': self.daily_retention,
+      })
+      self.history.create_indexes()
+      self.history.load(self.identity)
+      # Writes and compaction go to the database from a thread of their own,
+      # one at a time, so the timers that start them never hold up the bot's
+      # event loop. writing is the write last started.
+      self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='karma writer')
+      self.writing = None
+      self.compact_timer = self.call_every(KarmaTracker.COMPACT_INTERVAL, self.writer.submit, self.__compact_history)
+      self.write_timer = self.call_every(self.write_interval, self.__start_write)
+      self.commands = {
+         '!karma': self.karma_command_handler,
+         '!points': self.karma_command_handler,
+         '!top': self.leaderboard_handler,
+         '!bottom': self.leaderboard_handler,
+         '!trending': self.trending_handler,
+         '!alias': self.alias_handler,
+         '!unalias': self.unalias_handler,
+      }
       self.hooks = {
-         'PRIVMSG': self.privmsg_handler
+         'NOTICE': self.nickserv_handler,
       }
+      if self.allow_minus:
+         self.karma_mod_re = re.compile('[^ ]+(?:\+\+|--)')
+      else:
+         self.karma_mod_re = re.compile('[^ ]+\+\+')
+      self.triggers = [
+         (self.karma_mod_re.pattern, self.karma_mod_handler),
+      ]
       if self.prevent_spam:
-         # maintain a dictionary of tuples of (sender, karmaed) to timestamp
-         # to prevent people from spamming karma
-         self.recent_karma = {}
-         self.exiting = False
-         self.recent_karma_lock = threading.Lock()
-         # start checking for recent karma expired
-         threading.Thread(None, self.__recent_karma_expired).start()
+         # remember the (sender, karmaed) pairs from the last karma_timeout
+         # seconds to prevent people from spamming karma
+         self.recent_karma = ExpiringKeys(self.karma_timeout, self.recent_karma_size)
 
 
    # Initialize the extension's settings based on what was passed to the constructor.
@@ -42,38 +677,112 @@ class KarmaTracker(extension.Extension):
       self.allow_minus = settings.get('allow_minus', True)
       self.prevent_spam = settings.get('prevent_spam', True)
       self.karma_timeout = settings.get('karma_timeout', 300)
-      # The flush_period should be significantly less than the karma_timeout, maybe only a few seconds.
-      self.flush_period = settings.get('flush_period', 30)
+      # most (sender, karmaed) pairs remembered for prevent_spam
+      self.recent_karma_size = settings.get('recent_karma_size', 50000)
       self.print_karma_changes = settings.get('print_karma_changes', False)
+      # Karma changes are written to the database at most write_interval
+      # seconds after they are made. cache_size is how many nicks' karma is
+      # kept in memory.
+      self.write_interval = settings.get('write_interval', 5)
+      self.cache_size = settings.get('cache_size', 10000)
+      # Seconds to keep individual karma events, and the hourly and daily
+      # totals of karma changes, in the database.
+      self.event_retention = settings.get('event_retention', 7 * 86400)
+      self.hourly_retention = settings.get('hourly_retention', 14 * 86400)
+      self.daily_retention = settings.get('daily_retention', 366 * 86400)
+      # The nick of the network's NickServ, which is asked whether whoever
+      # uses !alias or !unalias is identified to the nick they are using, or
+      # None to take nicks on trust, on networks without services. admins
+      # are the nicks that may use !unalias.
+      self.nickserv = settings.get('nickserv', 'NickServ')
+      self.nickserv_command = settings.get('nickserv_command', 'ACC')
+      self.admins = set(nick.lower() for nick in settings.get('admins', []))
 
 
-   # Run an infinite loop that checks every so often to flush out the recent_karma list.
-   # This should be run in a new thread.
-   def __recent_karma_expired(self):
-      while not self.exiting:
-         now = time.time()
-         with self.recent_karma_lock:
-            for key in self.recent_karma.copy():
-               if now - self.recent_karma[key] > self.karma_timeout:
-                  self.recent_karma.pop(key)
+   # The identity whose karma a nick counts towards: its group, going by
+   # the nick with case and trailing underscores ignored.
+   def identity(self, nick):
+      return self.aliases.find(KarmaTracker.normalize(nick))
 
-         time.sleep(self.flush_period)
 
-      self.print("Karma Tracker polling thread finished")
+   # Same nick, for karma purposes.
+   @staticmethod
+   def normalize(nick):
+      return nick.rstrip('_').lower() or nick
 
 
-   # Given a nick, return a dictionary representing the associated user in the database.
-   # This will create a user if no user with the nick exists.
-   def _get_user(self, nick):
-      user = self.db.users.find_one({'nick': nick})
-      if user is None:
-         new_user = {
-            'nick': nick,
-            'karma': 0,
-         }
-         new_id = self.db.users.insert(new_user)
-         user = self.db.users.find_one({'_id': ObjectId(new_id)})
-      return user
+   # Build the alias groups from the links recorded in the database, and
+   # fill the leaderboards, in one pass over each collection. After this
+   # they are kept up to date as karma changes, and the database is never
+   # asked about them again (unless an alias is undone).
+   # Documents from before nicks were normalized are counted too, by
+   # grouping them (in memory only) with their normalized nick.
+   def __load_identities(self):
+      aliases = NickAliases()
+      for doc in self.db.nick_aliases.find({}, {'nick': 1, 'alias_of': 1, '_id': 0}):
+         aliases.union(doc['nick'], doc['alias_of'])
+      identity = lambda nick: aliases.find(KarmaTracker.normalize(nick))
+
+      scores = {}
+      for doc in self.db.users.find({}, {'nick': 1, 'karma': 1, '_id': 0}):
+         nick = doc['nick']
+         if KarmaTracker.normalize(nick) != nick:
+            aliases.union(KarmaTracker.normalize(nick), nick)
+         nick = identity(nick)
+         scores[nick] = scores.get(nick, 0) + doc.get('karma', 0)
+
+      channel_scores = {}
+      for doc in self.db.channel_karma.find({}, {'network': 1, 'channel': 1, 'nick': 1, 'karma': 1, '_id': 0}):
+         scores_here = channel_scores.setdefault((doc.get('network'), doc['channel']), {})
+         nick = identity(doc['nick'])
+         scores_here[nick] = scores_here.get(nick, 0) + doc.get('karma', 0)
+
+      self.aliases.replace(aliases)
+      self.leaderboard.load(scores)
+      for (network, channel), scores_here in channel_scores.items():
+         self._channel_leaderboard(network, channel).load(scores_here)
+
+
+   # Get the leaderboard for a channel on a network, creating it if needed.
+   def _channel_leaderboard(self, network, channel):
+      key = (network, channel)
+      with self.leaderboards_lock:
+         leaderboard = self.channel_leaderboards.get(key)
+         if leaderboard is None:
+            leaderboard = Leaderboard()
+            self.channel_leaderboards[key] = leaderboard
+         return leaderboard
+
+
+   # Start writing the karma changes on the writer thread, unless the last
+   # write is still waiting to go or in progress, in which case this one's
+   # changes go with the next. Called by the bot's scheduler every
+   # write_interval seconds.
+   def __start_write(self):
+      if self.writing is None or self.writing.done():
+         self.writing = self.writer.submit(self.__write_karma)
+
+
+   # Write the karma changes made since last time to the database. Only
+   # called on the writer thread, and on cleanup once it has stopped.
+   def __write_karma(self):
+      try:
+         self.karma.flush()
+      except Exception as e:
+         self.print('Could not write all karma changes:', e)
+      try:
+         self.history.flush()
+      except Exception as e:
+         self.print('Could not write all karma history:', e)
+
+
+   # Delete karma history past its retention. Started on the writer thread
+   # by the bot's scheduler every COMPACT_INTERVAL seconds.
+   def __compact_history(self):
+      try:
+         self.history.compact()
+      except Exception as e:
+         self.print('Could not compact karma history:', e)
 
 
    # Given a list of nicks with ++ or -- after them, adjust each user's karma accordingly.
@@ -83,8 +792,9 @@ class KarmaTracker(extension.Extension):
          self.bot.say('Karma may only be changed over public channels.', sender)
          return
 
+      sender_identity = self.identity(sender)
       for s in karma_mod_list:
-         # don't let people change their own karma
+         # don't let people change their own karma, under any of their nicks
          if s.find(sender) == 0:
             continue
 
@@ -109,18 +819,17 @@ class KarmaTracker(extension.Extension):
             continue
 
          nick = s.rstrip('+-')
-         if self.prevent_spam:
-            with self.recent_karma_lock:
-               if (sender, nick) in self.recent_karma:
-                  continue
-
-         user = self._get_user(nick)
+         identity = self.identity(nick)
+         if identity == sender_identity:
+            continue
+         if self.prevent_spam and not self.recent_karma.add((sender_identity, identity)):
+            continue
 
-         new_karma = user['karma'] + delta
-         self.db.users.update({'nick': nick}, { '$set':  { 'karma': new_karma } })
-         if self.prevent_spam:
-            with self.recent_karma_lock:
-               self.recent_karma[(sender, nick)] = time.time()
+         network = self.bot.network
+         new_karma = self.karma.add(identity, delta, network, channel)
+         self.leaderboard.set(identity, new_karma)
+         self._channel_leaderboard(network, channel).add(identity, delta)
+         self.history.record(sender, identity, network, channel, delta)
 
          if self.print_karma_changes:
             incdecstr = "in" if delta == 1 else "de"
@@ -131,19 +840,27 @@ class KarmaTracker(extension.Extension):
 
 
    def handle_karma_command(self, message, sender, recipient):
-      # Get and say the karma of the first param, and ignore anything else.
+      # Get and say the karma of the first param. If the second is a window
+      # like week, say how much it changed by over that time instead.
+      # Ignore anything else.
+      words = message.split()
       try:
-         nick = message.split()[1]
+         nick = words[1]
       except IndexError:
          nick = sender
 
-      cursor = self.db.users.find_one({'nick': nick}, {'karma': 1, '_id': 0})
-      try:
-         karma = cursor['karma']
-      except TypeError:
-         out_str = '%s has never received karma' % nick
+      identity = self.identity(nick)
+      if len(words) > 2 and words[2].lower() in KarmaHistory.WINDOWS:
+         window = words[2].lower()
+         change = self.history.gained(identity, window)
+         out_str = '%s has %s %s point%s of karma in the last %s' % (
+            nick, 'lost' if change < 0 else 'gained', abs(change), self.plural(change), window)
       else:
-         out_str = '%s has %s point%s of karma' % (nick, karma, self.plural(karma))
+         karma = self.karma.get(identity)
+         if karma is None:
+            out_str = '%s has never received karma' % nick
+         else:
+            out_str = '%s has %s point%s of karma' % (nick, karma, self.plural(karma))
 
       if recipient == self.bot.nick:
          self.bot.say(out_str, sender)
@@ -151,29 +868,233 @@ class KarmaTracker(extension.Extension):
          self.bot.say(out_str, recipient)
 
 
-   def privmsg_handler(self, msg):
+   def karma_command_handler(self, msg):
+      self.handle_karma_command(msg.trail, msg.getSender(), msg.params[0])
+      return True
+
+
+   # Say who has the most karma for !top, or the least for !bottom. Takes
+   # an optional number of nicks to list and an optional channel, for the
+   # leaderboard of karma given in that channel.
+   def leaderboard_handler(self, msg):
+      words = msg.trail.split()
+      if words[0] not in ('!top', '!bottom'):
+         # some other command starting the same way
+         return False
       recipient = msg.params[0]
-      sender = msg.getSender()
+      if recipient == self.bot.nick:
+         recipient = msg.getSender()
 
-      # look for !karma or !points first
-      if msg.trail[:6] == '!karma' or msg.trail[:7] == '!points':
-         self.handle_karma_command(msg.trail, sender, recipient)
+      count = KarmaTracker.LEADERBOARD_DEFAULT
+      channel = None
+      for word in words[1:]:
+         if word.isdigit():
+            count = max(1, min(int(word), KarmaTracker.LEADERBOARD_MAX))
+         elif word[0] == '#':
+            channel = word
+
+      if channel is None:
+         leaderboard = self.leaderboard
+         where = ''
+      else:
+         with self.leaderboards_lock:
+            leaderboard = self.channel_leaderboards.get((self.bot.network, channel))
+         where = ' in %s' % channel
+      if words[0] == '!top':
+         title = 'Most karma'
+         ranked = leaderboard.top(count) if leaderboard is not None else []
+      else:
+         title = 'Least karma'
+         ranked = leaderboard.bottom(count) if leaderboard is not None else []
+
+      if not ranked:
+         self.bot.say('Nobody has any karma%s yet' % where, recipient)
+      else:
+         entries = ', '.join('%s (%s)' % (nick, karma) for nick, karma in ranked)
+         self.bot.say('%s%s: %s' % (title, where, entries), recipient)
+      return True
+
+
+   # Say who gained the most karma recently, over the window given (a day
+   # by default).
+   def trending_handler(self, msg):
+      words = msg.trail.split()
+      if words[0] != '!trending':
+         return False
+      recipient = msg.params[0]
+      if recipient == self.bot.nick:
+         recipient = msg.getSender()
+
+      window = words[1].lower() if len(words) > 1 else 'day'
+      if window not in KarmaHistory.WINDOWS:
+         self.bot.say('Trending over a %s? Try %s' % (window, ', '.join(sorted(KarmaHistory.WINDOWS))), recipient)
          return True
 
-      if self.allow_minus:
-         karma_mod_list = re.findall('[^ ]+(?:\+\+|--)', msg.trail)
+      trending = self.history.trending(window, KarmaTracker.LEADERBOARD_DEFAULT)
+      if not trending:
+         self.bot.say('Nobody has gained any karma in the last %s' % window, recipient)
       else:
-         karma_mod_list = re.findall('[^ ]+\+\+', msg.trail)
+         entries = ', '.join('%s (+%s)' % (nick, delta) for nick, delta in trending)
+         self.bot.say('Trending in the last %s: %s' % (window, entries), recipient)
+      return True
+
+
+   # Alias the sender's nick to another, so they share karma from then on.
+   # The owner of the other nick has to agree by asking for the same the
+   # other way round, within ALIAS_REQUEST_TIMEOUT seconds. Since a nick is
+   # only a claim, NickServ is asked before acting on either side that the
+   # sender is identified to the nick they are using; otherwise anyone could
+   # take a nick while its owner is away and alias it to their own. Only
+   # admins can undo aliases, with !unalias.
+   def alias_handler(self, msg):
+      words = msg.trail.split()
+      if words[0] != '!alias':
+         return False
+      sender = msg.getSender()
+      recipient = msg.params[0]
+      if recipient == self.bot.nick:
+         recipient = sender
+      if len(words) < 2:
+         self.bot.say('Usage: !alias <your other nick>', recipient)
+         return True
 
-      if len(karma_mod_list) > 0:
-         self._adjust_karma(karma_mod_list, sender, recipient)
+      other = words[1]
+      if self.identity(sender) == self.identity(other):
+         self.bot.say('%s and %s already share their karma' % (sender, other), recipient)
+         return True
+      self.__when_identified(sender, recipient, self.__alias, sender, other, recipient)
+      return True
+
+
+   # Carry out an !alias once the sender is known to own their nick.
+   def __alias(self, sender, other, recipient):
+      mine = KarmaTracker.normalize(sender)
+      theirs = KarmaTracker.normalize(other)
+      if (theirs, mine) not in self.alias_requests:
+         self.alias_requests.add((mine, theirs))
+         self.bot.say('%s: to share karma with %s, say !alias %s' % (other, sender, sender), recipient)
+         return
+
+      karma = self._merge_aliases(mine, theirs)
+      self.bot.say('%s and %s now share %s point%s of karma' % (sender, other, karma, self.plural(karma)), recipient)
+
+
+   # Undo every alias made with a nick, for admins to clear up one made by
+   # mistake or by someone who turned out not to own a nick. Any other
+   # nicks aliased only through it stop sharing karma as well. Karma given
+   # to the group while it was aliased stays with the nick it was counted
+   # under, and so does its trending karma.
+   def unalias_handler(self, msg):
+      words = msg.trail.split()
+      if words[0] != '!unalias':
+         return False
+      sender = msg.getSender()
+      if sender.lower() not in self.admins:
+         return False
+      recipient = msg.params[0]
+      if recipient == self.bot.nick:
+         recipient = sender
+      if len(words) < 2:
+         self.bot.say('Usage: !unalias <nick>', recipient)
          return True
+      self.__when_identified(sender, recipient, self.__unalias, words[1], recipient)
+      return True
+
+
+   def __unalias(self, nick, recipient):
+      nick = KarmaTracker.normalize(nick)
+      members = self.aliases.members(nick)
+      # everything pending goes to the database first, since the
+      # leaderboards are read back from there
+      self.writer.submit(self.__write_karma).result()
+      removed = self.db.nick_aliases.delete_many({'nick': nick}).deleted_count
+      removed += self.db.nick_aliases.delete_many({'alias_of': nick}).deleted_count
+      if removed == 0:
+         self.bot.say('%s has no aliases' % nick, recipient)
+         return
+      self.__load_identities()
+      for member in members:
+         self.karma.forget(member)
+      self.bot.say('%s no longer shares karma with anyone' % nick, recipient)
+
+
+   # Call fn(*args) once NickServ says nick is identified to the nick it is
+   # using, or tell it to identify first if it isn't. The reply comes to
+   # nickserv_handler. Only the latest waiting for each nick is kept, and
+   # for no longer than IDENTIFY_TIMEOUT seconds. Without nickserv set, fn
+   # is called straight away.
+   def __when_identified(self, nick, recipient, fn, *args):
+      if self.nickserv is None:
+         fn(*args)
+         return
+      key = (self.bot.network, nick.lower())
+      self.identify_checks.pop(key)
+      self.identify_checks.add(key, (recipient, fn, args))
+      self.bot.say('%s %s' % (self.nickserv_command, nick), self.nickserv)
+
+
+   # Handle NickServ's answer to __when_identified. Atheme answers ACC with
+   # "nick ACC level" and Anope answers STATUS with "STATUS nick level";
+   # level 3 means identified to that nick.
+   def nickserv_handler(self, msg):
+      if self.nickserv is None or msg.getSender().lower() != self.nickserv.lower():
+         return False
+      words = msg.trail.split()
+      if len(words) >= 3 and words[1] == 'ACC':
+         nick, level = words[0], words[2]
+      elif len(words) >= 3 and words[0] == 'STATUS':
+         nick, level = words[1], words[2]
       else:
          return False
+      waiting = self.identify_checks.pop((self.bot.network, nick.lower()))
+      if waiting is None:
+         return False
+      recipient, fn, args = waiting
+      if level == '3':
+         fn(*args)
+      else:
+         self.bot.say('%s: identify with %s first' % (nick, self.nickserv), recipient)
+      return True
+
+
+   # Record that two nicks belong to the same person, and count the karma of
+   # both towards the merged identity from now on. Only one link is written
+   # to the database; no karma is moved there. Returns the merged karma.
+   def _merge_aliases(self, nick, alias_of):
+      # the karma of the merged identity is read back from the database, so
+      # everything pending has to be there first
+      self.writer.submit(self.__write_karma).result()
+      self.db.nick_aliases.insert_one({'nick': nick, 'alias_of': alias_of})
+      merged = self.aliases.union(nick, alias_of)
+      if merged is None:
+         return self.karma.get(self.identity(nick)) or 0
+      identity, absorbed = merged
+
+      self.karma.forget(identity)
+      self.karma.forget(absorbed)
+      karma = self.karma.get(identity) or 0
+      self.leaderboard.set(absorbed, 0)
+      self.leaderboard.set(identity, karma)
+      with self.leaderboards_lock:
+         leaderboards = list(self.channel_leaderboards.values())
+      for leaderboard in leaderboards:
+         leaderboard.move(absorbed, identity)
+      self.history.move(absorbed, identity)
+      return karma
+
+
+   # Only called for lines the trigger was found in, so there is always
+   # something in the list.
+   def karma_mod_handler(self, msg):
+      karma_mod_list = self.karma_mod_re.findall(msg.trail)
+      self._adjust_karma(karma_mod_list, msg.getSender(), msg.params[0])
+      return True
 
    def cleanup(self):
-      self.print('Waiting for Karma Tracker thread to close...')
-      self.exiting = True
+      self.write_timer.cancel()
+      self.compact_timer.cancel()
+      self.writer.shutdown(wait=True)
+      self.__write_karma()
 
 
    # Given a karma number, return 's' if the karma is plural
@@ -183,3 +1104,58 @@ class KarmaTracker(extension.Extension):
          return ''
       else:
          return 's'
+
+
+   ###
+   ### Constants
+   ###
+
+   # how many nicks !top and !bottom list by default, and at most
+   LEADERBOARD_DEFAULT = 5
+   LEADERBOARD_MAX = 10
+   # seconds between deleting karma history past its retention
+   COMPACT_INTERVAL = 3600
+   # seconds an !alias waits for the other nick to agree, and the most
+   # requests waiting at once
+   ALIAS_REQUEST_TIMEOUT = 600
+   ALIAS_REQUESTS_MAX = 1000
+   # seconds to wait for NickServ to say whether a nick is identified
+   IDENTIFY_TIMEOUT = 30
+
+
+# Merge the documents of a collection that have the same values for fields
+# into the first of them, which is left holding the sum of their karma.
+def merge_duplicates(collection, fields):
+   projection = dict((field, 1) for field in fields)
+   projection['karma'] = 1
+   found = collections.OrderedDict()
+   for doc in collection.find({}, projection):
+      key = tuple(doc.get(field) for field in fields)
+      found.setdefault(key, []).append(doc)
+   for docs in found.values():
+      if len(docs) < 2:
+         continue
+      total = sum(doc.get('karma', 0) for doc in docs)
+      collection.update_one({'_id': docs[0]['_id']}, {'$set': {'karma': total}})
+      collection.delete_many({'_id': {'$in': [doc['_id'] for doc in docs[1:]]}})
+
+
+# Send a list of write requests to a collection in one unordered bulk_write.
+# Returns None if every one was applied. Otherwise returns a tuple of the
+# error and a dictionary mapping the index of each request that certainly
+# wasn't applied to its error code (None if there isn't one). That
+# dictionary is None instead if it can't be told which were applied, as
+# when the connection drops partway.
+def write_unordered(collection, requests):
+   if not requests:
+      return None
+   try:
+      collection.bulk_write(requests, ordered=False)
+   except BulkWriteError as e:
+      return (e, dict((error['index'], error.get('code')) for error in e.details.get('writeErrors', ())))
+   except ServerSelectionTimeoutError as e:
+      # no server could be reached, so nothing was sent
+      return (e, dict((index, None) for index in range(len(requests))))
+   except Exception as e:
+      return (e, None)
+   return None
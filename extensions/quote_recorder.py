@@ -7,6 +7,9 @@
 import re
 import time
 
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
 import irc_message
 import extension
 
@@ -15,6 +18,8 @@ import extension
 
 class QuoteRecorder(extension.Extension):
    name = "Quote Recorder"
+   role = extension.Extension.OBSERVER
+   blocking = True
    db = None
 
    def __init__(self, bot, db, record_isare=True):
@@ -24,6 +29,30 @@ class QuoteRecorder(extension.Extension):
       self.hooks = {
          'PRIVMSG': self.privmsg_handler
       }
+      self.__init_counter()
+
+
+   # Quotes are numbered from 0 with no gaps, since QuoteRetriever picks one
+   # by a random index below the number of quotes. This extension's hooks
+   # may run at the same time as each other, so the next index comes from a
+   # counter document incremented atomically, rather than from counting the
+   # quotes (which two quotes recorded at once could both see the same
+   # result of). The counter starts at the number of quotes recorded before
+   # it existed.
+   def __init_counter(self):
+      try:
+         self.db.counters.update_one({'_id': 'quotes'},
+            {'$setOnInsert': {'count': self.db.quotes.count()}}, upsert=True)
+      except DuplicateKeyError:
+         # another bot created it at the same moment
+         pass
+
+
+   # Take the next quote index.
+   def __next_index(self):
+      counter = self.db.counters.find_one_and_update({'_id': 'quotes'},
+         {'$inc': {'count': 1}}, upsert=True, return_document=ReturnDocument.AFTER)
+      return counter['count'] - 1
 
 
    def privmsg_handler(self, msg):
@@ -35,12 +64,11 @@ class QuoteRecorder(extension.Extension):
          # convert it into sender's name plus the rest of the message
          message = sender + message[7:-1]
 
-      numquotes = self.db.quotes.count()
       newquote = {
          'author': sender,
          'quote': message,
          'tstamp': time.time(),
-         'index': numquotes,
+         'index': self.__next_index(),
       }
 
       if self.record_isare:
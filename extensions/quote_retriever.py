@@ -1,7 +1,7 @@
 """
    Quote retrieving extension.
    Responds to the !quote command and spits out random quotes
-   Hooks: PRIVMSG
+   Commands: !quote
 """
 
 import random
@@ -14,13 +14,16 @@ import extension
 
 class QuoteRetriever(extension.Extension):
    name = "Quote Retriever"
+   blocking = True
+   rate_limit = (5, 60)
+   rate_limit_response = extension.Extension.REPLY_ONCE
    db = None
 
    def __init__(self, bot, db):
       super(QuoteRetriever, self).__init__(bot)
       self.db = db
-      self.hooks = {
-         'PRIVMSG': self.privmsg_handler
+      self.commands = {
+         '!quote': self.privmsg_handler,
       }
 
 
@@ -29,11 +32,8 @@ class QuoteRetriever(extension.Extension):
       if recipient == self.bot.nick:
          recipient = msg.getSender()
 
-      if msg.trail[:6] == '!quote':
-         self._say_random_quote(recipient)
-         return True
-
-      return False
+      self._say_random_quote(recipient)
+      return True
 
 
    # Say a randomly chosen quote from the database.
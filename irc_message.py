@@ -4,50 +4,189 @@
 """
 
 import sys
+import functools
 
 # stop creating .pyc files
 sys.dont_write_bytecode = True
 
+# Encoding tried for text that isn't valid UTF-8, which on IRC is usually
+# from an old client using its local code page.
+FALLBACK_ENCODING = 'cp1252'
+
+
+# Decode bytes received from IRC. Most text is UTF-8 but not all of it, so
+# anything that isn't valid UTF-8 is decoded with the fallback encoding
+# instead, replacing whatever that can't decode either. Never raises.
+def decode(data, fallback=None):
+   try:
+      return str(data, 'utf-8')
+   except UnicodeDecodeError:
+      return str(data, fallback or FALLBACK_ENCODING, 'replace')
+
+
+# Number of distinct prefixes kept parsed; see parse_prefix.
+PREFIX_CACHE_SIZE = 4096
+
+
+class Prefix:
+   # The source of a message, nick!user@host for users or just a name for
+   # servers. For a server, nick is the server name, and user and host are
+   # empty.
+   __slots__ = ('raw', 'nick', 'user', 'host', 'is_server')
+
+   def __init__(self, raw):
+      self.raw = raw
+      nick, bang, rest = raw.partition('!')
+      if bang:
+         user, at, host = rest.partition('@')
+      else:
+         nick, at, host = raw.partition('@')
+         user = ''
+      self.nick = sys.intern(nick)
+      self.user = user
+      self.host = host
+      # a bare name with a dot in it can only be a server, since nicks can't
+      # contain dots
+      self.is_server = not bang and not at and '.' in nick
+
+   def __str__(self):
+      return self.raw
+
+   def __repr__(self):
+      return 'Prefix(%r)' % self.raw
+
+
+# Parse a prefix, given as str or as the bytes received, into a Prefix.
+# The same few hundred users send nearly all the traffic, so the most
+# recently seen prefixes are kept: a repeated prefix costs a single lookup
+# and every message from it shares one Prefix, with an interned nick that is
+# quick to use as a dictionary key.
+@functools.lru_cache(maxsize=PREFIX_CACHE_SIZE)
+def parse_prefix(raw, fallback=None):
+   if not isinstance(raw, str):
+      raw = decode(raw, fallback)
+   return Prefix(raw)
+
+
 class IrcMessage:
-   prefix = ""
-   command = ""
-   params = []
-   trail = ""
+   # Most messages are dropped after looking at their command, so only the
+   # command is parsed up front. The source, params, trail and sender are
+   # parsed the first time they are asked for and then kept; None means not
+   # parsed yet.
+   # A message may be made from a str or from the raw bytes of a line. In
+   # the second case the params and trail are split at the byte level and
+   # only decoded when asked for (see decode), so a line that isn't UTF-8
+   # never raises, and text nobody looks at is never decoded at all.
+   __slots__ = ('line', 'command', '_rest', '_source', '_params', '_trail', '_fallback')
 
    # Constructor takes a line verbatim from an IRC server, which is then parsed
-   # into the correct components. 
-   def __init__(self, line):
+   # into the correct components. fallback_encoding is used for decoding
+   # bytes that aren't UTF-8, defaulting to FALLBACK_ENCODING.
+   def __init__(self, line, fallback_encoding=None):
       # IRC lines are broken into [:<prefix>] <command> [ <param> ... ] :<trail>
+      self.line = line
+      self._fallback = fallback_encoding
+      if isinstance(line, str):
+         space = ' '
+         colon = ':'
+      else:
+         space = b' '
+         colon = b':'
 
-      # get prefix
-      if line[0] == ':':
-         prefixStart = 1
-         prefixEnd = line.find(" ")
-         if prefixEnd == -1:
-            raise ValueError('Could not find end of prefix in line ' + line)
+      # skip the prefix
+      if line[:1] == colon:
+         start = line.find(space)
+         if start == -1:
+            raise ValueError('Could not find end of prefix in line ' + self.__text())
       else:
-         prefixStart = 0
-         prefixEnd = 0
-      self.prefix = line[prefixStart:prefixEnd]
-
-      # get trail, which is unique in that it is the first part of the line
-      # to begin with " :"
-      trailStart = line.find(" :")
-      if trailStart >= 0:
-         commandEnd = trailStart
-         trailStart += 2
+         start = 0
+
+      # the command is the first word after the prefix, unless the trail
+      # starts first
+      length = len(line)
+      while start < length and line[start:start + 1] == space:
+         start += 1
+      if start == length or line[start:start + 1] == colon:
+         raise ValueError('Could not find a command in line ' + self.__text())
+      end = line.find(space, start)
+      if end == -1:
+         end = length
+      command = line[start:end]
+      # commands are always ASCII
+      self.command = command if space == ' ' else str(command, 'latin-1')
+      # where the params start
+      self._rest = end
+
+      self._source = None
+      self._params = None
+      self._trail = None
+
+
+   # The prefix, parsed into a Prefix (see parse_prefix).
+   @property
+   def source(self):
+      if self._source is None:
+         line = self.line
+         if isinstance(line, str):
+            raw = line[1:line.find(' ')] if line[0] == ':' else ''
+         else:
+            raw = line[1:line.find(b' ')] if line[:1] == b':' else ''
+         self._source = parse_prefix(raw, self._fallback)
+      return self._source
+
+
+   @property
+   def prefix(self):
+      return self.source.raw
+
+
+   @property
+   def params(self):
+      if self._params is None:
+         self.__parse_params()
+      return self._params
+
+
+   @property
+   def trail(self):
+      trail = self._trail
+      if trail is None:
+         self.__parse_params()
+         trail = self._trail
+      if not isinstance(trail, str):
+         trail = decode(trail, self._fallback)
+         self._trail = trail
+      return trail
+
+
+   # Parse the params and trail, which is unique in that it is the first part
+   # of the line to begin with " :". The trail of a bytes line is kept as
+   # bytes until it is asked for.
+   def __parse_params(self):
+      line = self.line
+      if isinstance(line, str):
+         trailStart = line.find(' :', self._rest)
+         if trailStart >= 0:
+            self._trail = line[trailStart + 2:]
+            self._params = line[self._rest:trailStart].split()
+         else:
+            self._trail = ''
+            self._params = line[self._rest:].split()
       else:
-         commandEnd = len(line)
-         trailStart = len(line)
-      self.trail = line[trailStart:]
+         trailStart = line.find(b' :', self._rest)
+         if trailStart >= 0:
+            self._trail = line[trailStart + 2:]
+            params = line[self._rest:trailStart].split()
+         else:
+            self._trail = ''
+            params = line[self._rest:].split()
+         self._params = [decode(p, self._fallback) for p in params]
+
 
-      # command and params are between the prefix and trail
-      commandStart = prefixEnd+1 if prefixEnd > 0 else 0
-      commandList = line[commandStart:commandEnd].split();
-      if len(commandList) < 1:
-         raise ValueError('Could not find a command in line ' + line)
-      self.command = commandList[0]
-      self.params = commandList[1:]
+   # The whole line as text, for error messages.
+   def __text(self):
+      line = self.line
+      return line if isinstance(line, str) else decode(line, self._fallback)
 
 
    # String conversion
@@ -56,16 +195,137 @@ class IrcMessage:
       return string_form % (self.prefix, self.command, " ".join(self.params), self.trail)
 
 
+   # Multi-line form used by print and for logging
+   def pretty_str(self):
+      return '\n'.join([
+         '   PREFIX: "%s"' % self.prefix,
+         '   COMMAND: "%s"' % self.command,
+         '   PARAMS: "%s"' % ', '.join(self.params),
+         '   TRAIL: "%s"' % self.trail,
+      ])
+
+
    # Printer
    def print(self):
-      print('   PREFIX: "%s"' % self.prefix)
-      print('   COMMAND: "%s"' % self.command)
-      print('   PARAMS: "%s"' % ', '.join(self.params))
-      print('   TRAIL: "%s"' % self.trail)
+      print(self.pretty_str())
 
 
    # If the prefix is user!~server.com or similar, gets "user" from it
    def getSender(self):
-      return self.prefix.split('!')[0]
+      return self.source.nick
+
 
+# Split raw input into lines: a bytes-like buffer of server output is split
+# on newlines in one go, leaving any \r for the caller to strip; anything else
+# is taken to be an iterable of lines already, str or bytes.
+def _split_lines(data):
+   if isinstance(data, bytes):
+      return data.split(b'\n')
+   if isinstance(data, (bytearray, memoryview)):
+      return bytes(data).split(b'\n')
+   return data
+
+
+# Parse many lines at once, for replaying logs and other bulk work, and for
+# the bot to parse everything one read from the server produced. data is a
+# bytes-like buffer of raw server output or an iterable of lines, with or
+# without their line endings. Returns a list of IrcMessages; those made from
+# bytes decode their text lazily, using fallback_encoding as IrcMessage does.
+# If commands is given, lines with other commands are skipped before a
+# message is even built for them. Empty lines are skipped, as are lines that
+# can't be parsed, after being passed to on_error along with the ValueError if
+# on_error is given.
+def parse_lines(data, commands=None, on_error=None, fallback_encoding=None):
+   new = IrcMessage.__new__
+   messages = []
+   for line in _split_lines(data):
+      if not line:
+         continue
+      if isinstance(line, str):
+         space, colon, newlines = ' ', ':', '\r\n'
+      else:
+         space, colon, newlines = b' ', b':', b'\r\n'
+      if line[-1:] in newlines:
+         line = line.rstrip(newlines)
+         if not line:
+            continue
+
+      # the common case of single spaces is handled inline; anything else
+      # goes through the constructor
+      prefixed = line[:1] == colon
+      start = line.find(space) + 1 if prefixed else 0
+      end = line.find(space, start)
+      if end < 0:
+         end = len(line)
+      command = line[start:end]
+      if prefixed and start == 0 or not command or command[:1] == colon:
+         try:
+            msg = IrcMessage(line, fallback_encoding)
+         except ValueError as e:
+            if on_error is not None:
+               on_error(line, e)
+            continue
+         if commands is None or msg.command in commands:
+            messages.append(msg)
+         continue
+
+      if space != ' ':
+         command = str(command, 'latin-1')
+      if commands is not None and command not in commands:
+         continue
+      msg = new(IrcMessage)
+      msg.line = line
+      msg.command = command
+      msg._rest = end
+      msg._source = None
+      msg._params = None
+      msg._trail = None
+      msg._fallback = fallback_encoding
+      messages.append(msg)
+   return messages
+
+
+# Like parse_lines, but parses every field right away into columns instead of
+# building messages. Returns a tuple of four lists, (prefixes, commands,
+# params, trails), with one entry per line parsed; each params entry is a
+# list. Lines given as bytes are decoded whole, as decode does.
+def parse_columns(data, commands=None, on_error=None, fallback_encoding=None):
+   prefixes = []
+   command_list = []
+   params = []
+   trails = []
+   for line in _split_lines(data):
+      if not line:
+         continue
+      if not isinstance(line, str):
+         line = decode(line, fallback_encoding)
+      if line[-1] in '\r\n':
+         line = line.rstrip('\r\n')
+         if not line:
+            continue
+
+      if line[0] == ':':
+         prefix, space, rest = line.partition(' ')
+         prefix = prefix[1:]
+      else:
+         prefix = ''
+         space = True
+         rest = line
+      # a trail straight after the prefix means there is no command
+      head, colon, trail = rest.partition(' :') if rest[:1] != ':' else ('', '', '')
+      words = head.split()
+      if not space or not words:
+         if on_error is not None:
+            if not space:
+               on_error(line, ValueError('Could not find end of prefix in line ' + line))
+            else:
+               on_error(line, ValueError('Could not find a command in line ' + line))
+         continue
+      if commands is not None and words[0] not in commands:
+         continue
 
+      prefixes.append(prefix)
+      command_list.append(words[0])
+      params.append(words[1:])
+      trails.append(trail)
+   return (prefixes, command_list, params, trails)
@@ -0,0 +1,123 @@
+"""
+   Line buffer module. Contains the LineBuffer class, which frames the raw
+   byte stream coming from an IRC server into complete lines.
+"""
+
+import sys
+import collections
+
+# stop creating .pyc files
+sys.dont_write_bytecode = True
+
+class LineBuffer:
+
+   # Maximum size the buffer is allowed to grow to when a single line does not
+   # fit. IRC lines are limited to 512 bytes (8191 more with message tags), so
+   # anything this large means the server is sending garbage.
+   MAX_BUFFER_SIZE = 1 << 20
+
+   def __init__(self, sock, bufsize=65536):
+      self.sock = sock
+      # One reusable receive buffer. Data between start and end has been
+      # received but not yet split into lines; scan marks how far we have
+      # already searched for a newline so no byte is searched twice.
+      self.buf = bytearray(bufsize)
+      self.view = memoryview(self.buf)
+      self.start = 0
+      self.end = 0
+      self.scan = 0
+      # complete lines waiting to be consumed, without their \r\n
+      self.lines = collections.deque()
+      self.eof = False
+
+
+   # Whether any complete lines are waiting. These can be consumed with
+   # get_line without touching the socket.
+   def has_line(self):
+      return len(self.lines) > 0
+
+
+   # Do one large read from the socket and queue up every complete line in it.
+   # Returns the number of bytes read; 0 means the connection was closed, in
+   # which case any trailing partial line is queued as a final line.
+   def fill(self):
+      if self.eof:
+         return 0
+      self.__make_room()
+      nbytes = self.sock.recv_into(self.view[self.end:])
+      if nbytes == 0:
+         self.eof = True
+         if self.end > self.start:
+            self.__push_line(self.start, self.end)
+         self.start = self.end = self.scan = 0
+         return 0
+
+      self.end += nbytes
+      self.__split_lines()
+      return nbytes
+
+
+   # Get the next complete line as bytes, reading from the socket as many
+   # times as necessary. Raises an EOFError if the connection closes before a
+   # line is available.
+   def get_line(self):
+      while not self.lines:
+         if self.eof:
+            raise EOFError('Connection closed unexpectedly')
+         self.fill()
+      return self.lines.popleft()
+
+
+   # Take every complete line waiting, as a list of bytes, without touching
+   # the socket.
+   def get_lines(self):
+      lines = list(self.lines)
+      self.lines.clear()
+      return lines
+
+
+   # Split everything between scan and end into lines, leaving any trailing
+   # partial line in the buffer for the next fill.
+   def __split_lines(self):
+      buf = self.buf
+      start = self.start
+      pos = buf.find(b'\n', self.scan, self.end)
+      while pos >= 0:
+         self.__push_line(start, pos)
+         start = pos + 1
+         pos = buf.find(b'\n', start, self.end)
+
+      if start == self.end:
+         # everything was consumed, rewind to the front of the buffer
+         self.start = self.end = self.scan = 0
+      else:
+         self.start = start
+         self.scan = self.end
+
+
+   # Queue the bytes between start and stop as a line, minus any trailing \r.
+   # Empty lines are silently ignored, as the IRC protocol asks.
+   def __push_line(self, start, stop):
+      if stop > start and self.buf[stop - 1] == 0x0D:
+         stop -= 1
+      if stop > start:
+         self.lines.append(bytes(self.view[start:stop]))
+
+
+   # Make sure there is free space at the end of the buffer, first by moving a
+   # partial line to the front and only then by growing the buffer.
+   def __make_room(self):
+      if self.end < len(self.buf):
+         return
+      pending = self.end - self.start
+      if self.start > 0:
+         self.view[:pending] = self.view[self.start:self.end]
+         self.scan -= self.start
+         self.start = 0
+         self.end = pending
+      else:
+         if len(self.buf) * 2 > LineBuffer.MAX_BUFFER_SIZE:
+            raise ValueError('Received line longer than %d bytes' % len(self.buf))
+         self.view.release()
+         self.buf.extend(bytes(len(self.buf)))
+         self.view = memoryview(self.buf)
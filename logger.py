@@ -0,0 +1,222 @@
+"""
+   Logger module. Contains the Logger class, which takes output from the bot,
+   its extensions and received messages off the receive loop: records are
+   queued and formatted and written by a background thread, so a slow
+   terminal or pipe never holds up the bot.
+"""
+
+import sys
+import os
+import time
+import queue
+import threading
+import traceback
+
+# stop creating .pyc files
+sys.dont_write_bytecode = True
+
+class StreamSink:
+
+   # Write to an open text stream, like sys.stdout. Lines are written as they
+   # are, with no timestamp, so console output looks like plain print.
+   def __init__(self, stream=None, timestamps=False):
+      self.stream = stream if stream is not None else sys.stdout
+      self.timestamps = timestamps
+
+   def write(self, when, text):
+      if self.timestamps:
+         text = Logger.timestamp(when) + text
+      self.stream.write(text + '\n')
+
+   def flush(self):
+      self.stream.flush()
+
+   def close(self):
+      self.flush()
+
+
+class FileSink:
+
+   # Append to a file, with a timestamp on every line.
+   def __init__(self, path):
+      self.path = path
+      self.file = open(path, 'a', encoding='utf-8')
+
+   def write(self, when, text):
+      self.file.write(Logger.timestamp(when) + text + '\n')
+
+   def flush(self):
+      self.file.flush()
+
+   def close(self):
+      self.file.close()
+
+
+class RotatingFileSink(FileSink):
+
+   # Append to a file, moving it to path.1 (and path.1 to path.2, and so on,
+   # keeping backup_count old files) once it grows past max_bytes.
+   def __init__(self, path, max_bytes=10 * 1024 * 1024, backup_count=5):
+      super(RotatingFileSink, self).__init__(path)
+      self.max_bytes = max_bytes
+      self.backup_count = backup_count
+      self.size = self.file.tell()
+
+   def write(self, when, text):
+      line = Logger.timestamp(when) + text + '\n'
+      if self.size + len(line) > self.max_bytes and self.size > 0:
+         self.__rotate()
+      self.file.write(line)
+      self.size += len(line)
+
+   def __rotate(self):
+      self.file.close()
+      for i in range(self.backup_count - 1, 0, -1):
+         older = '%s.%d' % (self.path, i)
+         if os.path.exists(older):
+            os.replace(older, '%s.%d' % (self.path, i + 1))
+      if self.backup_count > 0:
+         os.replace(self.path, self.path + '.1')
+      self.file = open(self.path, 'w', encoding='utf-8')
+      self.size = 0
+
+
+class Logger:
+
+   def __init__(self, level=1, sinks=None, queue_size=10000):
+      # Records at or below this level are written; higher ones are dropped
+      # before any formatting happens.
+      self.level = level
+      self.sinks = sinks if sinks is not None else [StreamSink()]
+      # Records waiting for the writer thread. When it is full new records
+      # are dropped and counted rather than making the caller wait.
+      self.records = queue.Queue(queue_size)
+      self.dropped = 0
+      self.reported_dropped = 0
+      self.writer = threading.Thread(None, self.__write_records, 'logger')
+      self.writer.daemon = True
+      self.writer.start()
+
+
+   # Whether records at a level would be written. Lets callers skip building
+   # expensive arguments.
+   def enabled(self, level):
+      return level <= self.level
+
+
+   # Log the arguments at a level, joined with spaces like print. They are
+   # only converted to strings on the writer thread.
+   def log(self, level, *args):
+      if level > self.level:
+         return
+      self.__put((time.time(), Logger.__format_args, args))
+
+
+   # Log the arguments and the exception currently being handled, with its
+   # traceback. Always written.
+   def exception(self, *args):
+      self.__put((time.time(), Logger.__format_exception, (args, sys.exc_info())))
+
+
+   # Log a received IrcMessage under a header line, as IrcMessage.print does.
+   def message(self, level, header, msg):
+      if level > self.level:
+         return
+      self.__put((time.time(), Logger.__format_message, (header, msg)))
+
+
+   # Add another place for records to go.
+   def add_sink(self, sink):
+      self.sinks = self.sinks + [sink]
+
+
+   # Write everything still queued, then stop the writer and close the sinks.
+   def close(self):
+      if self.writer is None:
+         return
+      self.records.put((0, None, None))
+      self.writer.join()
+      self.writer = None
+      for sink in self.sinks:
+         sink.close()
+
+
+   def __put(self, record):
+      try:
+         self.records.put_nowait(record)
+      except queue.Full:
+         self.dropped += 1
+
+
+   def __write_records(self):
+      while True:
+         record = self.records.get()
+         while record is not None:
+            when, formatter, data = record
+            if formatter is None:
+               self.__flush_sinks()
+               return
+            self.__write(when, formatter(data))
+            # keep going without flushing while more records are waiting
+            try:
+               record = self.records.get_nowait()
+            except queue.Empty:
+               record = None
+
+         if self.dropped != self.reported_dropped:
+            count = self.dropped - self.reported_dropped
+            self.reported_dropped = self.dropped
+            self.__write(time.time(), '(%d log records dropped)' % count)
+         self.__flush_sinks()
+
+
+   def __write(self, when, text):
+      for sink in self.sinks:
+         try:
+            sink.write(when, text)
+         except Exception as e:
+            sys.stderr.write('Log sink failed: %s\n' % e)
+
+
+   def __flush_sinks(self):
+      for sink in self.sinks:
+         try:
+            sink.flush()
+         except Exception as e:
+            sys.stderr.write('Log sink failed: %s\n' % e)
+
+
+   @staticmethod
+   def __format_args(args):
+      return ' '.join(str(arg) for arg in args)
+
+   @staticmethod
+   def __format_exception(data):
+      args, exc_info = data
+      text = ' '.join(str(arg) for arg in args)
+      return text + '\n' + ''.join(traceback.format_exception(*exc_info)).rstrip('\n')
+
+   @staticmethod
+   def __format_message(data):
+      header, msg = data
+      return header + '\n' + msg.pretty_str()
+
+
+   # Format a time for the start of a log line.
+   @staticmethod
+   def timestamp(when):
+      return time.strftime('%Y-%m-%d %H:%M:%S ', time.localtime(when))
+
+
+   ###
+   ### Levels, matching Bot's message_print_level values
+   ###
+
+   # bot and extension output, always written
+   INFO = 0
+   # received messages that nothing handled
+   UNHANDLED = 1
+   # received messages that were handled but fell through
+   FALL_THROUGH = 2
+   # all received messages
+   ALL = 3
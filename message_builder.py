@@ -0,0 +1,92 @@
+"""
+   Message builder module. Contains the MessageBuilder class, which turns
+   text the bot wants to say into encoded lines ready for the send queue.
+"""
+
+import sys
+
+# stop creating .pyc files
+sys.dont_write_bytecode = True
+
+class MessageBuilder:
+
+   def __init__(self, max_line=512, reserve=100, cache_size=1024):
+      # IRC lines are at most max_line bytes including the \r\n. The server
+      # relays our messages with our nick!user@host in front of them and that
+      # has to fit too, so reserve bytes are kept free for it.
+      self.max_line = max_line
+      self.reserve = reserve
+      # maps (command, target) to the encoded start of a line, like
+      # b'PRIVMSG #channel :'; cleared whenever it reaches cache_size
+      self.cache_size = cache_size
+      self.prefixes = {}
+
+
+   # Return the encoded lines, each including its \r\n, that say text to
+   # target. Text too long for one line is split over several, at a space if
+   # there is one near the end and otherwise between UTF-8 characters. Each
+   # line of a multi-line text is sent separately, so the text can never
+   # smuggle in a command of its own.
+   def privmsg(self, target, text):
+      return self.build('PRIVMSG', target, text)
+
+
+   def notice(self, target, text):
+      return self.build('NOTICE', target, text)
+
+
+   def build(self, command, target, text):
+      key = (command, target)
+      prefix = self.prefixes.get(key)
+      if prefix is None:
+         if len(self.prefixes) >= self.cache_size:
+            self.prefixes.clear()
+         prefix = ('%s %s :' % (command, target)).encode('utf-8')
+         self.prefixes[key] = prefix
+
+      room = max(MessageBuilder.MIN_ROOM, self.max_line - self.reserve - len(prefix) - 2)
+      if '\n' in text or '\r' in text:
+         bodies = [line.encode('utf-8') for line in text.splitlines() if line]
+      else:
+         bodies = [text.encode('utf-8')]
+
+      lines = []
+      for body in bodies:
+         if len(body) <= room:
+            lines.append(prefix + body + b'\r\n')
+         else:
+            for chunk in MessageBuilder.split(body, room):
+               lines.append(prefix + chunk + b'\r\n')
+      return lines
+
+
+   # Split encoded text into pieces of at most size bytes, never in the middle
+   # of a UTF-8 character.
+   @staticmethod
+   def split(data, size):
+      chunks = []
+      start = 0
+      while len(data) - start > size:
+         cut = start + size
+         # break at the last space, unless that would waste most of the line
+         space = data.rfind(b' ', start + size // 2, cut + 1)
+         if space > start:
+            chunks.append(data[start:space])
+            start = space + 1
+            continue
+         # back up over UTF-8 continuation bytes
+         while cut > start and (data[cut] & 0xC0) == 0x80:
+            cut -= 1
+         if cut == start:
+            # not UTF-8 after all
+            cut = start + size
+         chunks.append(data[start:cut])
+         start = cut
+      if start < len(data):
+         chunks.append(data[start:])
+      return chunks
+
+
+   # smallest number of bytes of text allowed on a line, however long the
+   # target is
+   MIN_ROOM = 64
@@ -0,0 +1,218 @@
+"""
+   Metrics module. Contains the Metrics registry the bot uses to count and
+   time everything it does, and an optional HTTP endpoint serving it in the
+   Prometheus text format.
+"""
+
+import sys
+import time
+import bisect
+import threading
+import http.server
+
+# stop creating .pyc files
+sys.dont_write_bytecode = True
+
+class Histogram:
+
+   # Upper bounds of the latency buckets, in seconds.
+   BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+             0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+   def __init__(self):
+      # one count per bucket, plus one for anything over the last bound
+      self.counts = [0] * (len(Histogram.BOUNDS) + 1)
+      self.count = 0
+      self.sum = 0.0
+
+
+   def observe(self, value):
+      self.counts[bisect.bisect_left(Histogram.BOUNDS, value)] += 1
+      self.count += 1
+      self.sum += value
+
+
+   # Estimate a quantile (0 to 1) from the buckets, as the upper bound of the
+   # bucket it falls in.
+   def quantile(self, q):
+      if self.count == 0:
+         return 0.0
+      rank = q * self.count
+      seen = 0
+      for i, count in enumerate(self.counts):
+         seen += count
+         if seen >= rank:
+            return Histogram.BOUNDS[i] if i < len(Histogram.BOUNDS) else float('inf')
+      return float('inf')
+
+
+class HookStats:
+
+   def __init__(self, ext_name, command):
+      self.ext_name = ext_name
+      self.command = command
+      self.calls = 0
+      self.halts = 0
+      self.fall_throughs = 0
+      self.errors = 0
+      self.latency = Histogram()
+
+
+class Metrics:
+
+   def __init__(self):
+      # maps (extension name, command) to its HookStats
+      self.hooks = {}
+      self.lines_in = 0
+      self.bytes_in = 0
+      self.start_time = time.monotonic()
+      # for the line rate since the last report
+      self.last_report_time = self.start_time
+      self.last_report_lines = 0
+      # maps gauge names to tuples of (Prometheus type, function returning the
+      # current value)
+      self.gauges = {}
+      self.lock = threading.Lock()
+      self.server = None
+
+
+   # Get the HookStats for an extension's hook, creating it if needed. The
+   # bot looks these up once when building its dispatch index, so recording
+   # a call doesn't need a dictionary lookup.
+   def hook_stats(self, ext_name, command):
+      key = (ext_name, command)
+      with self.lock:
+         stats = self.hooks.get(key)
+         if stats is None:
+            stats = HookStats(ext_name, command)
+            self.hooks[key] = stats
+      return stats
+
+
+   # Record one call of a hook: its return value (True for a halt, False for
+   # a fall-through), how long it took, and whether it raised.
+   def record(self, stats, retn, elapsed, error=False):
+      with self.lock:
+         stats.calls += 1
+         if error:
+            stats.errors += 1
+         elif retn == True:
+            stats.halts += 1
+         elif retn == False:
+            stats.fall_throughs += 1
+         stats.latency.observe(elapsed)
+
+
+   # Record lines received from the server.
+   def record_line(self, count=1):
+      self.lines_in += count
+
+
+   # Add a gauge, whose value is read from fn whenever metrics are shown.
+   # kind may be 'counter' for values that only ever go up.
+   def add_gauge(self, name, fn, kind='gauge'):
+      self.gauges[name] = (kind, fn)
+
+
+   # Return a human readable summary, for the console.
+   def report(self):
+      now = time.monotonic()
+      uptime = now - self.start_time
+      interval = now - self.last_report_time
+      recent_rate = (self.lines_in - self.last_report_lines) / interval if interval > 0 else 0.0
+      self.last_report_time = now
+      self.last_report_lines = self.lines_in
+
+      lines = [
+         'Uptime %.0fs, %d lines received (%.1f/s overall, %.1f/s since last report), %d bytes in' % (
+            uptime, self.lines_in, self.lines_in / uptime if uptime > 0 else 0.0, recent_rate, self.bytes_in),
+      ]
+      for name, (kind, fn) in sorted(self.gauges.items()):
+         lines.append('%s: %s' % (name, fn()))
+
+      lines.append('%-20s %-8s %8s %8s %8s %6s %9s %9s %9s' % (
+         'extension', 'command', 'calls', 'halts', 'through', 'errors', 'mean ms', 'p50 ms', 'p99 ms'))
+      with self.lock:
+         hooks = sorted(self.hooks.values(), key=lambda s: -s.latency.sum)
+         for s in hooks:
+            if s.calls == 0:
+               continue
+            lines.append('%-20s %-8s %8d %8d %8d %6d %9.3f %9.3f %9.3f' % (
+               s.ext_name[:20], s.command[:8], s.calls, s.halts, s.fall_throughs, s.errors,
+               1000 * s.latency.sum / s.latency.count,
+               1000 * s.latency.quantile(0.5), 1000 * s.latency.quantile(0.99)))
+      return '\n'.join(lines)
+
+
+   # Return everything in the Prometheus text exposition format.
+   def prometheus(self):
+      out = []
+      out.append('# TYPE knob_lines_received_total counter')
+      out.append('knob_lines_received_total %d' % self.lines_in)
+      out.append('# TYPE knob_bytes_received_total counter')
+      out.append('knob_bytes_received_total %d' % self.bytes_in)
+      for name, (kind, fn) in sorted(self.gauges.items()):
+         out.append('# TYPE knob_%s %s' % (name, kind))
+         out.append('knob_%s %s' % (name, fn()))
+
+      with self.lock:
+         hooks = list(self.hooks.values())
+         out.append('# TYPE knob_hook_calls_total counter')
+         for s in hooks:
+            labels = Metrics.__labels(s)
+            out.append('knob_hook_calls_total{%s,result="halt"} %d' % (labels, s.halts))
+            out.append('knob_hook_calls_total{%s,result="fall_through"} %d' % (labels, s.fall_throughs))
+            out.append('knob_hook_calls_total{%s,result="error"} %d' % (labels, s.errors))
+            out.append('knob_hook_calls_total{%s,result="none"} %d' % (
+               labels, s.calls - s.halts - s.fall_throughs - s.errors))
+         out.append('# TYPE knob_hook_latency_seconds histogram')
+         for s in hooks:
+            labels = Metrics.__labels(s)
+            cumulative = 0
+            for bound, count in zip(Histogram.BOUNDS, s.latency.counts):
+               cumulative += count
+               out.append('knob_hook_latency_seconds_bucket{%s,le="%g"} %d' % (labels, bound, cumulative))
+            out.append('knob_hook_latency_seconds_bucket{%s,le="+Inf"} %d' % (labels, s.latency.count))
+            out.append('knob_hook_latency_seconds_sum{%s} %f' % (labels, s.latency.sum))
+            out.append('knob_hook_latency_seconds_count{%s} %d' % (labels, s.latency.count))
+      return '\n'.join(out) + '\n'
+
+
+   # Serve the Prometheus text on http://host:port/metrics from a background
+   # thread.
+   def serve(self, port, host='127.0.0.1'):
+      metrics = self
+
+      class Handler(http.server.BaseHTTPRequestHandler):
+         def do_GET(self):
+            if self.path != '/metrics':
+               self.send_error(404)
+               return
+            body = metrics.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+         # keep request logging off the console
+         def log_message(self, format, *args):
+            pass
+
+      self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+      thread = threading.Thread(None, self.server.serve_forever, 'metrics')
+      thread.daemon = True
+      thread.start()
+
+
+   def shutdown(self):
+      if self.server is not None:
+         self.server.shutdown()
+         self.server.server_close()
+         self.server = None
+
+
+   @staticmethod
+   def __labels(stats):
+      ext_name = stats.ext_name.replace('\\', '\\\\').replace('"', '\\"')
+      return 'extension="%s",command="%s"' % (ext_name, stats.command)
@@ -0,0 +1,282 @@
+"""
+   Network loop module. Contains the NetworkLoop class, which runs several
+   connected bots, usually on different networks, on a single event loop.
+"""
+
+import sys
+import selectors
+
+# stop creating .pyc files
+sys.dont_write_bytecode = True
+
+class Reconnection:
+
+   # A bot reconnecting in the background: how many attempts it has made,
+   # the most the next may wait, and the timer for the next attempt or for
+   # giving up on the one in progress. sock is the socket of the attempt in
+   # progress, if any, and welcoming whether it has connected and is
+   # waiting for the server to welcome the bot.
+   def __init__(self, name, bot):
+      self.name = name
+      self.bot = bot
+      self.attempt = 0
+      self.delay = 0
+      self.timer = None
+      self.sock = None
+      self.welcoming = False
+
+
+class NetworkLoop:
+
+   def __init__(self):
+      self.selector = selectors.DefaultSelector()
+      # maps network names to the bots still connected, in the order they
+      # were added
+      self.bots = {}
+      # maps network names to the Reconnections of bots whose connections
+      # dropped, while they reconnect
+      self.reconnecting = {}
+      # every bot ever added, for cleanup, and whose timers keep running
+      # until then; see interact
+      self.added = []
+
+
+   # Add a bot that has already connected. The name identifies the network
+   # on the console. Each bot keeps its own nick, hooks and extensions, but
+   # extensions (and whatever database clients they hold) may be shared
+   # between bots by passing the same instances to set_extensions.
+   def add_bot(self, name, bot):
+      if name in self.bots or name in self.reconnecting:
+         raise ValueError('A network named %s has already been added' % name)
+      self.bots[name] = bot
+      self.added.append(bot)
+      self.selector.register(bot.sock, selectors.EVENT_READ, bot)
+      bot._start_interacting()
+
+
+   # Stop watching a bot, without closing its connection.
+   def remove_bot(self, name):
+      bot = self.bots.pop(name)
+      self.selector.unregister(bot.sock)
+
+
+   # Interact with every network until the user quits or all the
+   # connections have closed for good.
+   def interact(self):
+      try:
+         self.selector.register(sys.stdin, selectors.EVENT_READ, None)
+      except (ValueError, OSError):
+         self.__log('Warning: console input is unavailable')
+
+      while self.bots or self.reconnecting:
+         timeout = self.__update_events()
+         events = self.selector.select(timeout)
+         # The timers of every bot added run until cleanup, whether it is
+         # connected, reconnecting (they drive that) or gone for good. An
+         # extension shared between bots sets its timers on the bot it was
+         # created with, and they go on serving the others after that bot
+         # has left.
+         for bot in self.added:
+            bot._run_timers()
+         for bot in list(self.bots.values()):
+            if not bot._flush_sends():
+               self.__connection_lost(bot)
+         for reconnection in list(self.reconnecting.values()):
+            if reconnection.welcoming and not reconnection.bot._flush_sends():
+               self.__attempt_failed(reconnection, reconnection.bot.connection_error)
+
+         for key, mask in events:
+            bot = key.data
+            if bot is None:
+               user_input = sys.stdin.readline().rstrip('\n').split()
+               if not self._console_command(user_input):
+                  return
+            elif isinstance(bot, Reconnection):
+               self.__reconnect_event(bot, key.fileobj)
+            elif mask & selectors.EVENT_READ and self.__name_of(bot) is not None:
+               # (unless its connection was lost earlier in this pass)
+               if not bot._on_readable():
+                  self.__connection_lost(bot)
+
+
+   # Stop watching a bot whose connection dropped or failed, and reconnect
+   # it if it should be. Only that bot is affected; the others carry on.
+   def __connection_lost(self, bot):
+      name = self.__name_of(bot)
+      bot._log_connection_lost(name)
+      self.remove_bot(name)
+      if bot.reconnect_enabled:
+         self.__reconnect(name, bot)
+
+
+   # Start reconnecting a bot whose connection dropped. The attempts are made
+   # without waiting on the server, from the bot's timers and the events on
+   # its new socket, so the other networks carry on meanwhile.
+   def __reconnect(self, name, bot):
+      bot._disconnected()
+      reconnection = Reconnection(name, bot)
+      self.reconnecting[name] = reconnection
+      reconnection.delay = bot._first_reconnect_delay()
+      if reconnection.delay > 0:
+         reconnection.timer = bot.call_later(bot._reconnect_wait(reconnection.delay), self.__attempt, reconnection)
+      else:
+         self.__attempt(reconnection)
+
+
+   # Make the next reconnection attempt, unless the bot has run out of them.
+   def __attempt(self, reconnection):
+      bot = reconnection.bot
+      reconnection.timer = None
+      if not bot._may_reconnect(reconnection.attempt):
+         self.__give_up(reconnection)
+         return
+      reconnection.attempt += 1
+      bot.log('Reconnecting to %s (attempt %d)' % (bot.server, reconnection.attempt))
+      try:
+         reconnection.sock = bot._start_connect()
+      except OSError as e:
+         self.__attempt_failed(reconnection, e)
+         return
+      self.selector.register(reconnection.sock, selectors.EVENT_WRITE, reconnection)
+      reconnection.timer = bot.call_later(NetworkLoop.WELCOME_TIMEOUT, self.__attempt_failed,
+         reconnection, 'no welcome from the server after %ss' % NetworkLoop.WELCOME_TIMEOUT)
+
+
+   # Handle an event on the socket of a reconnection attempt: the connection
+   # being made, or the server sending something before it welcomes the bot.
+   # Once it has, the bot goes back to being dispatched like the others.
+   def __reconnect_event(self, reconnection, sock):
+      if reconnection.sock is not sock:
+         # the attempt was given up on earlier in this pass
+         return
+      bot = reconnection.bot
+      try:
+         if not reconnection.welcoming:
+            bot._finish_connect()
+            reconnection.welcoming = True
+            self.selector.modify(sock, selectors.EVENT_READ, reconnection)
+            return
+         if not bot._read_welcome():
+            return
+      except (OSError, EOFError, ValueError) as e:
+         self.__attempt_failed(reconnection, e)
+         return
+
+      reconnection.timer.cancel()
+      del self.reconnecting[reconnection.name]
+      self.bots[reconnection.name] = bot
+      self.selector.modify(sock, selectors.EVENT_READ, bot)
+      bot.reconnect_delay = reconnection.delay
+      bot._reconnected()
+
+
+   # Give up on a reconnection attempt, and set a timer for the next if the
+   # bot has any left.
+   def __attempt_failed(self, reconnection, reason):
+      bot = reconnection.bot
+      bot.log('Reconnect failed:', reason)
+      if reconnection.timer is not None:
+         reconnection.timer.cancel()
+      if reconnection.sock is not None:
+         self.selector.unregister(reconnection.sock)
+         reconnection.sock.close()
+         reconnection.sock = None
+      reconnection.welcoming = False
+      if not bot._may_reconnect(reconnection.attempt):
+         self.__give_up(reconnection)
+         return
+      reconnection.delay = bot._next_reconnect_delay(reconnection.delay)
+      reconnection.timer = bot.call_later(bot._reconnect_wait(reconnection.delay), self.__attempt, reconnection)
+
+
+   def __give_up(self, reconnection):
+      reconnection.bot.log('Giving up on reconnecting to', reconnection.bot.server)
+      del self.reconnecting[reconnection.name]
+
+
+   # Run a command typed by the user on the console. A command starting with
+   # a network name goes to that network's bot; quit goes to every bot, and
+   # anything else to the first bot added. Returns False if the loop should
+   # stop.
+   def _console_command(self, user_input):
+      if len(user_input) < 1:
+         return True
+      if user_input[0] in self.bots:
+         if not self.bots[user_input[0]]._console_command(user_input[1:]):
+            self.remove_bot(user_input[0])
+         return len(self.bots) > 0
+
+      if user_input[0].lower() == 'quit':
+         for name, bot in self.bots.items():
+            bot._console_command(user_input)
+         return False
+
+      if user_input[0].lower() == 'networks':
+         for name, bot in self.bots.items():
+            self.__log(name, 'as', bot.nick)
+         for name in self.reconnecting:
+            self.__log(name, 'reconnecting')
+         return True
+
+      if self.bots:
+         first = next(iter(self.bots.values()))
+         first._console_command(user_input)
+      return True
+
+
+   # Clean up every bot that was added, including ones whose connections
+   # have closed.
+   def cleanup(self):
+      for bot in self.added:
+         bot.cleanup()
+      self.selector.close()
+
+
+   # Register each bot's socket for the events it is waiting on, and return
+   # the shortest timeout any of them needs, including the bots reconnecting
+   # and the timers of bots that are gone.
+   def __update_events(self):
+      timeout = None
+      waiting = set(self.bots.values())
+      waiting.update(reconnection.bot for reconnection in self.reconnecting.values())
+      for bot in self.added:
+         if bot not in waiting:
+            bot_timeout = bot.scheduler.delay()
+            if bot_timeout is not None and (timeout is None or bot_timeout < timeout):
+               timeout = bot_timeout
+      for name, bot in self.bots.items():
+         wants_write, bot_timeout = bot._wait_spec()
+         events = selectors.EVENT_READ
+         if wants_write:
+            events |= selectors.EVENT_WRITE
+         if self.selector.get_key(bot.sock).events != events:
+            self.selector.modify(bot.sock, events, bot)
+         if bot_timeout is not None and (timeout is None or bot_timeout < timeout):
+            timeout = bot_timeout
+      for reconnection in self.reconnecting.values():
+         bot_timeout = reconnection.bot._wait_spec()[1]
+         if bot_timeout is not None and (timeout is None or bot_timeout < timeout):
+            timeout = bot_timeout
+      return timeout
+
+
+   # Write output, like print, through the logger of the first bot added.
+   def __log(self, *args):
+      if self.added:
+         self.added[0].log(*args)
+
+
+   def __name_of(self, bot):
+      for name, other in self.bots.items():
+         if other is bot:
+            return name
+      return None
+
+
+   ###
+   ### Constants
+   ###
+
+   # seconds a reconnection attempt may take to connect and be welcomed
+   # before it is given up on
+   WELCOME_TIMEOUT = 60
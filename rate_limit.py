@@ -0,0 +1,66 @@
+"""
+   Rate limit module. Contains the RateLimiter class, which the bot uses to
+   stop any one user (or channel) from setting off an extension more often
+   than it allows.
+"""
+
+import sys
+import time
+import threading
+import collections
+
+# stop creating .pyc files
+sys.dont_write_bytecode = True
+
+class RateLimiter:
+
+   # Allow calls calls per period seconds for each key, using the generic
+   # cell rate algorithm: each key only needs the time its next call would
+   # be due if calls were evenly spaced (its "theoretical arrival time"), and
+   # a call is allowed as long as that isn't more than the burst allowance
+   # ahead of now. burst defaults to calls, so a quiet key may use its whole
+   # allowance at once.
+   # At most max_keys keys are remembered. The least recently seen are
+   # forgotten first, which at worst lets a key start afresh early.
+   def __init__(self, calls, period, burst=None, max_keys=10000):
+      if burst is None:
+         burst = calls
+      self.interval = period / calls
+      self.tolerance = self.interval * (burst - 1)
+      self.max_keys = max_keys
+      # maps each key to a list of its arrival time, and whether it has been
+      # refused since it was last allowed
+      self.keys = collections.OrderedDict()
+      self.lock = threading.Lock()
+
+
+   # Record a call for key if it is allowed. Returns a tuple of how many
+   # seconds until a call would be allowed (0 if this one is), and whether
+   # this is the first call refused since the key was last allowed, so that
+   # a refusal can be explained just once.
+   def check(self, key):
+      now = time.monotonic()
+      with self.lock:
+         state = self.keys.get(key)
+         if state is None:
+            state = [now, False]
+            self.keys[key] = state
+            if len(self.keys) > self.max_keys:
+               self.keys.popitem(last=False)
+         else:
+            self.keys.move_to_end(key)
+
+         arrival = max(state[0], now)
+         wait = arrival - self.tolerance - now
+         if wait > 0:
+            first = not state[1]
+            state[1] = True
+            return (wait, first)
+         state[0] = arrival + self.interval
+         state[1] = False
+         return (0, False)
+
+
+   # Number of keys remembered.
+   def __len__(self):
+      return len(self.keys)
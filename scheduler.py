@@ -0,0 +1,155 @@
+"""
+   Scheduler module. Contains the Scheduler class, which keeps the timers
+   the bot and its extensions set, and runs them from the bot's event loop.
+"""
+
+import sys
+import time
+import heapq
+import threading
+
+# stop creating .pyc files
+sys.dont_write_bytecode = True
+
+class TimerHandle:
+   # Returned by Scheduler.call_later and call_every. Call cancel to stop the
+   # timer; a repeating timer keeps the same handle for every run.
+   __slots__ = ('when', 'fn', 'args', 'interval', 'cancelled', 'queued', 'scheduler')
+
+   def __init__(self, scheduler, when, fn, args, interval):
+      self.scheduler = scheduler
+      self.when = when
+      self.fn = fn
+      self.args = args
+      self.interval = interval
+      self.cancelled = False
+      # whether the handle is in the scheduler's heap
+      self.queued = False
+
+   def cancel(self):
+      self.scheduler._cancel(self)
+
+
+class Scheduler:
+
+   # Timers are kept in a heap ordered by when they are due, so setting one
+   # costs O(log n) and finding the next is O(1), however many are pending.
+   # Cancelled timers are left in the heap and skipped when they come up,
+   # unless they come to make up most of it, when it is rebuilt without them.
+   # on_error is called with the handle and the exception when a timer's
+   # function raises; the scheduler carries on either way.
+   def __init__(self, on_error=None):
+      self.heap = []
+      # tie breaker, so timers due at the same moment run in the order set
+      self.counter = 0
+      self.cancelled = 0
+      self.on_error = on_error
+      # Called, from whichever thread set it, when a timer is set that is due
+      # before every other, for event loops that need to wake up for it.
+      self.on_change = None
+      self.lock = threading.Lock()
+
+
+   # Call fn(*args) once, delay seconds from now.
+   def call_later(self, delay, fn, *args):
+      return self.__add(time.monotonic() + delay, fn, args, None)
+
+
+   # Call fn(*args) every interval seconds, the first time interval seconds
+   # from now, until the handle is cancelled. A run that is late doesn't make
+   # the next ones come sooner to catch up.
+   def call_every(self, interval, fn, *args):
+      if interval <= 0:
+         raise ValueError('call_every needs a positive interval, not %r' % interval)
+      return self.__add(time.monotonic() + interval, fn, args, interval)
+
+
+   def __add(self, when, fn, args, interval):
+      handle = TimerHandle(self, when, fn, args, interval)
+      with self.lock:
+         self.__push(handle)
+         first = self.heap[0][2] is handle
+      if first and self.on_change is not None:
+         self.on_change()
+      return handle
+
+
+   def __push(self, handle):
+      handle.queued = True
+      self.counter += 1
+      heapq.heappush(self.heap, (handle.when, self.counter, handle))
+
+
+   def _cancel(self, handle):
+      with self.lock:
+         if handle.cancelled:
+            return
+         handle.cancelled = True
+         if not handle.queued:
+            return
+         self.cancelled += 1
+         if self.cancelled > Scheduler.COMPACT_MIN and self.cancelled * 2 > len(self.heap):
+            self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+
+   # Number of timers pending.
+   def pending(self):
+      return len(self.heap) - self.cancelled
+
+
+   # Seconds until the next timer is due (0 if one is overdue), or None if
+   # there are none.
+   def delay(self):
+      with self.lock:
+         self.__drop_cancelled()
+         if not self.heap:
+            return None
+         return max(0.0, self.heap[0][0] - time.monotonic())
+
+
+   def __drop_cancelled(self):
+      heap = self.heap
+      while heap and heap[0][2].cancelled:
+         heapq.heappop(heap)[2].queued = False
+         self.cancelled -= 1
+
+
+   # Run every timer that is due. Timers set by the functions run here are
+   # left for the next call, even if they are already due.
+   def run_due(self):
+      now = time.monotonic()
+      due = []
+      with self.lock:
+         heap = self.heap
+         while heap and heap[0][0] <= now:
+            handle = heapq.heappop(heap)[2]
+            handle.queued = False
+            if handle.cancelled:
+               self.cancelled -= 1
+               continue
+            if handle.interval is not None:
+               # skip runs missed altogether rather than bunch them up
+               handle.when += handle.interval
+               if handle.when <= now:
+                  handle.when = now + handle.interval
+               self.__push(handle)
+            due.append(handle)
+
+      for handle in due:
+         if handle.cancelled:
+            continue
+         try:
+            handle.fn(*handle.args)
+         except Exception as e:
+            if self.on_error is not None:
+               self.on_error(handle, e)
+
+
+   ###
+   ### Constants
+   ###
+
+   # never bother rebuilding the heap for fewer cancelled timers than this
+   COMPACT_MIN = 64
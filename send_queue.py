@@ -0,0 +1,192 @@
+"""
+   Send queue module. Contains the SendQueue class, which schedules lines
+   going out to an IRC server so the bot doesn't get kicked for flooding.
+"""
+
+import sys
+import time
+import collections
+
+# stop creating .pyc files
+sys.dont_write_bytecode = True
+
+class SendQueue:
+
+   def __init__(self, send, rate=2.0, burst=5, sendv=None):
+      # send is a function taking a bytes-like object and returning how many
+      # bytes of it were accepted, like a non-blocking socket.send. It may
+      # raise BlockingIOError if it can't accept anything right now.
+      # sendv, if given, is the same but takes a list of bytes-like objects to
+      # be written one after the other, like socket.sendmsg, so a flush of
+      # many lines is a single call without joining them first.
+      self.send = send
+      self.sendv = sendv
+      # Token bucket: up to burst lines can go out back to back, after which
+      # lines go out at rate lines per second.
+      self.rate = rate
+      self.burst = burst
+      self.tokens = float(burst)
+      self.last_refill = time.monotonic()
+
+      # High priority lines (PONG, QUIT) jump the queue and don't wait for
+      # tokens. Everything else is queued per target and the targets are
+      # served round robin, so one busy channel can't starve the others.
+      # Both hold tuples of (encoded line, time queued).
+      self.urgent = collections.deque()
+      self.targets = collections.OrderedDict()
+      # bytes taken off the queues that the transport hasn't accepted yet
+      self.outbuf = b''
+
+      # counters
+      self.depth = 0
+      self.max_depth = 0
+      self.lines_queued = 0
+      self.lines_sent = 0
+      self.bytes_sent = 0
+      self.total_wait = 0.0
+      self.max_wait = 0.0
+
+
+   # Queue an encoded line (including its \r\n) to be sent.
+   def put(self, data, target=None, priority=None):
+      if priority is None:
+         priority = SendQueue.NORMAL
+      entry = (data, time.monotonic())
+      if priority == SendQueue.HIGH:
+         self.urgent.append(entry)
+      else:
+         pending = self.targets.get(target)
+         if pending is None:
+            pending = collections.deque()
+            self.targets[target] = pending
+         pending.append(entry)
+
+      self.depth += 1
+      self.lines_queued += 1
+      if self.depth > self.max_depth:
+         self.max_depth = self.depth
+
+
+   # Drop everything waiting to be sent, such as lines meant for a connection
+   # that has closed. The counters are kept.
+   def clear(self):
+      self.urgent.clear()
+      self.targets.clear()
+      self.outbuf = b''
+      self.depth = 0
+
+
+   # Whether anything is still waiting to be sent.
+   def pending(self):
+      return self.depth > 0 or len(self.outbuf) > 0
+
+
+   # Whether the transport refused data on the last flush, meaning the caller
+   # should wait for the socket to become writable before flushing again.
+   def blocked(self):
+      return len(self.outbuf) > 0
+
+
+   # Number of seconds until the next queued line may be sent, 0 if one may be
+   # sent right away, or None if nothing is queued.
+   def delay(self):
+      if self.urgent:
+         return 0
+      if not self.targets:
+         return None
+      self.__refill(time.monotonic())
+      if self.tokens >= 1:
+         return 0
+      return (1 - self.tokens) / self.rate
+
+
+   # Hand as many lines to the transport as the token bucket allows, in as
+   # few calls as possible. This never blocks; whatever the transport doesn't
+   # accept is kept for the next call.
+   def flush(self):
+      now = time.monotonic()
+      self.__refill(now)
+      while True:
+         batch = [self.outbuf] if self.outbuf else []
+         while len(batch) < SendQueue.MAX_BATCH:
+            data = self.__next_line(now)
+            if data is None:
+               break
+            batch.append(data)
+         if not batch:
+            return
+
+         try:
+            if self.sendv is not None:
+               nbytes = self.sendv(batch)
+            else:
+               nbytes = self.send(b''.join(batch) if len(batch) > 1 else batch[0])
+         except (BlockingIOError, InterruptedError):
+            nbytes = 0
+         self.bytes_sent += nbytes
+
+         # keep whatever wasn't accepted
+         for i, data in enumerate(batch):
+            if nbytes < len(data):
+               self.outbuf = data[nbytes:] + b''.join(batch[i + 1:])
+               # the transport is full
+               return
+            nbytes -= len(data)
+         self.outbuf = b''
+
+
+   # Return a dictionary of the queue's counters.
+   def stats(self):
+      return {
+         'depth': self.depth,
+         'max_depth': self.max_depth,
+         'lines_queued': self.lines_queued,
+         'lines_sent': self.lines_sent,
+         'bytes_sent': self.bytes_sent,
+         'avg_wait': self.total_wait / self.lines_sent if self.lines_sent else 0.0,
+         'max_wait': self.max_wait,
+      }
+
+
+   # Add the tokens earned since the last refill.
+   def __refill(self, now):
+      self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+      self.last_refill = now
+
+
+   # Take the next line that may be sent off the queues, or None if there is
+   # none or the token bucket is empty.
+   def __next_line(self, now):
+      if self.urgent:
+         data, queued = self.urgent.popleft()
+         self.tokens = max(0.0, self.tokens - 1)
+      elif self.targets and self.tokens >= 1:
+         target, pending = next(iter(self.targets.items()))
+         data, queued = pending.popleft()
+         if pending:
+            self.targets.move_to_end(target)
+         else:
+            del self.targets[target]
+         self.tokens -= 1
+      else:
+         return None
+
+      wait = now - queued
+      self.total_wait += wait
+      if wait > self.max_wait:
+         self.max_wait = wait
+      self.depth -= 1
+      self.lines_sent += 1
+      return data
+
+
+   ###
+   ### Constants for priorities
+   ###
+
+   HIGH = 0
+   NORMAL = 1
+
+   # most lines handed to the transport in one call, within the usual limit
+   # on the number of buffers in one sendmsg
+   MAX_BATCH = 512
@@ -0,0 +1,157 @@
+"""
+   Triggers module. Contains the TriggerRegistry class, which compiles the
+   commands and triggers every extension declares for PRIVMSG into one
+   prefix trie and one regular expression, so each chat line is scanned once
+   however many extensions are listening for something in it.
+"""
+
+import sys
+import re
+import inspect
+import threading
+
+# stop creating .pyc files
+sys.dont_write_bytecode = True
+
+class TriggerRegistry:
+
+   # If guard is given, it is called with each extension and handler, and
+   # what it returns is called instead of the handler.
+   def __init__(self, extensions, guard=None):
+      # The trie is nested dictionaries keyed by character. The None key of a
+      # node holds the (extension, handler) pairs for the command ending
+      # there.
+      self.trie = {}
+      # (extension, handler, group name) for each regex trigger, in order
+      self.regex_triggers = []
+      self.regex = None
+      # extensions with anything declared, in the order given
+      self.extensions = []
+
+      patterns = []
+      for ext in extensions:
+         if not ext.commands and not ext.triggers:
+            continue
+         self.extensions.append(ext)
+         for prefix, handler in ext.commands.items():
+            if guard is not None:
+               handler = guard(ext, handler)
+            node = self.trie
+            for ch in prefix:
+               node = node.setdefault(ch, {})
+            node.setdefault(None, []).append((ext, handler))
+         for pattern, handler in ext.triggers:
+            if guard is not None:
+               handler = guard(ext, handler)
+            group = 't%d' % len(self.regex_triggers)
+            # Every trigger is an optional lookahead from the start of the
+            # line followed by an empty named group, so a single match
+            # tells which triggers are found anywhere in the line. A trigger
+            # anchored with ^ can only be found at the start, so it isn't
+            # searched for through the rest.
+            skip = '' if anchored(pattern) else '(?s:.*?)'
+            patterns.append('(?:(?=%s(?:%s))(?P<%s>))?' % (skip, pattern, group))
+            self.regex_triggers.append((ext, handler, group))
+      if patterns:
+         self.regex = re.compile(''.join(patterns))
+
+      # the matches for the message last looked at on each thread, since
+      # every extension's hook asks about the same message in turn
+      self.local = threading.local()
+
+
+   # Return a dictionary mapping each extension with something matching
+   # msg's trail to the list of its handlers that match: commands first,
+   # shortest prefix first, then triggers in the order declared.
+   def match(self, msg):
+      local = self.local
+      if getattr(local, 'msg', None) is msg:
+         return local.matches
+
+      trail = msg.trail
+      matches = {}
+      node = self.trie
+      for ch in trail:
+         node = node.get(ch)
+         if node is None:
+            break
+         for ext, handler in node.get(None, ()):
+            matches.setdefault(ext, []).append(handler)
+
+      if self.regex is not None:
+         found = self.regex.match(trail)
+         if found.lastindex is not None:
+            for ext, handler, group in self.regex_triggers:
+               if found.group(group) is not None:
+                  matches.setdefault(ext, []).append(handler)
+
+      local.msg = msg
+      local.matches = matches
+      return matches
+
+
+   # Return a PRIVMSG hook for an extension, which runs whichever of its
+   # handlers match the message. Like any hook it returns True if one of them
+   # halted the message, and False if none did (including when nothing
+   # matched, as the extensions' own PRIVMSG hooks used to).
+   # If allow is given, it is called with the message before running any
+   # handlers, and if it returns False they aren't run and the message is
+   # halted as though they had.
+   def hook(self, ext, allow=None):
+      def run_triggers(msg):
+         handlers = self.match(msg).get(ext)
+         if handlers is None:
+            return False
+         if allow is not None and not allow(msg):
+            return True
+         for handler in handlers:
+            if handler(msg) == True:
+               return True
+         return False
+      return run_triggers
+
+
+   # Like hook, but the hook returned is a coroutine function, for AsyncBot.
+   # Handlers that return awaitables (as the guard AsyncBot gives makes
+   # them all do) are awaited in turn.
+   def hook_async(self, ext, allow=None):
+      async def run_triggers(msg):
+         handlers = self.match(msg).get(ext)
+         if handlers is None:
+            return False
+         if allow is not None and not allow(msg):
+            return True
+         for handler in handlers:
+            retn = handler(msg)
+            if inspect.isawaitable(retn):
+               retn = await retn
+            if retn == True:
+               return True
+         return False
+      return run_triggers
+
+
+# Whether a regular expression can only match at the start of a line, because
+# it begins with ^ and has no | outside of any group to get around that.
+def anchored(pattern):
+   if pattern[:1] != '^':
+      return False
+   depth = 0
+   in_class = False
+   escaped = False
+   for ch in pattern:
+      if escaped:
+         escaped = False
+      elif ch == '\\':
+         escaped = True
+      elif in_class:
+         in_class = ch != ']'
+      elif ch == '[':
+         in_class = True
+      elif ch == '(':
+         depth += 1
+      elif ch == ')':
+         depth -= 1
+      elif ch == '|' and depth == 0:
+         return False
+   return True
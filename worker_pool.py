@@ -0,0 +1,65 @@
+"""
+   Worker pool module. Contains the WorkerPool class, a fixed set of threads
+   that process items in order within each partition key.
+"""
+
+import sys
+import queue
+import threading
+
+# stop creating .pyc files
+sys.dont_write_bytecode = True
+
+class WorkerPool:
+
+   # Start num_workers threads, each of which calls fn on the items given to
+   # it. Items submitted with the same key always go to the same thread, so
+   # they are processed in the order they were submitted.
+   # on_error is called with the item and the exception when fn raises; the
+   # worker carries on either way.
+   def __init__(self, num_workers, fn, name='worker', on_error=None):
+      self.fn = fn
+      self.on_error = on_error
+      self.queues = []
+      self.threads = []
+      for i in range(num_workers):
+         items = queue.Queue()
+         thread = threading.Thread(None, self.__work, '%s-%d' % (name, i), (items,))
+         thread.daemon = True
+         self.queues.append(items)
+         self.threads.append(thread)
+         thread.start()
+
+
+   # Queue an item to be processed by the worker responsible for key.
+   def submit(self, key, item):
+      self.queues[hash(key) % len(self.queues)].put(item)
+
+
+   # Number of items waiting across all workers.
+   def depth(self):
+      return sum(items.qsize() for items in self.queues)
+
+
+   # Stop the workers once they have processed everything already submitted.
+   def shutdown(self):
+      for items in self.queues:
+         items.put(WorkerPool.STOP)
+      for thread in self.threads:
+         thread.join()
+
+
+   def __work(self, items):
+      while True:
+         item = items.get()
+         if item is WorkerPool.STOP:
+            return
+         try:
+            self.fn(item)
+         except Exception as e:
+            if self.on_error is not None:
+               self.on_error(item, e)
+
+
+   # sentinel telling a worker to exit
+   STOP = object()